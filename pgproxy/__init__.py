@@ -1,11 +1,11 @@
 from __future__ import with_statement
-import subprocess
 import os
-import socket
 import sys
 import time
-import signal
-from contextlib import closing
+
+# Only what every use of the package needs is imported here. The rest, 
+# Twisted included, is imported when it's used, so that importing pgproxy 
+# to start a proxy in a subprocess costs next to nothing. 
 
 __all__ = ['__version__', 'run', 'PGProxy',]
 
@@ -16,8 +16,8 @@ __version__ = '0.1'
 
 
 def run(listenPort=5433, serverAddr=('localhost', 5432), 
-        pidfile=None, logfile=None):
-    p = PGProxy(listenPort, serverAddr, pidfile, logfile)
+        pidfile=None, logfile=None, **kw):
+    p = PGProxy(listenPort, serverAddr, pidfile, logfile, **kw)
     return p.start()
 
 
@@ -26,6 +26,8 @@ def _serverUp(port):
     """
     Returns true if the given port is accepting connections.
     """
+    from contextlib import closing
+    import socket
     try:
         with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
             s.connect(('localhost', port))
@@ -44,43 +46,271 @@ def _waitForServerUp(port):
 
 
 
+def _readLine(fd, timeout):
+    """
+    Reads a line from fd, returning None if it's closed first or if
+    timeout seconds pass.
+    """
+    import select
+    data = ''
+    deadline = time.time() + timeout
+    while '\n' not in data:
+        left = deadline - time.time()
+        if left <= 0 or not select.select([fd], [], [], left)[0]:
+            return None
+        chunk = os.read(fd, 64)
+        if not chunk:
+            return None
+        data += chunk
+    return data.split('\n')[0]
+
+
+
 class PGProxy(object):
 
     def __init__(self, listenPort=5433, serverAddr=('localhost', 5432), 
-                 pidfile=None, logfile=None):
+                 pidfile=None, logfile=None, record=None, replay=None,
+                 onDivergence='fallback', capture=None, metricsPort=None,
+                 report=None, detectRepeats=False, repeatNotice=False,
+                 statements=None, statementsFile=None, budgetAction='fail',
+                 stageTiming=False, profileDir=None, idleTimeout=None,
+                 idleInTransactionTimeout=None, maxClientBuffer=None,
+                 maxMessageSize=None, workers=None, engine='twisted',
+                 inProcess=False, listenUnix=None, serverUnix=None, 
+                 listenTcp=True):
+        """
+        record and replay are paths to cassette files. When recording, the 
+        traffic of each test is saved to the cassette as the proxy shuts 
+        down. When replaying, tests are answered from the cassette, and 
+        onDivergence ('fallback' or 'fail') determines what happens when 
+        a test no longer matches it. Falling back to the server only works 
+        if it trusts the proxy's connection, since passwords aren't 
+        recorded (see pgproxy.cassette). 
+
+        capture is the path of a binary capture of all of the proxy's 
+        traffic (see pgproxy.capture). 
+
+        metricsPort is a port to serve metrics on, in the Prometheus text 
+        format. 
+
+        report is the path of a report of the work done by each test, 
+        written as the proxy shuts down (see pgproxy.report). 
+
+        detectRepeats turns on the detection of queries repeated within a 
+        test (see pgproxy.repeats), and repeatNotice warns the client of 
+        them with a NOTICE. 
+
+        statements is the number of query fingerprints to keep statistics 
+        of (see pgproxy.statements), and statementsFile the path they're 
+        written to as the proxy shuts down. 
+
+        budgetAction is what happens when a test goes over its budget (see 
+        pgproxy.budget): 'fail' or 'report'. 
+
+        stageTiming turns on the timing of each stage of relaying messages 
+        (see pgproxy.timing). 
+
+        profileDir is the directory that profiles started with PGPROXY 
+        PROFILE START are written to (see pgproxy.profiler). 
+
+        idleTimeout and idleInTransactionTimeout are the seconds a client 
+        may be idle for, outside of and in a transaction, maxClientBuffer 
+        the bytes that may wait to be read by a client, and maxMessageSize 
+        the largest message a client may send. A client that goes over one 
+        is disconnected. 
+
+        workers is the number of proxy processes to run, sharing the 
+        listening port (see pgproxy.workers). 
+
+        engine is what the proxy runs on: 'twisted', or 'asyncio' (see 
+        pgproxy.aio). 
+
+        inProcess runs the proxy in a thread of this process, rather than 
+        in a process of its own (see pgproxy.embedded). 
+
+        listenUnix is a directory to also listen on a Unix socket in, 
+        named .s.PGSQL.<listenPort> as libpq expects, or the path of the 
+        socket itself, and listenTcp=False listens on it alone. serverUnix 
+        is the directory (or socket) to connect to the server by, rather 
+        than by TCP (see pgproxy.unix). Once the proxy has started, the 
+        path of its socket is its socketPath attribute. 
+
+        listenPort may be 0, to listen on any free port. Once the proxy 
+        has started, the port it's listening on is its port attribute. 
+        """
         self.serverHost, self.serverPort = serverAddr
         self.listenPort = listenPort
         self.pidfile = pidfile or os.path.join(_this_dir, 'pgproxy.pid')
         self.logfile = logfile
         self.tacfile = os.path.join(_this_dir, 'service.tac')
         self.twistd = os.path.join(_this_dir, 'twistd.py')
+        self.record = record
+        self.replay = replay
+        self.onDivergence = onDivergence
+        self.capture = capture
+        self.metricsPort = metricsPort
+        self.report = report
+        self.detectRepeats = detectRepeats
+        self.repeatNotice = repeatNotice
+        self.statements = statements
+        self.statementsFile = statementsFile
+        self.budgetAction = budgetAction
+        self.stageTiming = stageTiming
+        self.profileDir = profileDir
+        self.idleTimeout = idleTimeout
+        self.idleInTransactionTimeout = idleInTransactionTimeout
+        self.maxClientBuffer = maxClientBuffer
+        self.maxMessageSize = maxMessageSize
+        self.workers = workers
+        self.engine = engine
+        self.inProcess = inProcess
+        self.listenUnix = listenUnix
+        self.serverUnix = serverUnix
+        self.listenTcp = listenTcp
+        if inProcess and workers:
+            raise ValueError('workers can only be run out of process')
+        self.port = None
+        self.socketPath = None
         self.proxy = None
+        self.embedded = None
+        self.output = None
 
 
-    def start(self):
-        args = [sys.executable, self.twistd, '-n', '-y', self.tacfile, 
-                '--pidfile=%s' % self.pidfile, 
-                '--listen-port=%s' % self.listenPort,
+    # Seconds to wait for the proxy to start listening.
+    startTimeout = 30
+
+
+    def options(self):
+        """
+        Returns the command line options of the proxy.
+        """
+        args = ['--listen-port=%s' % self.listenPort,
                 '--server-port=%s' % self.serverPort, 
                 '--server-host=%s' % self.serverHost,]
+        if self.record:
+            args.append('--record=%s' % self.record)
+        if self.replay:
+            args.extend(['--replay=%s' % self.replay, 
+                         '--on-divergence=%s' % self.onDivergence])
+        if self.capture:
+            args.append('--capture=%s' % self.capture)
+        if self.metricsPort:
+            args.append('--metrics-port=%s' % self.metricsPort)
+        if self.report:
+            args.append('--report=%s' % self.report)
+        if self.detectRepeats:
+            args.append('--detect-repeats')
+        if self.repeatNotice:
+            args.append('--repeat-notice')
+        if self.statements:
+            args.append('--statements=%s' % self.statements)
+        if self.statementsFile:
+            args.append('--statements-file=%s' % self.statementsFile)
+        if self.budgetAction != 'fail':
+            args.append('--budget-action=%s' % self.budgetAction)
+        if self.stageTiming:
+            args.append('--stage-timing')
+        if self.profileDir:
+            args.append('--profile-dir=%s' % self.profileDir)
+        for flag, value in [
+            ('idle-timeout', self.idleTimeout), 
+            ('idle-in-transaction-timeout', self.idleInTransactionTimeout),
+            ('max-client-buffer', self.maxClientBuffer), 
+            ('max-message-size', self.maxMessageSize),
+            ('workers', self.workers),
+            ('listen-unix', self.listenUnix),
+            ('server-unix', self.serverUnix)]:
+            if value:
+                args.append('--%s=%s' % (flag, value))
+        if not self.listenTcp:
+            args.append('--no-tcp')
+        return args
+
+
+    def start(self):
+        if self.inProcess:
+            return self.startInProcess()
+        import subprocess
+        import tempfile
+        if self.engine == 'asyncio':
+            args = [sys.executable, os.path.join(_this_dir, 'aio.py')]
+        else:
+            args = [sys.executable, self.twistd, '-n', '-y', self.tacfile]
+        args += ['--pidfile=%s' % self.pidfile] + self.options()
         if self.logfile:
             args.extend(['-l', self.logfile])
-        self.proxy = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        if not _waitForServerUp(self.listenPort):
-            raise AssertionError('Could not start pgproxy on port %s' 
-                                 % self.listenPort)
+        # The proxy writes its port to the pipe once it's listening. What 
+        # it writes to stdout and stderr goes to a file, so that it can 
+        # never block on a full pipe. 
+        r, w = os.pipe()
+        self.output = tempfile.TemporaryFile(prefix='pgproxy-')
+        try:
+            self.proxy = subprocess.Popen(
+                args + ['--ready-fd=%d' % w], stdout=self.output, 
+                stderr=subprocess.STDOUT, close_fds=False)
+        finally:
+            os.close(w)
+        try:
+            line = _readLine(r, self.startTimeout)
+        finally:
+            os.close(r)
+
+        if not line:
+            self.terminate()
+            self.output.seek(0)
+            output = self.output.read()[-4096:]
+            self.output.close()
+            raise AssertionError('Could not start pgproxy on port %s:\n%s' 
+                                 % (self.listenPort, output))
+        self.port = int(line)
+        self.setSocketPath()
+        return self
+
+
+    def startInProcess(self):
+        from options import Options
+        config = Options()
+        config.parseOptions(self.options())
+        config['logfile'] = self.logfile
+        if self.engine == 'asyncio':
+            from embedded import LoopThreadProxy as Proxy
+        else:
+            from embedded import EmbeddedProxy as Proxy
+        self.embedded = Proxy(dict(config))
+        self.port = self.embedded.start()
+        self.setSocketPath()
         return self
 
 
+    def setSocketPath(self):
+        if self.listenUnix:
+            from unix import socketPath
+            self.socketPath = socketPath(self.listenUnix, self.port)
+
+
     __enter__ = start
 
 
     def stop(self):
-        os.kill(self.proxy.pid, signal.SIGTERM)
+        """
+        Stops the proxy, and waits for it to exit.
+        """
+        if self.embedded is not None:
+            embedded, self.embedded = self.embedded, None
+            embedded.stop()
+            return self
+        self.terminate()
+        self.output.close()
         return self
 
+
+    def terminate(self):
+        import signal
+        if self.proxy.poll() is None:
+            os.kill(self.proxy.pid, signal.SIGTERM)
+            self.proxy.wait()
+
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
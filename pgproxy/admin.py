@@ -0,0 +1,228 @@
+"""
+Module for the proxy's admin queries. These are answered by the proxy
+itself, and never reach the server:
+
+    SHOW PGPROXY STATS            - the message counts, filter actions
+                                    and reply latencies (see the stats
+                                    module)
+    SHOW PGPROXY POOLS            - the state of the connection to the
+                                    server
+    SHOW PGPROXY CLIENTS          - the attached client connections
+    SHOW PGPROXY TESTS            - the tests that have taken the most
+                                    database time, when the proxy is run
+                                    with --report
+    SHOW PGPROXY REPORT           - writes the --report file now
+    SHOW PGPROXY REPEATS          - the queries repeated within tests, when
+                                    the proxy is run with --detect-repeats
+    SHOW PGPROXY STATEMENTS       - the statement statistics, when the
+                                    proxy is run with --statements
+    SHOW PGPROXY DUMP STATEMENTS  - writes the --statements-file now
+    SHOW PGPROXY STAGES           - the time spent in each stage of the
+                                    relay path, when the proxy is run with
+                                    --stage-timing
+    SHOW PGPROXY MEMORY           - the bytes held for each connection
+    SHOW PGPROXY MEMORY DIFF      - the biggest changes in the memory
+                                    allocated since the last MEMORY DIFF,
+                                    with tracemalloc (see the memory
+                                    module)
+    PGPROXY PROFILE START         - starts sampling the proxy's stacks
+    PGPROXY PROFILE START CPROFILE
+                                  - starts running cProfile on the proxy
+    PGPROXY PROFILE STOP          - stops the profile and writes it to the
+                                    --profile-dir (see the profiler module)
+
+The SHOW is optional. Each command is a function of the client protocol
+that sent the query, returning the column names and rows of the result, or
+raising AdminError. All values are sent as text.
+
+"""
+import memory
+
+
+
+class AdminError(Exception):
+    """
+    Raised by a command to answer with an error.
+    """
+
+
+
+def _address(p):
+    peer = getattr(p.transport, 'getPeer', None)
+    if peer is None:
+        return None
+    a = peer()
+    return '%s:%s' % (getattr(a, 'host', a), getattr(a, 'port', ''))
+
+
+def stats(client):
+    rows = []
+    s = client.stats and client.stats.snapshot()
+    if s:
+        rows.append(['uptime_seconds', s['uptime']])
+        for group in ('messages', 'bytes', 'actions', 'connections'):
+            for k, v in sorted(s[group].items()):
+                rows.append(['%s.%s' % (group, k), v])
+        for t, summary in sorted(s['latency_ms'].items()):
+            for k, v in sorted(summary.items()):
+                rows.append(['latency_ms.%s.%s' % (t, k), v])
+    return ['name', 'value'], rows
+
+
+def pools(client):
+    pg = client.postgresProtocol
+    columns = ['server', 'state', 'transaction_status', 'test',
+               'committed_test', 'clients', 'waiting_clients', 'owner',
+               'pending_replies']
+    if pg is None:
+        return columns, []
+    config = getattr(getattr(pg, 'pgproxyFactory', None), 'config', {})
+    server = '%s:%s' % (config.get('server-host'), config.get('server-port'))
+    if pg.dead:
+        state = 'dead'
+    elif pg.authenticationComplete:
+        state = 'ready'
+    else:
+        state = 'authenticating'
+    return columns, [[
+            server, state, pg.transactionStatus, pg.activeTest(),
+            pg.committedTest and 't' or 'f', len(pg.clientStack),
+            len(pg.waitingClients),
+            pg.owner and pg.owner.connectionId, pg.pendingReplies]]
+
+
+def clients(client):
+    pg = client.postgresProtocol
+    columns = ['id', 'address', 'current', 'owner', 'held_messages',
+               'savepoints']
+    if pg is None:
+        return columns, []
+    current = pg.currentClient()
+    rows = []
+    for c in reversed(pg.clientStack):
+        rows.append([
+                c.connectionId, _address(c), c is current and 't' or 'f',
+                c is pg.owner and 't' or 'f', len(c.heldMessages),
+                len(c.filter.savepoints)])
+    return columns, rows
+
+
+def _testReport(client):
+    report = client.stats and client.stats.tests
+    if report is None:
+        raise AdminError('the proxy is not reporting on tests (see --report)')
+    return report
+
+
+def tests(client, limit=20):
+    columns = ['test', 'queries', 'backend_seconds', 'rows', 'bytes',
+               'savepoints', 'slowest_seconds', 'slowest_sql']
+    rows = []
+    for name, t in _testReport(client).ranked()[:limit]:
+        seconds, sql = t.slowestStatement()
+        rows.append([name, t.queries, '%.6f' % t.seconds, t.rows, t.bytes,
+                     t.savepoints,
+                     seconds is not None and '%.6f' % seconds or None, sql])
+    return columns, rows
+
+
+def report(client):
+    r = _testReport(client)
+    return ['path', 'tests'], [[client.factory.writeReport(), len(r.tests)]]
+
+
+def repeats(client):
+    detector = client.stats and client.stats.repeats
+    if detector is None:
+        raise AdminError(
+            'the proxy is not detecting repeats (see --detect-repeats)')
+    rows = []
+    for test, findings in sorted(detector.findings().items()):
+        for f in findings:
+            rows.append([test, f.kind, f.times, f.fingerprint])
+    return ['test', 'kind', 'times', 'fingerprint'], rows
+
+
+def _statementTable(client):
+    table = client.stats and client.stats.statements
+    if table is None:
+        raise AdminError(
+            'the proxy is not keeping statement statistics (see --statements)')
+    return table
+
+
+def statements(client, limit=100):
+    table = _statementTable(client)
+    return list(table.columns), table.table(limit)
+
+
+def dumpStatements(client):
+    table = _statementTable(client)
+    if not client.factory.config.get('statements-file'):
+        raise AdminError('no --statements-file was given')
+    return (['path', 'statements'], 
+            [[client.factory.writeStatements(), len(table.statements)]])
+
+
+def stages(client):
+    timing = client.timing
+    if timing is None:
+        raise AdminError(
+            'the proxy is not timing stages (see --stage-timing)')
+    rows = []
+    for scope, key, stage, n, seconds in timing.rows():
+        rows.append([scope, key, stage, n, '%.3f' % (seconds * 1000),
+                     '%.3f' % (seconds * 1e6 / n)])
+    return ['scope', 'key', 'stage', 'count', 'total_ms', 'mean_us'], rows
+
+
+def profileStart(client, mode='sample'):
+    factory = client.factory
+    if factory.profiler is not None:
+        raise AdminError('a profile is already running')
+    factory.startProfile(mode)
+    return (['mode', 'limit_seconds'], 
+            [[mode, factory.config.get('profile-limit', 60)]])
+
+
+def profileStop(client):
+    factory = client.factory
+    if factory.profiler is None:
+        raise AdminError('no profile is running')
+    samples = factory.profiler.samples
+    return ['path', 'samples'], [[factory.stopProfile(), samples]]
+
+
+def memoryUsage(client):
+    factory = getattr(client, 'factory', None)
+    columns = ['connection', 'parse', 'held', 'transport', 'auth', 'total']
+    if factory is None:
+        return columns, []
+    return columns, [
+        [c.connection, c.parse, c.held, c.transport, c.auth, c.total()]
+        for c in memory.top(memory.usage(factory), None)]
+
+
+def memoryDiff(client):
+    if not memory.snapshots.available():
+        raise AdminError('tracemalloc is not available')
+    return (['location', 'size_diff', 'size', 'count_diff'], 
+            [list(d) for d in memory.snapshots.diff()])
+
+
+commands = {
+    'stats': stats,
+    'pools': pools,
+    'clients': clients,
+    'tests': tests,
+    'report': report,
+    'repeats': repeats,
+    'statements': statements,
+    'dump statements': dumpStatements,
+    'stages': stages,
+    'memory': memoryUsage,
+    'memory diff': memoryDiff,
+    'profile start': profileStart,
+    'profile start cprofile': lambda client: profileStart(client, 'cprofile'),
+    'profile stop': profileStop,
+    }
@@ -0,0 +1,452 @@
+"""
+Module for running the proxy on an asyncio event loop instead of the
+Twisted reactor, so that it can be embedded in asyncio test runners and
+services. It's the same proxy: the protocols, filters and message parsing
+are shared with the Twisted engine, and only the connections belong to
+asyncio. Each one is adapted to the proxy's protocols by an AioConnection
+and an AioTransport, and timed calls are made with a LoopClock.
+
+    proxy = AioProxy({'listen-port': 5433, 'server-port': 5432}, loop)
+    loop.run_until_complete(proxy.start())
+    ...
+    loop.run_until_complete(proxy.stop())
+
+The configuration is that of pgproxy.options, as a dict; the defaults are
+used for the options left out. The metrics aren't served on their own
+port, since that's done with twisted.web, but metrics.render(proxy.factory)
+renders them.
+
+asyncio comes with Python 3.4 and later; elsewhere the trollius backport
+is used if it's installed. newEventLoop makes a uvloop loop when uvloop
+is installed and asked for. The proxy can also be run on its own, with
+the options of pgproxy.options, --logfile, --pidfile and --uvloop:
+
+    python -m pgproxy.aio --listen-port=5433 --server-port=5432
+
+"""
+from twisted.internet import address, defer, error, protocol
+from twisted.python import failure, log
+from proxy import PGProxyServerFactory
+import os
+import signal
+import socket
+import sys
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+
+def available():
+    return asyncio is not None
+
+
+def newEventLoop(useUvloop=False):
+    """
+    Returns a new event loop, uvloop's if useUvloop is true and it's
+    installed.
+    """
+    if useUvloop and uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def _ensureFuture(coro, loop):
+    ensure = getattr(asyncio, 'ensure_future', None) or getattr(
+        asyncio, 'async')
+    return ensure(coro, loop=loop)
+
+
+
+class _DelayedCall(object):
+    """
+    A call scheduled by a LoopClock.
+    """
+
+    def __init__(self, loop, delay, f, args, kw):
+        self.f, self.args, self.kw = f, args, kw
+        self.called = self.cancelled = False
+        self.handle = loop.call_later(delay, self._run)
+
+
+    def _run(self):
+        self.called = True
+        self.f(*self.args, **self.kw)
+
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+        self.cancelled = True
+        self.handle.cancel()
+
+
+
+class LoopClock(object):
+    """
+    Schedules calls on an asyncio loop, for the protocols and the factory
+    (and LoopingCalls) that would otherwise use the reactor.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+
+    def seconds(self):
+        return self.loop.time()
+
+
+    def callLater(self, delay, f, *args, **kw):
+        return _DelayedCall(self.loop, delay, f, args, kw)
+
+
+
+class AioTransport(object):
+    """
+    The transport of a proxy protocol that's connected by asyncio. It
+    has the methods of a Twisted transport that the proxy uses.
+    """
+
+    disconnecting = False
+    paused = False
+
+
+    def __init__(self, transport, connection):
+        self.transport = transport
+        self.connection = connection
+
+
+    def write(self, data):
+        self.transport.write(data)
+
+
+    def writeSequence(self, seq):
+        self.transport.writelines(seq)
+
+
+    def pauseProducing(self):
+        self.paused = True
+        self.transport.pause_reading()
+
+
+    def resumeProducing(self):
+        self.paused = False
+        self.transport.resume_reading()
+        self.connection.deliverUnread()
+
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.transport.close()
+
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.transport.abort()
+
+
+    def getPeer(self):
+        peer = self.transport.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            return address.IPv4Address('TCP', peer[0], peer[1])
+        return peer
+
+
+    def writeBufferSize(self):
+        return self.transport.get_write_buffer_size()
+
+
+    def limitWrites(self, high, low):
+        """
+        Stops the peer of the protocol being read from while more than
+        high bytes wait to be written, until there are low or fewer, as
+        proxy.WriteBufferProducer does for Twisted transports.
+        """
+        self.transport.set_write_buffer_limits(high, low)
+        self.connection.limited = True
+
+
+
+class AioConnection(asyncio and asyncio.Protocol or object):
+    """
+    Hands what happens on an asyncio connection to a proxy protocol: a
+    given one, or else one built by the factory when it's connected.
+    """
+
+    # True if the peer is paused while writes are buffered.
+    limited = False
+
+
+    def __init__(self, factory, protocol=None):
+        self.factory = factory
+        self.protocol = protocol
+        self.transport = None
+        self.pausedPeer = None
+
+        # Data that arrived while the protocol had paused reading. Some 
+        # loops only start reading once connection_made has returned, so a 
+        # pause made as the protocol is connected doesn't take. 
+        self.unread = []
+
+
+    def connection_made(self, transport):
+        # asyncio sends what's written straight away, rather than once per
+        # turn of the loop as Twisted does, so the replies made of several
+        # small writes would otherwise wait on Nagle's algorithm.
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transport = t = AioTransport(transport, self)
+        if self.protocol is None:
+            self.protocol = self.factory.buildProtocol(t.getPeer())
+        clock = getattr(self.factory, 'clock', None)
+        if clock is not None:
+            self.protocol.clock = clock
+        self.protocol.makeConnection(t)
+
+
+    def data_received(self, data):
+        if self.transport.paused:
+            self.unread.append(data)
+        else:
+            self.protocol.dataReceived(data)
+
+
+    def deliverUnread(self):
+        while self.unread and not self.transport.paused:
+            self.protocol.dataReceived(self.unread.pop(0))
+
+
+    def eof_received(self):
+        return False
+
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        if exc is None:
+            reason = protocol.connectionDone
+        else:
+            reason = failure.Failure(exc)
+        self.protocol.connectionLost(reason)
+
+
+    def pause_writing(self):
+        memory = getattr(self.protocol, 'memory', None)
+        if memory is not None:
+            memory.backlog(self.protocol)
+        if not self.limited or self.pausedPeer is not None:
+            return
+        peer = self.protocol.getPeer()
+        if peer is not None:
+            self.pausedPeer = peer
+            peer.pauseReading(self)
+
+
+    def resume_writing(self):
+        peer, self.pausedPeer = self.pausedPeer, None
+        if peer is not None:
+            peer.resumeReading(self)
+
+
+
+class AioServerFactory(PGProxyServerFactory):
+    """
+    The proxy's factory, with the server connections made on an asyncio
+    loop.
+    """
+
+    def __init__(self, pgproxy, loop):
+        PGProxyServerFactory.__init__(self, pgproxy)
+        self.loop = loop
+        self.clock = LoopClock(loop)
+
+
+    def limitWrites(self, p):
+        high = self.config.get('high-water', 1 << 20)
+        if high and hasattr(p.transport, 'limitWrites'):
+            p.transport.limitWrites(high, self.config.get('low-water', 1 << 18))
+
+
+    def connectBackend(self, protocolClass, *args):
+        p = protocolClass(*args)
+        d = defer.Deferred()
+        def connected(f):
+            if f.cancelled():
+                d.errback(failure.Failure(defer.CancelledError()))
+            elif f.exception() is not None:
+                d.errback(failure.Failure(f.exception()))
+            else:
+                d.callback(p)
+        if self.config.get('server-unix'):
+            from unix import socketPath
+            connecting = self.loop.create_unix_connection(
+                lambda: AioConnection(self, p), socketPath(
+                    self.config['server-unix'], self.config['server-port']))
+        else:
+            connecting = self.loop.create_connection(
+                lambda: AioConnection(self, p), self.config['server-host'],
+                self.config['server-port'])
+        _ensureFuture(connecting, self.loop).add_done_callback(connected)
+        return d
+
+
+
+class AioProxy(object):
+    """
+    A proxy on an asyncio loop. config is a dict of pgproxy.options
+    options.
+    """
+
+    def __init__(self, config=None, loop=None):
+        if not available():
+            raise RuntimeError('asyncio is not available')
+        from options import defaults
+        self.config = defaults()
+        self.config.update(config or {})
+        self.loop = loop or asyncio.get_event_loop()
+        self.factory = AioServerFactory(self, self.loop)
+        # The TCP server, and every server, once it's started.
+        self.server = None
+        self.servers = []
+        self.socketPath = None
+        if self.config.get('listen-unix'):
+            from unix import socketPath
+            self.socketPath = socketPath(
+                self.config['listen-unix'], self.config['listen-port'])
+
+
+    @property
+    def port(self):
+        """
+        The port the proxy is listening on, once it's started.
+        """
+        if self.server is None:
+            return self.config['listen-port']
+        return self.server.sockets[0].getsockname()[1]
+
+
+    def start(self):
+        """
+        Starts listening on --listen-port and --listen-unix. Returns a
+        future that's done when it is.
+        """
+        self.factory.doStart()
+        connection = lambda: AioConnection(self.factory)
+        servers = []
+        if not self.config.get('no-tcp'):
+            servers.append(self.loop.create_server(
+                    connection, None, self.config['listen-port']))
+        if self.socketPath:
+            # asyncio doesn't remove a socket left by a proxy that didn't
+            # stop, as Twisted does.
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+            servers.append(self.loop.create_unix_server(
+                    connection, self.socketPath))
+        f = asyncio.gather(*servers, loop=self.loop)
+        def listening(f):
+            if f.cancelled() or f.exception() is not None:
+                return
+            self.servers = f.result()
+            if not self.config.get('no-tcp'):
+                self.server = self.servers[0]
+                log.msg('pgproxy listening on port %d (asyncio).' % self.port)
+            if self.socketPath:
+                os.chmod(self.socketPath, 0777)
+                log.msg('pgproxy listening on %s (asyncio).' % self.socketPath)
+        f.add_done_callback(listening)
+        return f
+
+
+    def stop(self):
+        """
+        Stops listening, disconnects the clients, and stops the factory
+        (which disconnects from the server and writes the files it
+        writes). Returns a future that's done when the listening sockets
+        are closed.
+        """
+        servers, self.servers, self.server = self.servers, [], None
+        pg = self.factory.postgresProtocol
+        if pg is not None:
+            for c in list(pg.clientStack):
+                c.transport.loseConnection()
+        self.factory.doStop()
+        for server in servers:
+            server.close()
+        if self.socketPath and os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        return asyncio.gather(
+            *[server.wait_closed() for server in servers], loop=self.loop)
+
+
+
+def main(argv=None):
+    from options import Options
+    class AioOptions(Options):
+        optFlags = [
+            ('uvloop', '', 'Run on uvloop, if it is installed.'),
+            ]
+        optParameters = [
+            ('logfile', 'l', None, 'Log to this file, or - for stdout.'),
+            ('pidfile', '', None, 'Write the process id to this file.'),
+            ]
+
+    config = AioOptions()
+    try:
+        config.parseOptions(argv)
+    except Exception, e:
+        sys.stderr.write('%s\n%s\n' % (config, e))
+        return 2
+    if config['workers']:
+        sys.stderr.write('--workers is not supported by the asyncio engine\n')
+        return 2
+    if config['logfile'] and config['logfile'] != '-':
+        log.startLogging(open(config['logfile'], 'a'), setStdout=False)
+    else:
+        log.startLogging(sys.stdout, setStdout=False)
+
+    if config['pidfile']:
+        f = open(config['pidfile'], 'w')
+        try:
+            f.write('%d\n' % os.getpid())
+        finally:
+            f.close()
+
+    loop = newEventLoop(config['uvloop'])
+    asyncio.set_event_loop(loop)
+    proxy = AioProxy(dict(config), loop)
+    loop.run_until_complete(proxy.start())
+    if config['ready-fd'] is not None:
+        # see pgproxy.ready
+        os.write(config['ready-fd'], '%d\n' % proxy.port)
+        os.close(config['ready-fd'])
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(proxy.stop())
+        loop.close()
+        if config['pidfile']:
+            os.remove(config['pidfile'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
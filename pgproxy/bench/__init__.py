@@ -0,0 +1,54 @@
+"""
+Benchmarks for measuring the proxy. They are run with the pgproxy-bench
+command: 
+
+    pgproxy-bench <command> [options]
+
+Run pgproxy-bench <command> --help for the options of each command. 
+
+"""
+from twisted.python import usage
+import sys
+import clients
+import e2e
+import micro
+import replay
+import startup
+
+
+
+class Options(usage.Options):
+    synopsis = 'pgproxy-bench'
+
+    subCommands = [
+        ('replay', None, replay.Options, 
+         'Replay captured traffic against a proxy.'),
+        ('micro', None, micro.Options,
+         'Run the microbenchmarks of parsing and filtering messages.'),
+        ('e2e', None, e2e.Options,
+         'Measure the throughput and latency added by the proxy.'),
+        ('clients', None, clients.Options,
+         'Measure the cost per message with many clients attached.'),
+        ('startup', None, startup.Options,
+         'Measure the time from starting a proxy to its first query.'),
+        ]
+
+
+    def postOptions(self):
+        if not self.subCommand:
+            raise usage.UsageError('A command is required.')
+
+
+
+def main(argv=None):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        sys.stderr.write('%s\n%s\n' % (config, e))
+        return 2
+    return config.subOptions.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+A minimal postgres client for the benchmarks. It writes raw frontend
+messages and times how long the server takes to become ready for the
+next query, without the overhead of a real driver.
+
+"""
+from twisted.internet import defer, protocol, reactor
+from pgproxy.protocol import MessageProtocol
+from pgproxy.messages import BackendMessage
+from pgproxy import messages
+import time
+
+
+
+class BenchClientProtocol(MessageProtocol):
+    """
+    Sends batches of frontend messages, one at a time. The deferred
+    returned by send fires with the number of seconds until the
+    ReadyForQuery that ends the reply.
+    """
+    messageType = BackendMessage
+
+
+    def __init__(self):
+        MessageProtocol.__init__(self)
+        self.waiting = None
+        self.sent = None
+        self.errors = 0
+        self.rows = 0
+        self.bytesReceived = 0
+
+
+    def send(self, data):
+        """
+        Writes the data, and returns a deferred that fires when the reply
+        is complete.
+        """
+        self.waiting = defer.Deferred()
+        self.sent = time.time()
+        self.transport.write(data)
+        return self.waiting
+
+
+    def dataReceived(self, data):
+        self.bytesReceived += len(data)
+        return MessageProtocol.dataReceived(self, data)
+
+
+    def messageReceived(self, msg):
+        if msg.type == 'E':
+            self.errors += 1
+        elif msg.type == 'D':
+            self.rows += 1
+        elif msg.type == 'Z' and self.waiting:
+            d, self.waiting = self.waiting, None
+            d.callback(time.time() - self.sent)
+
+
+    def query(self, sql):
+        return self.send(messages.query(sql).serialize())
+
+
+    def startup(self, user='postgres', database=None):
+        """
+        Sends a startup message. Only trust authentication is supported.
+        """
+        return self.send(messages.startup(user, database).serialize())
+
+
+    def terminate(self):
+        self.transport.write(messages.terminate().serialize())
+        self.transport.loseConnection()
+
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.waiting:
+            d, self.waiting = self.waiting, None
+            d.errback(reason)
+
+
+
+def connect(host, port):
+    """
+    Returns a deferred that fires with a connected BenchClientProtocol.
+    """
+    cc = protocol.ClientCreator(reactor, BenchClientProtocol)
+    return cc.connectTCP(host, port)
+
+
+def connectUnix(path):
+    """
+    Returns a deferred that fires with a BenchClientProtocol connected to
+    the Unix socket at path.
+    """
+    cc = protocol.ClientCreator(reactor, BenchClientProtocol)
+    return cc.connectUNIX(path)
@@ -0,0 +1,146 @@
+"""
+Measures how the proxy's cost per message changes with the number of
+clients attached to the server connection. For each count, that many
+clients are attached to one server protocol, and queries are sent from
+clients spread across all of them, each answered by the server, while
+a client connects and disconnects every few queries. Nothing is sent
+over the network.
+
+With the clients registered in constant time, the microseconds per
+message should stay flat from a handful of clients to tens of thousands.
+The memory held for each idle client is reported too, where the
+interpreter can count its allocated memory blocks.
+
+"""
+from twisted.internet import task
+from twisted.python import usage
+from pgproxy.proxy import PGProxyProtocol
+from pgproxy import filters, messages
+from measure import writeResults
+from micro import NullTransport, _proxy, measure
+import gc
+import sys
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ('counts', 'n', '1,1000,10000,50000',
+         'Comma separated numbers of attached clients to measure.'),
+        ('seconds', 's', 1.0, 'Seconds to spend on each count.', float),
+        ('json', '', None, 'Write the results as JSON to this file, or - '
+         'for stdout.'),
+        ]
+
+
+    def postOptions(self):
+        try:
+            self['counts'] = [int(n) for n in self['counts'].split(',')]
+        except ValueError:
+            raise usage.UsageError('--counts must be comma separated numbers')
+
+
+    def run(self):
+        results = runCounts(self['counts'], self['seconds'])
+        if self['json']:
+            writeResults(results, self['json'])
+        printResults(self['json'] != '-' and sys.stdout or sys.stderr, results)
+        return 0
+
+
+
+def _client(b):
+    f = PGProxyProtocol()
+    f.transport = NullTransport()
+    f.postgresProtocol = b
+    b.attachClient(f)
+    return f
+
+
+def _blocks():
+    count = getattr(sys, 'getallocatedblocks', None)
+    if count is None:
+        return None
+    gc.collect()
+    return count()
+
+
+def attached(n):
+    """
+    Returns a server protocol with n clients attached, a list of every
+    client, and the memory blocks allocated for each one (or None).
+    """
+    b, f = _proxy()
+    clients = [f]
+    before = _blocks()
+    for _ in xrange(n - 1):
+        clients.append(_client(b))
+    after = _blocks()
+    perClient = None
+    if before is not None and n > 1:
+        perClient = round((after - before) / float(n - 1), 1)
+    return b, clients, perClient
+
+
+def workload(b, clients, churn=8):
+    """
+    Returns a function that sends a query from each of 64 clients spread
+    evenly over the registry, answers each one, and connects and
+    disconnects a client after every churn queries, and the number of
+    messages it handles per call.
+    """
+    senders = [clients[i * len(clients) // 64] for i in range(64)]
+    q = messages.query('SELECT 1')
+    reply = [messages.commandComplete('SELECT 1'),
+             messages.readyForQuery('idle')]
+    def run():
+        for i, f in enumerate(senders):
+            f.messageReceived(q)
+            for m in reply:
+                b.messageReceived(m)
+            if i % churn == 0:
+                c = _client(b)
+                c.connectionLost()
+    messagesPerRun = (len(senders) * (1 + len(reply)) + 
+                      len(range(0, len(senders), churn)))
+    return run, messagesPerRun
+
+
+def runCounts(counts, seconds=1.0):
+    """
+    Returns a dict of the microseconds per message, and the memory blocks
+    per idle client, for each number of attached clients.
+    """
+    clock = task.Clock()
+    reactor, filters.reactor = filters.reactor, clock
+    results = {}
+    try:
+        for n in counts:
+            b, clients, perClient = attached(n)
+            run, size = workload(b, clients)
+            def runAndSpoof():
+                run()
+                clock.advance(0)
+            t = measure(runAndSpoof, seconds)
+            results[str(n)] = {
+                'clients': n,
+                'usec_per_message': round(t * 1e6 / size, 3),
+                'blocks_per_client': perClient,
+                }
+            del b, clients
+    finally:
+        filters.reactor = reactor
+    return {'python': sys.version.split()[0], 'counts': results}
+
+
+def printResults(out, results):
+    rows = sorted(results['counts'].values(), key=lambda r: r['clients'])
+    out.write('%10s %16s %18s\n' % (
+            'clients', 'usec/message', 'blocks/client'))
+    for r in rows:
+        blocks = r['blocks_per_client']
+        out.write('%10d %16.3f %18s\n' % (
+                r['clients'], r['usec_per_message'],
+                '-' if blocks is None else blocks))
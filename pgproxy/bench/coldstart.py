@@ -0,0 +1,71 @@
+"""
+Takes one sample for the startup benchmark (see startup.py): starts a
+proxy with pgproxy.PGProxy, in front of the backend on the port given,
+and runs a query through it. It's run as a script in a new interpreter,
+so nothing but pgproxy is imported beforehand, and nothing Twisted is
+imported here, so that it's counted as part of starting the proxy.
+
+    python coldstart.py <options as JSON> <backend port>
+
+The seconds taken to start, and until the query was answered, are
+written to stdout as JSON.
+
+"""
+from pgproxy import PGProxy, messages
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+
+
+def _untilReady(s):
+    data = ''
+    ready = messages.readyForQuery('idle').serialize()
+    while not data.endswith(ready):
+        chunk = s.recv(65536)
+        if not chunk:
+            raise IOError('The proxy closed the connection.')
+        data += chunk
+    return data
+
+
+def firstQuery(port):
+    """
+    Connects to port, and returns once a query has been answered.
+    """
+    s = socket.create_connection(('127.0.0.1', port))
+    try:
+        s.sendall(messages.startup('postgres').serialize())
+        _untilReady(s)
+        s.sendall(messages.query('select 1').serialize())
+        _untilReady(s)
+        s.sendall(messages.terminate().serialize())
+    finally:
+        s.close()
+
+
+def sample(kw, serverPort):
+    tmp = tempfile.mkdtemp(prefix='pgproxy-bench-')
+    try:
+        began = time.time()
+        p = PGProxy(0, ('127.0.0.1', serverPort),
+                    pidfile=os.path.join(tmp, 'pgproxy.pid'), **kw)
+        p.start()
+        started = time.time()
+        try:
+            firstQuery(p.port)
+            answered = time.time()
+        finally:
+            p.stop()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {'start': started - began, 'first_query': answered - began}
+
+
+if __name__ == '__main__':
+    sys.stdout.write(json.dumps(
+            sample(json.loads(sys.argv[1]), int(sys.argv[2]))) + '\n')
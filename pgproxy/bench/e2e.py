@@ -0,0 +1,289 @@
+"""
+Measures what the proxy costs per query. A proxy is started with
+pgproxy.PGProxy in front of a backend, and each workload is run by
+concurrent clients, first connected to the backend directly and then
+through the proxy. The report has the queries per second and latency of
+each, the latency the proxy added, and the proxy's memory use over time.
+
+The workloads are:
+
+    short - each client runs select 1, over and over
+    large - each client runs a query that returns many rows
+    churn - each query is made on a new connection, including the startup
+
+By default the backend is a fake one (see pgproxy.fakebackend), started
+on --server-port, so the numbers are mostly the proxy's own. Use
+--postgres to run against a real server instead. --engine=asyncio runs
+the proxy on asyncio (see pgproxy.aio), to compare it with Twisted.
+--unix connects the clients, and the proxy to the backend, by Unix
+sockets rather than by TCP loopback (see pgproxy.unix).
+
+"""
+from twisted.internet import defer, reactor, task
+from twisted.python import failure, usage
+from pgproxy.fakebackend import FakeBackend
+from pgproxy import PGProxy
+from client import connect, connectUnix
+from pgproxy.unix import socketPath
+from measure import summarize, processRSS, writeResults
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+
+workloads = ('short', 'large', 'churn')
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ('clients', 'c', 10, 'Concurrent client connections.', int),
+        ('queries', 'n', 200, 'Queries run by each client in each workload.',
+         int),
+        ('workloads', 'w', ','.join(workloads),
+         'Comma separated workloads to run.'),
+        ('large-rows', '', 10000, 'Rows returned by the large workload.', int),
+        ('listen-port', '', 5433, 'The port the proxy listens on.', int),
+        ('server-host', '', 'localhost', 'The host of the backend.'),
+        ('server-port', '', 54320, 'The port of the backend.', int),
+        ('user', 'u', 'postgres', 'The user to connect as.'),
+        ('database', 'd', None, 'The database to connect to.'),
+        ('latency', '', 0.0,
+         'Milliseconds that the fake backend delays each reply by.', float),
+        ('engine', '', 'twisted',
+         'What the proxy runs on: twisted or asyncio (see pgproxy.aio).'),
+        ('server-unix', '', None,
+         'With --postgres and --unix, the directory of the server\'s Unix '
+         'socket.'),
+        ('rss-interval', '', 0.1,
+         'Seconds between samples of the proxy\'s memory use.', float),
+        ('json', '', None, 'Write the results as JSON to this file, or - '
+         'for stdout.'),
+        ]
+
+    optFlags = [
+        ('postgres', '', 'Use the postgres server at --server-host and '
+         '--server-port, instead of starting a fake backend.'),
+        ('unix', '', 'Connect by Unix sockets, rather than by TCP.'),
+        ]
+
+
+    def postOptions(self):
+        self['workloads'] = [w.strip() for w in self['workloads'].split(',')]
+        for w in self['workloads']:
+            if w not in workloads:
+                raise usage.UsageError('Unknown workload: %s' % w)
+        if self['engine'] not in ('twisted', 'asyncio'):
+            raise usage.UsageError('--engine must be twisted or asyncio')
+        if self['unix'] and self['postgres'] and not self['server-unix']:
+            raise usage.UsageError('--unix with --postgres needs '
+                                   '--server-unix.')
+
+
+    def run(self):
+        return EndToEnd(self).run()
+
+
+
+class EndToEnd(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.errors = 0
+        self.rss = []
+        self.failure = None
+        # The directory of the socket on each port, with --unix.
+        self.socketDirs = {}
+
+
+    def run(self):
+        c = self.config
+        tmp = tempfile.mkdtemp(prefix='pgproxy-bench-')
+        backend = proxy = None
+        try:
+            if c['unix']:
+                self.socketDirs = {c['server-port']: c['server-unix'] or tmp,
+                                   c['listen-port']: tmp}
+            if not c['postgres']:
+                backend = FakeBackend(c['server-port'], c['latency'] / 1000.0,
+                                      unix=c['unix'] and tmp or None)
+                backend.start()
+            proxy = PGProxy(c['listen-port'],
+                            (c['server-host'], c['server-port']),
+                            pidfile=os.path.join(tmp, 'pgproxy.pid'),
+                            logfile=os.path.join(tmp, 'pgproxy.log'),
+                            engine=c['engine'],
+                            listenUnix=self.socketDirs.get(c['listen-port']),
+                            serverUnix=self.socketDirs.get(c['server-port']),
+                            listenTcp=not c['unix'])
+            proxy.start()
+            self.pid = proxy.proxy.pid
+
+            results = {}
+            reactor.callWhenRunning(self.runAll, results)
+            reactor.run()
+        finally:
+            if proxy:
+                proxy.stop()
+            if backend:
+                backend.stop()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        if self.failure:
+            return 1
+        self.report(results)
+        return 0
+
+
+    @defer.inlineCallbacks
+    def runAll(self, results):
+        c = self.config
+        began = time.time()
+        sampler = task.LoopingCall(self.sampleRSS, began)
+        sampler.start(c['rss-interval'])
+        try:
+            for name in c['workloads']:
+                direct = yield self.runWorkload(name, c['server-port'])
+                proxied = yield self.runWorkload(name, c['listen-port'])
+                results[name] = compare(direct, proxied)
+        except Exception:
+            self.failure = failure.Failure()
+            self.failure.printTraceback(sys.stderr)
+        sampler.stop()
+        results['engine'] = c['engine']
+        results['transport'] = c['unix'] and 'unix' or 'tcp'
+        results['errors'] = self.errors
+        results['proxy_rss'] = rssSummary(self.rss)
+        reactor.stop()
+
+
+    def sampleRSS(self, began):
+        rss = processRSS(self.pid)
+        if rss is not None:
+            self.rss.append((round(time.time() - began, 3), rss))
+
+
+    @defer.inlineCallbacks
+    def runWorkload(self, name, port):
+        """
+        Runs a workload on concurrent clients connected to port, and
+        returns the summary of the latencies of its queries.
+        """
+        run = getattr(self, name)
+        latencies = []
+        began = time.time()
+        yield defer.gatherResults(
+            [run(port, latencies) for _ in range(self.config['clients'])],
+            consumeErrors=True)
+        elapsed = time.time() - began
+        s = summarize(latencies)
+        s['queries_per_second'] = round(len(latencies) / elapsed, 1)
+        defer.returnValue(s)
+
+
+    @defer.inlineCallbacks
+    def connect(self, port):
+        if self.socketDirs:
+            c = yield connectUnix(socketPath(self.socketDirs[port], port))
+        else:
+            c = yield connect(self.config['server-host'], port)
+        yield c.startup(self.config['user'], self.config['database'])
+        defer.returnValue(c)
+
+
+    @defer.inlineCallbacks
+    def queries(self, port, latencies, sql):
+        c = yield self.connect(port)
+        try:
+            for _ in range(self.config['queries']):
+                latency = yield c.query(sql)
+                latencies.append(latency)
+        finally:
+            self.errors += c.errors
+            c.terminate()
+
+
+    def short(self, port, latencies):
+        return self.queries(port, latencies, 'select 1')
+
+
+    def large(self, port, latencies):
+        return self.queries(port, latencies,
+                            'select * from generate_series(1, %d)' %
+                            self.config['large-rows'])
+
+
+    @defer.inlineCallbacks
+    def churn(self, port, latencies):
+        for _ in range(self.config['queries']):
+            began = time.time()
+            c = yield self.connect(port)
+            try:
+                yield c.query('select 1')
+            finally:
+                self.errors += c.errors
+                c.terminate()
+            latencies.append(time.time() - began)
+
+
+    def report(self, results):
+        if self.config['json']:
+            writeResults(results, self.config['json'])
+            if self.config['json'] == '-':
+                return
+        printResults(sys.stdout, results)
+
+
+
+def compare(direct, proxied):
+    """
+    Returns the results of a workload, given the summaries of its direct
+    and proxied runs.
+    """
+    added = {}
+    for k in ('mean', 'p50', 'p90', 'p99'):
+        if k in direct and k in proxied:
+            added[k] = round(proxied[k] - direct[k], 3)
+    return {'direct': direct, 'proxy': proxied, 'added_latency_ms': added}
+
+
+def rssSummary(samples):
+    """
+    Summarizes a list of (seconds, bytes) samples of the proxy's memory.
+    """
+    if not samples:
+        return None
+    values = [rss for _, rss in samples]
+    return {'samples': samples, 'initial': values[0], 'max': max(values),
+            'final': values[-1]}
+
+
+def printResults(out, results):
+    out.write('%-8s %-8s %10s %10s %10s %12s %12s\n' % (
+            'workload', 'target', 'queries/s', 'p50 ms', 'p99 ms',
+            'added p50', 'added p99'))
+    for name in workloads:
+        r = results.get(name)
+        if not r:
+            continue
+        for target in ('direct', 'proxy'):
+            s = r[target]
+            added = ('', '')
+            if target == 'proxy':
+                added = ['%+.3f' % r['added_latency_ms'].get(k, 0)
+                         for k in ('p50', 'p99')]
+            out.write('%-8s %-8s %10.1f %10.3f %10.3f %12s %12s\n' % (
+                    name, target, s['queries_per_second'], s.get('p50', 0),
+                    s.get('p99', 0), added[0], added[1]))
+    out.write('%d errors, on the %s engine, over %s\n' % (
+            results['errors'], results.get('engine', 'twisted'),
+            results.get('transport', 'tcp')))
+    rss = results['proxy_rss']
+    if rss:
+        out.write('proxy RSS: %.1f MB initial, %.1f MB max, %.1f MB final\n' % (
+                rss['initial'] / 1e6, rss['max'] / 1e6, rss['final'] / 1e6))
@@ -0,0 +1,103 @@
+"""
+Helpers for summarizing benchmark measurements, and for measuring the
+resources used by another process.
+
+"""
+import math
+import os
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0-100) of the sorted list of values, using
+    the nearest-rank method.
+    """
+    if not values:
+        return None
+    i = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(i, len(values) - 1))]
+
+
+def summarize(latencies):
+    """
+    Returns a dict of the count, mean and percentiles of a list of
+    latencies in seconds. The results are in milliseconds.
+    """
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    ms = lambda x: round(x * 1000.0, 3)
+    return {
+        'count': len(values),
+        'mean': ms(sum(values) / len(values)),
+        'p50': ms(percentile(values, 50)),
+        'p90': ms(percentile(values, 90)),
+        'p99': ms(percentile(values, 99)),
+        'max': ms(values[-1]),
+        }
+
+
+def processCPU(pid):
+    """
+    Returns the user plus system CPU seconds used by a process so far, or
+    None if that can't be determined (it's read from /proc).
+    """
+    try:
+        stat = open('/proc/%d/stat' % pid).read()
+    except (IOError, OSError):
+        return None
+    # the command name can contain spaces, so split after it.
+    fields = stat[stat.rindex(')') + 2:].split()
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def processRSS(pid):
+    """
+    Returns the resident set size of a process in bytes, or None if it
+    can't be determined.
+    """
+    try:
+        for l in open('/proc/%d/status' % pid):
+            if l.startswith('VmRSS:'):
+                return int(l.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def writeResults(results, path):
+    """
+    Writes the results as JSON to path, or to stdout if path is '-'.
+    """
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if path == '-':
+        sys.stdout.write(data + '\n')
+        return
+    f = open(path, 'w')
+    try:
+        f.write(data + '\n')
+    finally:
+        f.close()
+
+
+def printLatencies(out, latencies):
+    """
+    Prints a table of the summaries of latencies, a dict of label to the
+    output of summarize.
+    """
+    out.write('%-20s %8s %9s %9s %9s %9s\n' % (
+            'statement', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+    for label, s in sorted(latencies.items()):
+        if not s['count']:
+            continue
+        out.write('%-20s %8d %9.3f %9.3f %9.3f %9.3f\n' % (
+                label[:20], s['count'], s['mean'], s['p50'], s['p99'], 
+                s['max']))
@@ -0,0 +1,395 @@
+"""
+Microbenchmarks of the proxy's hot path: buffering, parsing, filtering and
+serializing messages. Nothing is sent over the network.
+
+Each benchmark reports the messages and bytes it processes per second,
+taking the best of several timed batches. It also reports the memory
+still allocated per message after a batch, so that leaks and caches show
+up: the blocks traced by tracemalloc where it's available, and otherwise
+the objects tracked by the garbage collector, which leaves out strings
+and numbers.
+
+The results can be saved as JSON and used as the baseline of a later run,
+which then prints the change in throughput of each benchmark and exits
+with status 1 if any of them slowed down by more than the threshold.
+
+"""
+from twisted.internet import task
+from twisted.python import usage
+from pgproxy.fifobuffer import FIFOBuffer
+from pgproxy.proxy import PostgresClientProtocol, PGProxyProtocol
+from pgproxy import filters, messages
+from measure import json, writeResults
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ('seconds', 's', 1.0, 'Seconds to spend on each benchmark.', float),
+        ('only', 'o', None,
+         'Only run the benchmarks whose names contain this.'),
+        ('json', '', None, 'Write the results as JSON to this file, or - '
+         'for stdout.'),
+        ('baseline', 'b', None,
+         'Compare the results to those saved in this JSON file.'),
+        ('threshold', '', 5.0,
+         'The percent slowdown from the baseline that counts as a '
+         'regression.', float),
+        ]
+
+    optFlags = [
+        ('list', 'l', 'List the benchmarks and exit.'),
+        ]
+
+
+    def run(self):
+        if self['list']:
+            for name, _ in benchmarks:
+                print name
+            return 0
+
+        results = runBenchmarks(self['seconds'], self['only'])
+        if self['json']:
+            writeResults(results, self['json'])
+        out = sys.stdout if self['json'] != '-' else sys.stderr
+        if not self['baseline']:
+            printResults(out, results)
+            return 0
+
+        f = open(self['baseline'])
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = printComparison(
+            out, compare(baseline, results), self['threshold'])
+        return regressions and 1 or 0
+
+
+
+benchmarks = []
+
+def benchmark(f):
+    """
+    Registers a benchmark. The function is called once to set up, and
+    returns a (run, messages, bytes) tuple: run is the function that is
+    timed, and messages and bytes are how much it processes per call.
+    """
+    benchmarks.append((f.__name__, f))
+    return f
+
+
+
+class NullTransport(object):
+
+    def write(self, data):
+        pass
+
+
+    def pauseProducing(self):
+        pass
+
+
+    def resumeProducing(self):
+        pass
+
+
+    def loseConnection(self):
+        pass
+
+
+
+def _proxy():
+    """
+    Returns a connected (backend, frontend) pair of protocols with
+    transports that discard what is written to them.
+    """
+    b = PostgresClientProtocol()
+    b.transport = NullTransport()
+    f = PGProxyProtocol()
+    f.transport = NullTransport()
+    f.postgresProtocol = b
+    b.attachClient(f)
+    for m in (messages.authenticationOk(),
+              messages.parameterStatus('client_encoding', 'UTF8'),
+              messages.readyForQuery('idle')):
+        b.messageReceived(m)
+    return b, f
+
+
+def _serialize(ms):
+    return ''.join([m.serialize() for m in ms])
+
+
+def _result(rows, width=40):
+    return [messages.rowDescription(['id', 'name', 'email'])] + [
+        messages.dataRow([i, 'n' * 12, 'e' * width]) for i in range(rows)] + [
+        messages.commandComplete('SELECT %d' % rows),
+        messages.readyForQuery('transaction')]
+
+
+# A mix of the statements a test suite sends through the proxy. The
+# transaction statements are balanced, so the savepoint stack doesn't grow.
+sql_mix = [
+    "SELECT u.id, u.name, u.email FROM users u WHERE u.id = 1234",
+    "BEGIN",
+    "INSERT INTO orders (user_id, total, created) VALUES (1234, 19.99, now())",
+    "SELECT o.id, o.total FROM orders o JOIN users u ON u.id = o.user_id "
+    "WHERE u.email = 'someone@example.com' ORDER BY o.created DESC LIMIT 20",
+    "UPDATE users SET last_login = now() WHERE id = 1234",
+    "COMMIT",
+    "SELECT count(*) FROM products WHERE category_id IN (1, 2, 3, 4, 5)",
+    "BEGIN; SET TRANSACTION ISOLATION LEVEL READ COMMITTED",
+    "DELETE FROM cart_items WHERE cart_id = 77",
+    "ROLLBACK",
+    "SELECT 1",
+    ]
+
+
+
+@benchmark
+def fifobuffer_append():
+    chunks = ['x' * 1460] * 8
+    def run():
+        b = FIFOBuffer()
+        for c in chunks:
+            b.append(c)
+        b.remainder()
+    return run, len(chunks), sum(map(len, chunks))
+
+
+@benchmark
+def fifobuffer_read():
+    data = _serialize([messages.dataRow([i, 'abc']) for i in range(50)])
+    def run():
+        b = FIFOBuffer(data)
+        n = len(b)
+        while b.pos < n:
+            b.get_char()
+            b.pos += b.get_int32()
+    return run, 50, len(data)
+
+
+@benchmark
+def consume_whole():
+    ms = _result(20)
+    data = _serialize(ms)
+    def run():
+        extra = data
+        while extra:
+            done, extra = messages.BackendMessage().consume(extra)
+    return run, len(ms), len(data)
+
+
+@benchmark
+def consume_split():
+    data = messages.dataRow([1, 'n' * 12, 'e' * 40]).serialize()
+    splits = [(data[:i], data[i:]) for i in range(1, len(data))]
+    def run():
+        for a, b in splits:
+            m = messages.BackendMessage()
+            m.consume(a)
+            m.consume(b)
+    return run, len(splits), len(data) * len(splits)
+
+
+@benchmark
+def consume_bytewise():
+    data = messages.query(sql_mix[3]).serialize()
+    def run():
+        m = messages.FrontendMessage()
+        for c in data:
+            m.consume(c)
+    return run, 1, len(data)
+
+
+class ServerTransport(NullTransport):
+    """
+    Notes that something was written, so that it can be answered.
+    """
+    written = False
+
+    def write(self, data):
+        self.written = True
+
+
+
+@benchmark
+def frontend_filter_q():
+    b, f = _proxy()
+    b.transport = server = ServerTransport()
+    f.signalTest(True, 'micro')
+    qs = [messages.query(sql) for sql in sql_mix]
+    reply = (messages.commandComplete('SELECT 1'),
+             messages.readyForQuery('transaction'))
+    def run():
+        for q in qs:
+            f.messageReceived(q)
+            # each query that's sent on is answered, as the server would,
+            # so the proxy is ready for the next one.
+            if server.written:
+                server.written = False
+                for m in reply:
+                    b.messageReceived(m)
+    return run, len(qs), len(_serialize(qs))
+
+
+@benchmark
+def backend_filter_results():
+    b, f = _proxy()
+    ms = _result(100)
+    data = _serialize(ms)
+    def run():
+        b.dataReceived(data)
+    return run, len(ms), len(data)
+
+
+@benchmark
+def message_constructors():
+    def run():
+        messages.query(sql_mix[0])
+        messages.commandComplete('SELECT 1')
+        messages.readyForQuery('transaction')
+        messages.dataRow([1, 'abc', None])
+        messages.errorResponse(('S', 'ERROR'), ('C', 'XX000'), ('M', 'oops'))
+    return run, 5, 0
+
+
+
+def _time(run, loops):
+    t = time.time()
+    for _ in xrange(loops):
+        run()
+    return time.time() - t
+
+
+def measure(run, seconds):
+    """
+    Returns the best number of seconds per call of run, out of batches
+    that each take about a tenth of the time allowed.
+    """
+    loops = 1
+    while 1:
+        t = _time(run, loops)
+        if t >= min(0.01, seconds / 10):
+            break
+        loops *= 2
+    loops = max(1, int(loops * (seconds / 10) / max(t, 1e-9)))
+
+    best, end = None, time.time() + seconds
+    while best is None or time.time() < end:
+        t = _time(run, loops) / loops
+        best = t if best is None else min(best, t)
+    return best
+
+
+def allocations(run, n, loops=200):
+    """
+    Returns the memory blocks, or without tracemalloc the objects, still
+    allocated per message after calling run.
+    """
+    run()
+    gc.collect()
+    if tracemalloc is not None:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        count = lambda: sum([s.count for s in
+                             tracemalloc.take_snapshot().statistics('filename')])
+    else:
+        count = lambda: len(gc.get_objects())
+    try:
+        before = count()
+        for _ in xrange(loops):
+            run()
+        gc.collect()
+        after = count()
+    finally:
+        if tracemalloc is not None and not tracing:
+            tracemalloc.stop()
+    return round((after - before) / float(loops * n), 3)
+
+
+def runBenchmarks(seconds=1.0, only=None):
+    """
+    Runs the benchmarks, and returns a dict of the results.
+    """
+    # Spoofed replies are scheduled on the reactor, so give the filters a
+    # clock that can be run by hand.
+    clock = task.Clock()
+    reactor, filters.reactor = filters.reactor, clock
+    results = {}
+    try:
+        for name, f in benchmarks:
+            if only and only not in name:
+                continue
+            run, n, size = f()
+            def runAndSpoof():
+                run()
+                clock.advance(0)
+            t = measure(runAndSpoof, seconds)
+            results[name] = {
+                'messages_per_second': round(n / t, 1),
+                'bytes_per_second': round(size / t, 1) if size else None,
+                'allocations_per_message': allocations(runAndSpoof, n),
+                }
+    finally:
+        filters.reactor = reactor
+
+    return {'python': sys.version.split()[0],
+            'allocations': tracemalloc and 'blocks' or 'objects',
+            'benchmarks': results}
+
+
+def compare(baseline, results):
+    """
+    Returns a list of (name, baseline messages/s, messages/s, percent
+    change) for the benchmarks in both sets of results.
+    """
+    old, new = baseline['benchmarks'], results['benchmarks']
+    rows = []
+    for name in sorted(set(old) & set(new)):
+        a = old[name]['messages_per_second']
+        b = new[name]['messages_per_second']
+        rows.append((name, a, b, round((b - a) * 100.0 / a, 1)))
+    return rows
+
+
+def printResults(out, results):
+    out.write('%-24s %14s %14s %12s\n' % (
+            'benchmark', 'messages/s', 'MB/s',
+            '%s/msg' % results.get('allocations', 'allocs')))
+    for name, r in sorted(results['benchmarks'].items()):
+        mb = r['bytes_per_second']
+        allocs = r.get('allocations_per_message')
+        out.write('%-24s %14.1f %14s %12s\n' % (
+                name, r['messages_per_second'],
+                '-' if mb is None else '%.2f' % (mb / 1e6),
+                '-' if allocs is None else allocs))
+
+
+def printComparison(out, rows, threshold):
+    """
+    Prints the comparison, and returns the number of regressions.
+    """
+    regressions = 0
+    out.write('%-24s %14s %14s %9s\n' % (
+            'benchmark', 'baseline/s', 'messages/s', 'change'))
+    for name, a, b, change in rows:
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        out.write('%-24s %14.1f %14.1f %+8.1f%%%s\n' % (
+                name, a, b, change, flag))
+    return regressions
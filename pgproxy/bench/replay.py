@@ -0,0 +1,278 @@
+"""
+Replays the frontend traffic in a capture (see pgproxy.capture) against a
+proxy, and reports the throughput, the latency of each statement and the
+CPU used by the proxy.
+
+Each captured client connection is replayed on its own connection, in its
+original order. A statement is the group of messages up to one that the
+server answers with ReadyForQuery (a Query, a Sync or the Startup), along
+with the password or COPY data that goes with it. The next statement on a
+connection is not sent until the previous one has been answered.
+
+Each connection's messages are read from the capture as they're replayed,
+found through the capture's index, so the capture is never loaded into
+memory as a whole.
+
+With a speed-up factor, the statements are also spaced out the way they
+were captured, that many times faster, on one clock for the whole replay:
+a connection that had to wait for a free slot catches up rather than
+shifting the rest of its traffic later. Without one, each connection sends
+its statements as fast as the proxy answers them. Either way, the report
+includes the captured time span that was replayed and how much faster
+than captured the replay as a whole ran.
+
+"""
+from twisted.internet import defer, reactor, task
+from twisted.python import log, usage
+from pgproxy.capture import CaptureReader
+from pgproxy.messages import FrontendMessage
+from pgproxy import PGProxy
+from client import connect
+from measure import (summarize, processCPU, writeResults, printLatencies)
+import sys
+import time
+
+
+
+# Messages that the server answers with ReadyForQuery.
+_syncs = ('Q', 'S', 'Startup')
+
+# Messages that are sent after a sync message, without waiting for a reply.
+_follows = ('p', 'd', 'c', 'f')
+
+# Messages that can't be replayed.
+_skipped = ('SSLRequest', 'Cancel')
+
+
+
+class Options(usage.Options):
+    synopsis = '[options] <capture>'
+
+    optParameters = [
+        ('concurrency', 'c', 10, 'Connections to replay at once.', int),
+        ('speedup', 's', 0.0,
+         'Replay this many times faster than captured. 0 does not wait '
+         'between statements.', float),
+        ('test', 't', None, 'Only replay the traffic of this test.'),
+        ('listen-port', '', 5433, 'The port the proxy listens on.', int),
+        ('server-host', '', 'localhost', 'The host of the postgres server.'),
+        ('server-port', '', 5432, 'The port of the postgres server.', int),
+        ('json', '', None, 'Write the results as JSON to this file, or - '
+         'for stdout.'),
+        ]
+
+    optFlags = [
+        ('no-proxy', '',
+         'Replay against a proxy that is already running on --listen-port.'),
+        ]
+
+
+    def parseArgs(self, capture):
+        self['capture'] = capture
+
+
+    def run(self):
+        return Replay(self).run()
+
+
+
+def statements(messages):
+    """
+    Groups a client's (timestamp, FrontendMessage) pairs into statements.
+    Yields (timestamp, label, data) for each statement, where the label
+    is used to group the latencies in the report.
+    """
+    group, synced = [], False
+    for ts, m in messages:
+        if m.type in _skipped:
+            continue
+        if m.type == 'X':
+            break
+        if synced and m.type not in _follows:
+            yield _statement(group)
+            group, synced = [], False
+        group.append((ts, m))
+        if m.type in _syncs:
+            synced = True
+    if synced:
+        yield _statement(group)
+
+
+def _statement(group):
+    first = group[0][1]
+    if first.type == 'Startup':
+        label = 'startup'
+    elif first.type == 'Q':
+        label = (first.data[:-1].split(None, 1) or [''])[0].upper()
+    else:
+        label = 'extended'
+    return group[0][0], label, ''.join([m.serialize() for _, m in group])
+
+
+def readStreams(reader, test=None):
+    """
+    Returns the client connections in a CaptureReader, in the order they
+    started, as tuples of (start time, statements). The statements are an
+    iterator that reads the connection's messages from the capture as
+    it's consumed. Only the index is read here.
+    """
+    runs, started = {}, []
+    for _, client, offset, start, end in reader.runs(test=test):
+        if client not in runs:
+            runs[client] = []
+            started.append((offset, client))
+        runs[client].append((start, end))
+    started.sort()
+    return [(reader.start + offset,
+             statements(_frontend(reader, runs[client])))
+            for offset, client in started]
+
+
+def _frontend(reader, runs):
+    for start, end in runs:
+        for direction, _, ts, _, data in reader.runRecords(start, end):
+            if direction == 'F':
+                m = FrontendMessage()
+                m.consume(data)
+                yield ts, m
+
+
+
+class Replay(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.latencies = {}
+        self.errors = 0
+        self.failedConnections = 0
+        # The capture time of the first connection, and the time the
+        # replay started, so that every connection is timed on one clock.
+        self.first = self.began = None
+        # The capture time of the last statement replayed.
+        self.last = None
+
+
+    def run(self):
+        reader = CaptureReader(self.config['capture'])
+        try:
+            return self.replayCapture(reader)
+        finally:
+            reader.close()
+
+
+    def replayCapture(self, reader):
+        streams = readStreams(reader, self.config['test'])
+        if not streams:
+            sys.stderr.write('No client traffic to replay.\n')
+            return 1
+
+        proxy = None
+        if not self.config['no-proxy']:
+            proxy = PGProxy(
+                self.config['listen-port'],
+                (self.config['server-host'], self.config['server-port']))
+            proxy.start()
+        try:
+            pid = proxy and proxy.proxy.pid
+            cpu = pid and processCPU(pid)
+            reactor.callWhenRunning(self.replayAll, streams)
+            reactor.run()
+            elapsed = time.time() - self.began
+            if cpu is not None:
+                cpu = processCPU(pid) - cpu
+        finally:
+            if proxy:
+                proxy.stop()
+
+        self.report(self.results(elapsed, cpu))
+        return 0
+
+
+    def replayAll(self, streams):
+        self.began, self.first = time.time(), streams[0][0]
+        sem = defer.DeferredSemaphore(self.config['concurrency'])
+        def failed(f):
+            self.failedConnections += 1
+            log.err(f, 'Replayed connection failed')
+        ds = [sem.run(self.replayStream, s).addErrback(failed)
+              for _, s in streams]
+        defer.DeferredList(ds).addBoth(lambda _: reactor.stop())
+
+
+    def wait(self, ts):
+        """
+        Returns a Deferred that fires when a statement captured at ts is
+        due, or None if it's due already.
+        """
+        speedup = self.config['speedup']
+        if speedup:
+            delay = self.began + (ts - self.first) / speedup - time.time()
+            if delay > 0:
+                return task.deferLater(reactor, delay, lambda: None)
+
+
+    @defer.inlineCallbacks
+    def replayStream(self, statements):
+        statement = next(statements, None)
+        if statement is None:
+            return
+        # Connect once the first statement is due, so that a connection
+        # that's early doesn't hold on to a slot.
+        yield self.wait(statement[0])
+        client = yield connect('localhost', self.config['listen-port'])
+        try:
+            while statement is not None:
+                ts, label, data = statement
+                yield self.wait(ts)
+                latency = yield client.send(data)
+                self.latencies.setdefault(label, []).append(latency)
+                if self.last is None or ts > self.last:
+                    self.last = ts
+                statement = next(statements, None)
+        finally:
+            self.errors += client.errors
+            client.terminate()
+
+
+    def results(self, elapsed, cpu):
+        everything = []
+        for ls in self.latencies.values():
+            everything.extend(ls)
+        latencies = dict([(label, summarize(ls))
+                          for label, ls in self.latencies.items()])
+        latencies['all'] = summarize(everything)
+        captured = 0.0
+        if self.last is not None:
+            captured = max(self.last - self.first, 0.0)
+        return {
+            'statements': len(everything),
+            'seconds': round(elapsed, 3),
+            'statements_per_second': round(len(everything) / elapsed, 1),
+            'captured_seconds': round(captured, 3),
+            'speedup': round(captured / elapsed, 2),
+            'errors': self.errors,
+            'failed_connections': self.failedConnections,
+            'proxy_cpu_seconds': cpu,
+            'proxy_cpu_utilization':
+                None if cpu is None else round(cpu / elapsed, 3),
+            'latency_ms': latencies,
+            }
+
+
+    def report(self, results):
+        out = sys.stdout
+        if self.config['json']:
+            writeResults(results, self.config['json'])
+            if self.config['json'] == '-':
+                return
+        out.write('%(statements)d statements in %(seconds).3fs '
+                  '(%(statements_per_second).1f/s), %(errors)d errors, '
+                  '%(failed_connections)d failed connections\n' % results)
+        out.write('replayed %(captured_seconds).3fs of captured traffic '
+                  '(%(speedup).2fx)\n' % results)
+        if results['proxy_cpu_seconds'] is not None:
+            out.write('proxy CPU: %(proxy_cpu_seconds).2fs '
+                      '(%(proxy_cpu_utilization).1f%% of one core)\n' % dict(
+                    results, proxy_cpu_utilization=
+                    results['proxy_cpu_utilization'] * 100))
+        printLatencies(out, results['latency_ms'])
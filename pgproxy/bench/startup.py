@@ -0,0 +1,117 @@
+"""
+Measures how long it takes to start a proxy and use it: the time from
+pgproxy.PGProxy's start() to the first query answered through the proxy,
+and to start() returning. Each sample is taken in a new interpreter that
+has only imported pgproxy (see coldstart.py), as a test run that starts
+a proxy would, so the imports the proxy needs are counted.
+
+The modes are:
+
+    subprocess          - the proxy runs in a process of its own
+    inprocess           - the proxy runs in a thread (inProcess=True)
+    subprocess-asyncio  - the same, on the asyncio engine (see pgproxy.aio)
+    inprocess-asyncio
+
+The backend is a fake one (see pgproxy.fakebackend), started on
+--server-port.
+
+"""
+from __future__ import with_statement
+from twisted.python import usage
+from pgproxy.fakebackend import FakeBackend
+from measure import summarize, writeResults
+import json
+import os
+import subprocess
+import sys
+
+
+
+modes = [
+    ('subprocess', {}),
+    ('inprocess', {'inProcess': True}),
+    ('subprocess-asyncio', {'engine': 'asyncio'}),
+    ('inprocess-asyncio', {'engine': 'asyncio', 'inProcess': True}),
+    ]
+
+_this_dir = os.path.realpath(os.path.dirname(__file__))
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ('runs', 'n', 10, 'Samples to take of each mode.', int),
+        ('modes', 'm', 'subprocess,inprocess',
+         'Comma separated modes to measure: %s.' %
+         ', '.join([m for m, _ in modes])),
+        ('server-port', '', 54320, 'The port of the fake backend.', int),
+        ('json', '', None, 'Write the results as JSON to this file, or - '
+         'for stdout.'),
+        ]
+
+
+    def postOptions(self):
+        self['modes'] = [m.strip() for m in self['modes'].split(',')]
+        for m in self['modes']:
+            if m not in dict(modes):
+                raise usage.UsageError('Unknown mode: %s' % m)
+
+
+    def run(self):
+        results = runModes(self['modes'], self['runs'], self['server-port'])
+        if self['json']:
+            writeResults(results, self['json'])
+        printResults(self['json'] != '-' and sys.stdout or sys.stderr, results)
+        return 0
+
+
+
+def sample(mode, serverPort):
+    """
+    Takes a sample of a mode in a new interpreter, and returns the
+    seconds it took to start and to answer the first query.
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(_this_dir))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + filter(None, [env.get('PYTHONPATH')]))
+    p = subprocess.Popen(
+        [sys.executable, os.path.join(_this_dir, 'coldstart.py'),
+         json.dumps(dict(modes)[mode]), str(serverPort)],
+        stdout=subprocess.PIPE, env=env)
+    out = p.communicate()[0]
+    if p.returncode:
+        raise RuntimeError('The %s sample failed.' % mode)
+    return json.loads(out.splitlines()[-1])
+
+
+def runModes(names, runs, serverPort):
+    """
+    Returns the summaries of the start and first query times of each
+    mode, in milliseconds.
+    """
+    results = {}
+    with FakeBackend(serverPort):
+        for name in names:
+            samples = [sample(name, serverPort) for _ in range(runs)]
+            results[name] = {
+                'start': summarize([s['start'] for s in samples]),
+                'first_query': summarize([s['first_query'] for s in samples]),
+                }
+    return {'python': sys.version.split()[0], 'modes': results}
+
+
+def printResults(out, results):
+    out.write('%-20s %12s %12s %16s %16s\n' % (
+            'mode', 'start p50', 'start p90', 'first query p50',
+            'first query p90'))
+    for name, _ in modes:
+        r = results['modes'].get(name)
+        if not r:
+            continue
+        out.write('%-20s %12.1f %12.1f %16.1f %16.1f\n' % (
+                name, r['start']['p50'], r['start']['p90'],
+                r['first_query']['p50'], r['first_query']['p90']))
+    out.write('(milliseconds)\n')
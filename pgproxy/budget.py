@@ -0,0 +1,90 @@
+"""
+Module for test budgets. A test can be given limits on the database work
+it does when it begins:
+
+    BEGIN TEST 'name' WITH (max_queries = 50, max_backend_ms = 200,
+                            max_rows = 1000);
+
+The same clause can follow BEGIN COMMITTED TEST. queries counts the
+statements the test sends (simple queries and Executes, but not the
+BEGINs and COMMITs the proxy answers with savepoints), backend_ms the time
+the server spent answering the test, and rows the rows it returned.
+
+When the test is rolled back, a test over budget gets an ErrorResponse in
+place of the ROLLBACK's CommandComplete, or with --budget-action=report
+only has the violation logged. Either way, it's added to the --report.
+
+"""
+import re
+
+
+
+class BudgetError(ValueError):
+    """
+    Raised for a budget clause that can't be parsed.
+    """
+
+
+
+_limit_re = re.compile(r'^\s*(\w+)\s*=\s*(\d+(?:\.\d+)?)\s*$')
+
+
+class Budget(object):
+    """
+    The limits of one test, and the work it has done so far.
+    """
+
+    # The limits that can be set, and what they limit.
+    limits = {
+        'max_queries': 'queries',
+        'max_backend_ms': 'backend_ms',
+        'max_rows': 'rows',
+        }
+
+
+    def __init__(self, test, **limits):
+        for k in limits:
+            if k not in self.limits:
+                raise BudgetError('unknown budget limit: %s' % k)
+        self.test = test
+        self.maxima = limits
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+    def used(self):
+        return {
+            'queries': self.queries,
+            'backend_ms': round(self.seconds * 1000, 3),
+            'rows': self.rows,
+            }
+
+
+    def violations(self):
+        """
+        Returns a description of each limit that was exceeded.
+        """
+        used = self.used()
+        found = []
+        for k, limit in sorted(self.maxima.items()):
+            n = used[self.limits[k]]
+            if n > limit:
+                found.append('%s %s > %s' % (self.limits[k], n, limit))
+        return found
+
+
+
+def parse(test, clause):
+    """
+    Returns the Budget given by the inside of a WITH (...) clause, as in
+    'max_queries = 50, max_rows = 1000'.
+    """
+    limits = {}
+    for item in clause.split(','):
+        m = _limit_re.match(item)
+        if not m:
+            raise BudgetError('bad budget limit: %s' % item.strip())
+        k, v = m.groups()
+        limits[k] = float(v) if '.' in v else int(v)
+    return Budget(test, **limits)
@@ -0,0 +1,249 @@
+"""
+Module for capturing the messages that pass through the proxy to a binary
+log, and reading them back.
+
+Each message is recorded with the direction it traveled in, the id of the
+client connection it belongs to, a timestamp, its type code and its raw
+bytes. The directions are:
+
+    F - received from a frontend (client)
+    B - received from the backend (postgres server)
+    f - written to a frontend by the proxy
+    b - written to the backend by the proxy
+
+The lower case directions include everything the proxy sent, after the
+filters translated, dropped or spoofed messages.
+
+The capture is written by a background thread, so that the reactor never
+waits on the disk. Messages are handed to it through a bounded queue; if
+the queue fills up, messages are dropped and counted rather than slowing
+the proxy down.
+
+Alongside the capture file (path), two sidecar files are written:
+
+    path.idx   - fixed-size entries marking where each run of messages
+                 for one test and client starts. The file can be mmapped
+                 and scanned to find one test's traffic without reading
+                 the capture.
+    path.tests - the test names, one per line. The first line is test id 1.
+                 Id 0 means traffic outside of a test.
+
+"""
+from __future__ import with_statement
+from data import struct_compile
+import mmap
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+
+capture_magic = 'PGPXCAP1'
+index_magic = 'PGPXIDX1'
+
+# direction, client id, timestamp, type code, length
+_record = struct_compile('!cIdcI')
+
+# test id, client id, time offset, capture file offset
+_entry = struct_compile('!IIdQ')
+
+# start time of the capture
+_header = struct_compile('!d')
+
+
+
+class CaptureWriter(object):
+    """
+    Writes a capture file and its index from a background thread.
+    """
+
+    def __init__(self, path, maxQueue=10000):
+        self.path = path
+        self.queue = queue.Queue(maxQueue)
+        self.dropped = 0
+        self.written = 0
+        self.start = time.time()
+
+        self.capture = open(path, 'wb')
+        self.capture.write(capture_magic + _header.pack(self.start))
+        self.index = open(path + '.idx', 'wb')
+        self.index.write(index_magic)
+        self.names = open(path + '.tests', 'wb')
+
+        self.testIds = {}
+        self.run = None
+
+        self.thread = threading.Thread(target=self.writeRecords,
+                                       name='pgproxy-capture')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def record(self, direction, clientId, test, messages):
+        """
+        Queues messages to be written. This is called on the reactor
+        thread, so it never blocks.
+        """
+        now = time.time()
+        for m in messages:
+            try:
+                self.queue.put_nowait(
+                    (direction, clientId, now, m.type, m.serialize(), test))
+            except queue.Full:
+                self.dropped += 1
+
+
+    def writeRecords(self):
+        while 1:
+            r = self.queue.get()
+            if r is None:
+                break
+            self.writeRecord(*r)
+        for f in (self.capture, self.index, self.names):
+            f.close()
+
+
+    def writeRecord(self, direction, clientId, timestamp, type, data, test):
+        testId = self.testId(test)
+        if self.run != (testId, clientId):
+            self.run = (testId, clientId)
+            self.index.write(_entry.pack(
+                    testId, clientId, timestamp - self.start,
+                    self.capture.tell()))
+
+        if len(type) != 1:
+            # Startup and the other special messages are not identified
+            # by a type code.
+            type = '\x00'
+        self.capture.write(_record.pack(
+                direction, clientId, timestamp, type, len(data)))
+        self.capture.write(data)
+        self.written += 1
+
+
+    def testId(self, test):
+        if not test:
+            return 0
+        i = self.testIds.get(test)
+        if i is None:
+            i = self.testIds[test] = len(self.testIds) + 1
+            self.names.write(test.replace('\n', '\\n') + '\n')
+        return i
+
+
+    def close(self):
+        """
+        Writes out the messages that are still queued, and closes the files.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+
+class CaptureReader(object):
+    """
+    Reads a capture written by CaptureWriter. The capture and the index
+    are mapped into memory, so only the parts of the capture that are
+    asked for are read.
+
+    Records are returned as tuples of:
+
+        (direction, client id, timestamp, type code, raw message)
+
+    The type code is '\\x00' for Startup messages and the other special
+    messages without a type code.
+    """
+
+    def __init__(self, path):
+        self.files = []
+        self.capture = self._map(path, capture_magic)
+        self.index = self._map(path + '.idx', index_magic)
+        self.start = _header.unpack_from(self.capture, len(capture_magic))[0]
+        self.dataStart = len(capture_magic) + _header.size
+
+        with open(path + '.tests', 'rb') as f:
+            self.testNames = [l[:-1].replace('\\n', '\n') for l in f]
+
+
+    def _map(self, path, magic):
+        f = open(path, 'rb')
+        self.files.append(f)
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a pgproxy capture' % path)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        for m in (self.capture, self.index):
+            m.close()
+        for f in self.files:
+            f.close()
+
+
+    def tests(self):
+        """
+        Returns the names of the tests in the capture.
+        """
+        return list(self.testNames)
+
+
+    def testName(self, testId):
+        if not testId:
+            return None
+        return self.testNames[testId - 1]
+
+
+    def runs(self, test=None, client=None):
+        """
+        Yields the runs of consecutive messages in the capture as tuples of
+        (test name, client id, time offset, start offset, end offset),
+        optionally only those for one test and/or client.
+        """
+        testId = None
+        if test is not None:
+            if test not in self.testNames:
+                return
+            testId = self.testNames.index(test) + 1
+
+        n = (len(self.index) - len(index_magic)) // _entry.size
+        prev = None
+        for i in range(n + 1):
+            if i < n:
+                e = _entry.unpack_from(
+                    self.index, len(index_magic) + i * _entry.size)
+                end = e[3]
+            else:
+                e, end = None, len(self.capture)
+            if prev is not None:
+                t, c, offset, start = prev
+                if testId in (None, t) and client in (None, c):
+                    yield self.testName(t), c, offset, start, end
+            prev = e
+
+
+    def records(self, test=None, client=None):
+        """
+        Yields the records in the capture, optionally only those for one
+        test and/or client.
+        """
+        for _, _, _, start, end in self.runs(test, client):
+            for r in self.runRecords(start, end):
+                yield r
+
+
+    def runRecords(self, pos, end):
+        """
+        Yields the records of one run, from its start and end offsets as
+        returned by runs().
+        """
+        m = self.capture
+        while pos < end:
+            direction, c, timestamp, type, length = \
+                _record.unpack_from(m, pos)
+            pos += _record.size
+            yield direction, c, timestamp, type, m[pos:pos + length]
+            pos += length
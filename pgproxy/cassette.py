@@ -0,0 +1,537 @@
+"""
+Module that records the traffic between the proxy and the postgres server
+to a cassette file, and replays it later without a server.
+
+A cassette holds, for each test (as named by BEGIN TEST), the sequence of
+interactions with the backend. An interaction is the data of one write
+to the backend, plus all of the data the backend sent back before the
+next write. The authentication exchange (the prelude) and the traffic
+outside of tests are saved as well. Outside of tests the order of queries
+is not meaningful, so those interactions are looked up by their content.
+
+When replaying, ReplayPostgresProtocol stands in for the connection to the
+server. Writes are compared with the next interaction in the cassette, and
+the recorded reply is fed back through the protocol as if the server had
+sent it. When they stop matching, the replay either fails the query or
+falls back to a real server connection for the rest of the session.
+
+Falling back only works with a server that trusts the proxy's connection.
+The fallback connection is authenticated by replaying the recorded
+prelude, and a password can't be replayed: md5 and SCRAM challenge every
+connection differently. So passwords are never recorded. A password
+message, and the SASL responses that share its type code, is saved with
+its contents scrubbed. A replay whose prelude asked for a password fails
+the query that diverged instead of falling back.
+
+"""
+from __future__ import with_statement
+from twisted.internet import reactor
+from twisted.python import log
+from proxy import PostgresClientProtocol
+from protocol import MessageProtocol
+from messages import FrontendMessage, BackendMessage
+from data import pack_int32, unpack_int32_from
+import messages
+import os
+import re
+import zlib
+
+
+
+magic = 'PGPXCAS1'
+
+# Savepoint names are generated from the clock, so they have to be removed
+# before comparing recorded queries to new ones.
+_savepoint_re = re.compile(r'\bsp_[0-9_]+')
+
+_terminate = messages.terminate().serialize()
+
+# What's saved in place of a password message.
+_scrubbed = messages._message('p', '\x00', FrontendMessage).serialize()
+
+
+
+def splitMessages(data, messageType):
+    """
+    Parses all of the complete messages out of the data.
+    """
+    ms = []
+    while data:
+        m = messageType()
+        done, data = m.consume(data)
+        if not done:
+            break
+        ms.append(m)
+    return ms
+
+
+def interactionKey(data):
+    """
+    Returns a value identifying the frontend data of an interaction, that
+    ignores the parts of it that change from run to run.
+    """
+    return tuple([(m.type, _savepoint_re.sub('sp', m.data))
+                  for m in splitMessages(data, FrontendMessage)])
+
+
+def messageTypes(data, messageType=FrontendMessage):
+    """
+    Returns the type codes of the messages in the data.
+    """
+    return tuple([m.type for m in splitMessages(data, messageType)])
+
+
+def scrubPasswords(data):
+    """
+    Returns the frontend data with the contents of its password messages
+    removed.
+    """
+    ms = splitMessages(data, FrontendMessage)
+    if 'p' not in [m.type for m in ms]:
+        return data
+    return ''.join([m.type == 'p' and _scrubbed or m.serialize()
+                    for m in ms])
+
+
+def asksForPassword(prelude):
+    """
+    Returns true if the server asked for a password in the recorded
+    authentication exchange.
+    """
+    for _, reply in prelude:
+        if isinstance(reply, list):
+            reply = ''.join(reply)
+        for m in splitMessages(reply, BackendMessage):
+            if m.type == 'R' and not m.success:
+                return True
+    return False
+
+
+
+class Cassette(object):
+    """
+    The recorded interactions. Each interaction is a 2-item list of the
+    frontend data and the backend reply.
+    """
+
+    def __init__(self):
+        self.prelude = []
+        self.untested = {}
+        self.tests = {}
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a cassette file.
+        """
+        c = cls()
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(magic):
+            raise ValueError('%s is not a pgproxy cassette' % path)
+        r = _Reader(zlib.decompress(data[len(magic):]))
+
+        # cassettes recorded before passwords were scrubbed may have them.
+        c.prelude = [[scrubPasswords(d), reply]
+                     for d, reply in r.interactions()]
+        for i in r.interactions():
+            c.untested[interactionKey(i[0])] = i
+        for _ in range(r.int32()):
+            name = r.string()
+            c.tests[name] = r.interactions()
+        return c
+
+
+    def save(self, path):
+        """
+        Writes the cassette to a file. The file is replaced atomically, so
+        a reader never sees a partial cassette.
+        """
+        out = [_interactions(self.prelude),
+               _interactions(self.untested.values()),
+               pack_int32(len(self.tests))]
+        for name, interactions in sorted(self.tests.items()):
+            out.append(_string(name))
+            out.append(_interactions(interactions))
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(magic)
+            f.write(zlib.compress(''.join(out)))
+        os.rename(tmp, path)
+
+
+
+def _string(s):
+    return pack_int32(len(s)) + s
+
+
+def _interactions(interactions):
+    out = [pack_int32(len(interactions))]
+    for data, reply in interactions:
+        if isinstance(reply, list):
+            reply = ''.join(reply)
+        out.append(_string(data))
+        out.append(_string(reply))
+    return ''.join(out)
+
+
+
+class _Reader(object):
+    """
+    Reads the values written by Cassette.save.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+
+    def int32(self):
+        p = self.pos
+        self.pos += 4
+        return unpack_int32_from(self.data, p)[0]
+
+
+    def string(self):
+        n = self.int32()
+        p = self.pos
+        self.pos += n
+        return self.data[p:self.pos]
+
+
+    def interactions(self):
+        return [[self.string(), self.string()] for _ in range(self.int32())]
+
+
+
+class _CassetteProtocol(PostgresClientProtocol):
+    """
+    Base class for the recording and replaying backend protocols. Keeps
+    track of which test each write to the backend belongs to.
+    """
+
+    # The test that the interactions are currently being attributed to.
+    cassetteTest = None
+
+    # Set when the test has ended, but the write that ends it (the ROLLBACK)
+    # has not been seen yet.
+    endingTest = False
+
+
+    def signalTest(self, value, name=None, committed=False):
+        PostgresClientProtocol.signalTest(self, value, name, committed)
+        if value:
+            self.cassetteTest = self.testName
+            self.endingTest = False
+            self.testStarted()
+        else:
+            self.endingTest = True
+
+
+    def testStarted(self):
+        """
+        Called when a new test has been started.
+        """
+        pass
+
+
+    def nextWriteTest(self):
+        """
+        Returns the test that the next write to the backend belongs to,
+        or None if it's outside of a test.
+        """
+        test = self.cassetteTest
+        if self.endingTest:
+            self.cassetteTest = None
+            self.endingTest = False
+        return test
+
+
+
+class RecordingTransport(object):
+    """
+    Wraps the transport of a RecordingPostgresProtocol, so that the data
+    written to the backend is recorded.
+    """
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+
+    def write(self, data):
+        self.protocol.frontendWritten(data)
+        return self.transport.write(data)
+
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+
+class RecordingPostgresProtocol(_CassetteProtocol):
+    """
+    Backend protocol that records its traffic to a cassette.
+    """
+
+    def __init__(self, cassette):
+        _CassetteProtocol.__init__(self)
+        self.cassette = cassette
+        self.interaction = None
+
+
+    def connectionMade(self):
+        _CassetteProtocol.connectionMade(self)
+        self.cassette.prelude = []
+        self.transport = RecordingTransport(self.transport, self)
+
+
+    def testStarted(self):
+        # re-running a test replaces its recording.
+        self.cassette.tests[self.cassetteTest] = []
+
+
+    def frontendWritten(self, data):
+        if data == _terminate:
+            return
+
+        test = self.nextWriteTest()
+        self.interaction = i = [data, []]
+        if test is not None:
+            self.cassette.tests.setdefault(test, []).append(i)
+        elif not self.authenticationComplete:
+            i[0] = scrubPasswords(data)
+            self.cassette.prelude.append(i)
+        else:
+            self.cassette.untested[interactionKey(data)] = i
+
+
+    def dataReceived(self, data):
+        if self.interaction is not None:
+            self.interaction[1].append(data)
+        return _CassetteProtocol.dataReceived(self, data)
+
+
+
+class ReplayTransport(object):
+    """
+    The transport of a ReplayPostgresProtocol. Writes are answered from the
+    cassette instead of being sent anywhere.
+    """
+    disconnecting = False
+
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+    def write(self, data):
+        self.protocol.frontendWritten(data)
+
+
+    def writeSequence(self, seq):
+        self.write(''.join(seq))
+
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self.protocol.closeLive()
+        (self.protocol.clock or reactor).callLater(
+            0, self.protocol.connectionLost, None)
+
+
+    def pauseProducing(self):
+        pass
+
+
+    resumeProducing = stopProducing = pauseProducing
+
+
+
+class LiveBackendProtocol(MessageProtocol):
+    """
+    The real server connection that a replay falls back to. The replies
+    to the interactions that were already replayed from the cassette are
+    discarded (by counting ReadyForQuery messages), and everything after
+    that is handed to the replay protocol as if it came from the cassette.
+    """
+    messageType = BackendMessage
+
+
+    def __init__(self, replay, skip):
+        MessageProtocol.__init__(self)
+        self.replay = replay
+        self.skip = skip
+
+
+    def messageReceived(self, msg):
+        if self.skip:
+            if msg.type == 'Z':
+                self.skip -= 1
+            return
+        self.replay.dataReceived(msg.serialize())
+
+
+    def connectionLost(self, reason=None):
+        self.replay.transport.loseConnection()
+
+
+
+class ReplayPostgresProtocol(_CassetteProtocol):
+    """
+    Backend protocol that answers from a cassette. onDivergence determines
+    what happens when a write doesn't match the cassette:
+
+        'fail'     - the query fails with an ErrorResponse, and so does the
+                     rest of the test.
+        'fallback' - a real server connection is made, the current test's
+                     interactions are re-run on it, and it is used for the
+                     rest of the session.
+
+    connect is a callable like PGProxyServerFactory.connectBackend.
+    """
+
+    divergence_error = messages.errorResponse(
+        ('S', 'ERROR'), ('C', 'XX000'),
+        ('M', 'pgproxy: query does not match the recorded cassette'))
+
+
+    def __init__(self, cassette, onDivergence='fallback', connect=None):
+        _CassetteProtocol.__init__(self)
+        self.cassette = cassette
+        self.onDivergence = onDivergence
+        self.connect = connect
+
+        self.position = 0
+        self.preludePosition = 0
+        self.history = []
+        self.diverged = False
+
+        # Writes are queued here while the fallback connection is being
+        # made, and then sent to liveProtocol.
+        self.liveQueue = None
+        self.liveProtocol = None
+
+
+    def testStarted(self):
+        self.position = 0
+        self.history = []
+        self.diverged = False
+
+
+    def frontendWritten(self, data):
+        if self.liveProtocol:
+            return self.liveProtocol.transport.write(data)
+        if self.liveQueue is not None:
+            return self.liveQueue.append(data)
+        if data == _terminate:
+            return
+
+        test = self.nextWriteTest()
+        ending = test is not None and self.cassetteTest is None
+        if self.diverged:
+            return self.failWrite(data, ending)
+
+        i = self.lookup(test, data)
+        if i is None:
+            return self.divergedAt(test, data, ending)
+        if test is not None:
+            self.history.append(i)
+        self.replyLater(i[1])
+
+
+    def replyLater(self, reply):
+        if reply:
+            (self.clock or reactor).callLater(0, self.dataReceived, reply)
+
+
+    def lookup(self, test, data):
+        """
+        Returns the recorded interaction that matches the write, or None.
+        """
+        if test is not None:
+            seq = self.cassette.tests.get(test, ())
+            if self.position < len(seq):
+                i = seq[self.position]
+                if interactionKey(i[0]) == interactionKey(data):
+                    self.position += 1
+                    return i
+            return None
+
+        if not self.authenticationComplete:
+            # Startup parameters and passwords can differ between runs,
+            # only the shape of the exchange has to match.
+            p = self.cassette.prelude
+            if self.preludePosition < len(p):
+                i = p[self.preludePosition]
+                if messageTypes(i[0]) == messageTypes(data):
+                    self.preludePosition += 1
+                    return i
+            return None
+
+        return self.cassette.untested.get(interactionKey(data))
+
+
+    def divergedAt(self, test, data, ending):
+        log.msg('Replay diverged from the cassette in test %r' % (test,))
+        fallback = self.onDivergence == 'fallback' and self.connect
+        if fallback and asksForPassword(self.cassette.prelude):
+            log.msg('Not falling back to the postgres server: it asked for '
+                    'a password, which is not recorded.')
+            fallback = False
+        if not fallback:
+            if test is not None and not ending:
+                self.diverged = True
+            return self.failWrite(data, ending)
+        self.goLive(data)
+
+
+    def failWrite(self, data, ending):
+        """
+        Answers a write that can't be replayed with an error, if the write
+        expects an answer. The write that ends a failed test is answered
+        with a successful rollback.
+        """
+        if ending:
+            self.diverged = False
+            reply = (messages.commandComplete('ROLLBACK'),
+                     messages.readyForQuery('idle'))
+        elif set(messageTypes(data)) & set(['Q', 'S', 'Startup']):
+            reply = (self.divergence_error, messages.readyForQuery(
+                    'failed' if self.diverged else 'idle'))
+        else:
+            return
+        self.replyLater(''.join([m.serialize() for m in reply]))
+
+
+    def goLive(self, data):
+        """
+        Connects to the real server, and replays the prelude and the
+        current test on it before sending data.
+        """
+        log.msg('Replay falling back to the postgres server.')
+        replayed = self.cassette.prelude + self.history
+        skip = sum([messageTypes(r, BackendMessage).count('Z')
+                    for _, r in replayed])
+        self.liveQueue = [d for d, _ in replayed] + [data]
+
+        def connected(p):
+            self.liveProtocol = p
+            p.transport.write(''.join(self.liveQueue))
+            self.liveQueue = None
+
+        def failed(f):
+            log.err(f, 'Could not fall back to the postgres server.')
+            self.transport.loseConnection()
+
+        self.connect(LiveBackendProtocol, self, skip).addCallbacks(
+            connected, failed)
+
+
+    def closeLive(self):
+        if self.liveProtocol:
+            self.liveProtocol.transport.loseConnection()
@@ -10,6 +10,7 @@ struct_compile = getattr(struct, 'Struct', None) or struct._compile
 _fmt_int32 = struct_compile('!I')
 _fmt_int16 = struct_compile('!H')
 pack_int32 = _fmt_int32.pack
+pack_int16 = _fmt_int16.pack
 unpack_int32 = _fmt_int32.unpack
 unpack_int16 = _fmt_int16.unpack
 unpack_int32_from = _fmt_int32.unpack_from
@@ -0,0 +1,197 @@
+"""
+Module for running the proxy in a thread of the process that uses it,
+rather than in a process of its own, so that a test suite can start it
+without waiting for a new interpreter to start. pgproxy.PGProxy uses it
+when given inProcess=True.
+
+EmbeddedProxy runs the proxy on the Twisted reactor, in a thread that
+runs the reactor for the rest of the process's life, since the reactor
+can't be started twice. It can't be used in a process that runs the
+reactor itself. LoopThreadProxy runs the asyncio engine (see pgproxy.aio)
+on a loop of its own in a thread.
+
+Both take the configuration of pgproxy.options as a dict, and start()
+returns the port the proxy is listening on once it is, which is how the
+port picked with a --listen-port of 0 is found.
+
+"""
+from __future__ import with_statement
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+import sys
+import threading
+
+
+
+_reactorThread = None
+_reactorLock = threading.Lock()
+
+
+def reactorThread():
+    """
+    Returns the thread that runs the reactor, starting it if it hasn't
+    been started.
+    """
+    global _reactorThread
+    with _reactorLock:
+        if _reactorThread is None:
+            if reactor.running:
+                raise RuntimeError('The reactor is already running in this '
+                                   'process.')
+            t = threading.Thread(
+                target=reactor.run, name='pgproxy reactor',
+                kwargs={'installSignalHandlers': False})
+            t.daemon = True
+            t.start()
+            _reactorThread = t
+    return _reactorThread
+
+
+
+class _Embedded(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.port = None
+        self.logFile = None
+
+
+    def startLogging(self):
+        """
+        Logs to --logfile, if there is one, while the proxy runs.
+        """
+        path = self.config.get('logfile')
+        if path and path != '-':
+            self.logFile = open(path, 'a')
+            self.observer = log.FileLogObserver(self.logFile).emit
+            log.addObserver(self.observer)
+
+
+    def stopLogging(self):
+        if self.logFile is not None:
+            log.removeObserver(self.observer)
+            self.logFile.close()
+            self.logFile = None
+
+
+
+class EmbeddedProxy(_Embedded):
+    """
+    A proxy on the reactor, run in its own thread.
+    """
+
+    def __init__(self, config):
+        _Embedded.__init__(self, config)
+        self.factory = None
+        self.listeners = []
+
+
+    def start(self):
+        self.startLogging()
+        reactorThread()
+        try:
+            self.port = threads.blockingCallFromThread(reactor, self.listen)
+        except:
+            self.stopLogging()
+            raise
+        return self.port
+
+
+    def listen(self):
+        from proxy import PGProxyServerFactory
+        self.factory = PGProxyServerFactory(self)
+        port = self.config['listen-port']
+        if not self.config.get('no-tcp'):
+            listener = reactor.listenTCP(port, self.factory)
+            self.listeners.append(listener)
+            port = listener.getHost().port
+            log.msg('pgproxy listening on port %d (in process).' % port)
+        if self.config.get('listen-unix'):
+            from unix import socketPath
+            path = socketPath(self.config['listen-unix'], port)
+            self.listeners.append(reactor.listenUNIX(
+                    path, self.factory, mode=0777, wantPID=True))
+            log.msg('pgproxy listening on %s (in process).' % path)
+        if self.config.get('metrics-port'):
+            from metrics import metricsSite
+            self.listeners.append(reactor.listenTCP(
+                    self.config['metrics-port'], metricsSite(self.factory)))
+        return port
+
+
+    def stop(self):
+        """
+        Stops listening and disconnects the clients, returning once the
+        proxy has stopped.
+        """
+        try:
+            threads.blockingCallFromThread(reactor, self.stopListening)
+        finally:
+            self.stopLogging()
+
+
+    def stopListening(self):
+        pg = self.factory.postgresProtocol
+        if pg is not None:
+            for c in list(pg.clientStack):
+                c.transport.loseConnection()
+        listeners, self.listeners = self.listeners, []
+        return defer.gatherResults(
+            [defer.maybeDeferred(l.stopListening) for l in listeners])
+
+
+
+class LoopThreadProxy(_Embedded):
+    """
+    A proxy on an asyncio loop, run in its own thread.
+    """
+
+    def __init__(self, config):
+        _Embedded.__init__(self, config)
+        self.loop = self.proxy = self.thread = None
+        self.error = None
+
+
+    def start(self):
+        self.startLogging()
+        started = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, args=(started,), name='pgproxy loop')
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        if self.error is not None:
+            self.stopLogging()
+            raise self.error[0], self.error[1], self.error[2]
+        return self.port
+
+
+    def run(self, started):
+        import aio
+        self.loop = loop = aio.newEventLoop(self.config.get('uvloop'))
+        try:
+            self.proxy = aio.AioProxy(self.config, loop)
+            loop.run_until_complete(self.proxy.start())
+            self.port = self.proxy.port
+        except:
+            self.error = sys.exc_info()
+            loop.close()
+            started.set()
+            return
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(self.proxy.stop())
+            loop.close()
+
+
+    def stop(self):
+        """
+        Stops the proxy, returning once it has stopped.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        finally:
+            self.stopLogging()
@@ -0,0 +1,509 @@
+"""
+A fake postgres server, for running and measuring the proxy without a
+database.
+
+It speaks enough of version 3 of the frontend/backend protocol for the
+proxy and simple clients: startup (every user is trusted), simple queries,
+and the extended query protocol. Nothing is stored. The results of queries
+are made up from the SQL:
+
+    select <n>                        - one row holding n
+    select * from generate_series(a, b)
+                                      - the integers from a to b
+    select * from fake_rows(n[, w])   - n rows of one w-byte text column
+    select fake_error('message')      - fails with the message
+
+Other queries that return rows (select, show, values, ...) return the
+factory's default number of rows. Transaction statements (begin, commit,
+rollback, savepoint, ...) keep track of the transaction status the way
+postgres does, and anything else completes as if it affected one row.
+More query patterns can be added with FakeBackendFactory.addQuery.
+
+Every reply can be delayed by a fixed latency, to stand in for the time a
+real server would take. To run a fake backend:
+
+    python fakebackend.py --port 54321 --latency 0.5
+
+With --unix, it also listens on a Unix socket in the directory given,
+named as postgres names its own (see pgproxy.unix).
+
+"""
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log, usage
+from protocol import MessageProtocol
+from messages import FrontendMessage
+from itertools import count
+import messages
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+
+_this_dir = os.path.realpath(os.path.dirname(__file__))
+
+_comment_re = re.compile(r'--[^\n]*')
+_select_n_re = re.compile(r'select\s+(-?\d+)$', re.I)
+_series_re = re.compile(
+    r'select\s+\*\s+from\s+generate_series\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)$',
+    re.I)
+_fake_rows_re = re.compile(
+    r'select\s+\*\s+from\s+fake_rows\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\)$', re.I)
+_fake_error_re = re.compile(r"select\s+fake_error\('([^']*)'\)$", re.I)
+
+# The first words of statements that return rows.
+_row_verbs = frozenset(['select', 'show', 'values', 'with', 'table', 'fetch'])
+
+_parameters = (
+    ('server_version', '9.6.0'),
+    ('server_encoding', 'UTF8'),
+    ('client_encoding', 'UTF8'),
+    ('DateStyle', 'ISO, MDY'),
+    ('integer_datetimes', 'on'),
+    ('standard_conforming_strings', 'on'),)
+
+
+
+class QueryError(Exception):
+    """
+    Raised to make a query fail.
+    """
+
+    def __init__(self, message, code='XX000'):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+    def response(self):
+        return messages.errorResponse(
+            ('S', 'ERROR'), ('C', self.code), ('M', self.args[0]))
+
+
+
+class Result(object):
+    """
+    The outcome of one statement. rowData is the serialized DataRow
+    messages, and columns is None for statements that return no rows.
+    """
+
+    def __init__(self, tag, columns=None, rows=()):
+        self.tag = tag
+        self.columns = columns
+        self.rowCount = len(rows)
+        self.rowData = ''.join([messages.dataRow(r).serialize() for r in rows])
+
+
+    @classmethod
+    def repeated(cls, columns, row, n):
+        """
+        Returns a result of n copies of the same row, without building a
+        message for each one.
+        """
+        r = cls('SELECT %d' % n, columns)
+        r.rowCount = n
+        r.rowData = messages.dataRow(row).serialize() * n
+        return r
+
+
+    def description(self):
+        if self.columns is None:
+            return messages.noData().serialize()
+        return messages.rowDescription(self.columns).serialize()
+
+
+    def completion(self):
+        return self.rowData + messages.commandComplete(self.tag).serialize()
+
+
+
+class FakeBackendProtocol(MessageProtocol):
+    """
+    One connection to the fake server. Messages are dispatched to the
+    handle_<message type> methods.
+    """
+    messageType = FrontendMessage
+
+
+    def __init__(self):
+        MessageProtocol.__init__(self)
+        self.transactionStatus = 'idle'
+        self.statements = {}
+        self.portals = {}
+
+        # Replies to the extended protocol are held here until a Sync or
+        # a Flush. After an error, messages are ignored until the Sync.
+        self.pending = []
+        self.skipToSync = False
+
+        # (due time, data) pairs waiting for the latency to pass.
+        self.replies = []
+        self.delayed = None
+        self.lost = defer.Deferred()
+
+
+    def connectionMade(self):
+        self.pid = self.factory.pids.next()
+        self.factory.protocols.append(self)
+
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.delayed and self.delayed.active():
+            self.delayed.cancel()
+        if self in self.factory.protocols:
+            self.factory.protocols.remove(self)
+        self.lost.callback(None)
+
+
+    def reply(self, data):
+        """
+        Writes data to the client, once the latency has passed. Replies
+        are always written in order.
+        """
+        latency = self.factory.latency
+        if not latency and not self.replies:
+            return self.transport.write(data)
+        self.replies.append((time.time() + latency, data))
+        if not self.delayed:
+            self.scheduleReplies()
+
+
+    def scheduleReplies(self):
+        delay = max(0, self.replies[0][0] - time.time())
+        self.delayed = reactor.callLater(delay, self.sendReplies)
+
+
+    def sendReplies(self):
+        now = time.time()
+        while self.replies and self.replies[0][0] <= now:
+            self.transport.write(self.replies.pop(0)[1])
+        self.delayed = None
+        if self.replies:
+            self.scheduleReplies()
+
+
+    def readyForQuery(self):
+        return messages.readyForQuery(self.transactionStatus).serialize()
+
+
+    def messageReceived(self, msg):
+        if self.skipToSync and msg.type != 'S':
+            return
+        getattr(self, 'handle_' + msg.type, self.handle_unknown)(msg)
+
+
+    def handle_unknown(self, msg):
+        self.reply(QueryError('unsupported message: %s' % msg.type,
+                              '08P01').response().serialize())
+
+
+    def handle_SSLRequest(self, msg):
+        self.transport.write('N')
+
+
+    def handle_Cancel(self, msg):
+        self.transport.loseConnection()
+
+
+    def handle_Startup(self, msg):
+        ms = [messages.authenticationOk()]
+        ms.extend([messages.parameterStatus(k, v) for k, v in _parameters])
+        ms.append(messages.backendKeyData(self.pid, self.pid))
+        self.reply(''.join([m.serialize() for m in ms]) + self.readyForQuery())
+
+
+    def handle_X(self, msg):
+        self.transport.loseConnection()
+
+
+    def handle_Q(self, msg):
+        statements = [s.strip() for s in
+                      _comment_re.sub('', msg.data[:-1]).split(';')]
+        statements = [s for s in statements if s]
+        if not statements:
+            self.reply(messages.emptyQueryResponse().serialize() +
+                       self.readyForQuery())
+            return
+
+        out = []
+        for sql in statements:
+            try:
+                r = self.execute(sql)
+            except QueryError, e:
+                out.append(e.response().serialize())
+                self.failed()
+                break
+            out.append(r.description() if r.columns is not None else '')
+            out.append(r.completion())
+        out.append(self.readyForQuery())
+        self.reply(''.join(out))
+
+
+    def handle_P(self, msg):
+        name, sql = msg.data.split('\x00')[:2]
+        self.statements[name] = _comment_re.sub('', sql).strip().rstrip(';')
+        self.pending.append(messages.parseComplete().serialize())
+
+
+    def handle_B(self, msg):
+        portal, name = msg.data.split('\x00')[:2]
+        if name not in self.statements:
+            return self.extendedError(QueryError(
+                    'prepared statement "%s" does not exist' % name, '26000'))
+        self.portals[portal] = self.statements[name]
+        self.pending.append(messages.bindComplete().serialize())
+
+
+    def handle_D(self, msg):
+        kind, name = msg.data[0], msg.data[1:].split('\x00')[0]
+        sql = (self.statements if kind == 'S' else self.portals).get(name)
+        if sql is None:
+            return self.extendedError(QueryError(
+                    '"%s" does not exist' % name, '26000'))
+        try:
+            r = self.plan(sql)
+        except QueryError, e:
+            return self.extendedError(e)
+        if kind == 'S':
+            self.pending.append(messages.parameterDescription().serialize())
+        self.pending.append(r.description())
+
+
+    def handle_E(self, msg):
+        name = msg.data.split('\x00')[0]
+        if name not in self.portals:
+            return self.extendedError(QueryError(
+                    'portal "%s" does not exist' % name, '34000'))
+        try:
+            r = self.execute(self.portals[name])
+        except QueryError, e:
+            return self.extendedError(e)
+        self.pending.append(r.completion())
+
+
+    def handle_C(self, msg):
+        kind, name = msg.data[0], msg.data[1:].split('\x00')[0]
+        (self.statements if kind == 'S' else self.portals).pop(name, None)
+        self.pending.append(messages.closeComplete().serialize())
+
+
+    def handle_H(self, msg):
+        self.flush()
+
+
+    def handle_S(self, msg):
+        self.skipToSync = False
+        self.portals.clear()
+        self.pending.append(self.readyForQuery())
+        self.flush()
+
+
+    def flush(self):
+        if self.pending:
+            self.reply(''.join(self.pending))
+            self.pending = []
+
+
+    def extendedError(self, e):
+        self.pending.append(e.response().serialize())
+        self.skipToSync = True
+        self.failed()
+
+
+    def failed(self):
+        if self.transactionStatus == 'transaction':
+            self.transactionStatus = 'failed'
+
+
+    def execute(self, sql):
+        """
+        Runs a statement, returning its Result and updating the transaction
+        status.
+        """
+        words = sql.lower().split()
+        verb = words[0]
+        status = self.transactionStatus
+
+        if verb in ('begin', 'start'):
+            self.transactionStatus = 'transaction'
+            return Result('BEGIN')
+
+        if verb in ('commit', 'end', 'abort') or (
+            verb == 'rollback' and 'to' not in words[1:3]):
+            self.transactionStatus = 'idle'
+            if verb == 'rollback' or verb == 'abort' or status == 'failed':
+                return Result('ROLLBACK')
+            return Result('COMMIT')
+
+        if verb == 'rollback':
+            # ROLLBACK TO SAVEPOINT recovers from an error.
+            if status != 'idle':
+                self.transactionStatus = 'transaction'
+            return Result('ROLLBACK')
+
+        if status == 'failed':
+            raise QueryError('current transaction is aborted, commands '
+                             'ignored until end of transaction block', '25P02')
+        return self.plan(sql)
+
+
+    def plan(self, sql):
+        """
+        Returns the Result of a statement, without changing any state.
+        """
+        for rx, f in self.factory.script:
+            m = rx.match(sql)
+            if m:
+                r = f(m)
+                if isinstance(r, Result):
+                    return r
+                if isinstance(r, str):
+                    return Result(r)
+                columns, rows = r
+                return Result('SELECT %d' % len(rows), columns, rows)
+
+        m = _fake_error_re.match(sql)
+        if m:
+            raise QueryError(m.group(1))
+
+        m = _select_n_re.match(sql)
+        if m:
+            return Result('SELECT 1', ['?column?'], [[m.group(1)]])
+
+        m = _series_re.match(sql)
+        if m:
+            a, b = int(m.group(1)), int(m.group(2))
+            return Result('SELECT %d' % max(0, b - a + 1),
+                          ['generate_series'], [[i] for i in range(a, b + 1)])
+
+        m = _fake_rows_re.match(sql)
+        if m:
+            width = int(m.group(2) or self.factory.rowWidth)
+            return Result.repeated(['fake'], ['x' * width], int(m.group(1)))
+
+        verb = sql.split()[0].lower()
+        if verb in _row_verbs:
+            return Result.repeated(['fake'], ['x' * self.factory.rowWidth],
+                                   self.factory.rows)
+        if verb == 'copy':
+            raise QueryError('COPY is not supported by the fake backend',
+                             '0A000')
+        if verb == 'insert':
+            return Result('INSERT 0 1')
+        if verb in ('update', 'delete', 'move'):
+            return Result('%s 1' % verb.upper())
+        if verb in ('create', 'drop', 'alter', 'truncate'):
+            return Result(' '.join(sql.split()[:2]).upper())
+        if verb == 'release':
+            return Result('RELEASE')
+        return Result(verb.upper())
+
+
+
+class FakeBackendFactory(protocol.ServerFactory):
+    """
+    Creates the fake server's connections. latency is the number of seconds
+    that every reply is delayed by. rows and rowWidth determine the size of
+    the results of queries that aren't otherwise recognized.
+    """
+    protocol = FakeBackendProtocol
+
+
+    def __init__(self, latency=0, rows=1, rowWidth=8):
+        self.latency = latency
+        self.rows = rows
+        self.rowWidth = rowWidth
+        self.script = []
+        self.pids = count(1000)
+        self.protocols = []
+
+
+    def addQuery(self, pattern, result):
+        """
+        Makes queries that match the regular expression pattern return the
+        value of result, a function that is called with the match object.
+        It can return a command tag string, a Result, or a (column names,
+        rows) pair. It can raise QueryError to fail the query. Patterns
+        are tried in the order they were added, before the built in ones.
+        """
+        self.script.append((re.compile(pattern + '$', re.I), result))
+
+
+
+class FakeBackend(object):
+    """
+    Runs a fake backend in a subprocess, the same way that pgproxy.PGProxy
+    runs the proxy. latency is in seconds. unix is a directory to also
+    listen on a Unix socket in.
+    """
+
+    def __init__(self, port=5432, latency=0, rows=1, rowWidth=8, unix=None):
+        self.port = port
+        self.unix = unix
+        self.latency = latency
+        self.rows = rows
+        self.rowWidth = rowWidth
+        self.process = None
+
+
+    def start(self):
+        from pgproxy import _waitForServerUp
+        args = [sys.executable, os.path.join(_this_dir, 'fakebackend.py'),
+                '--port=%d' % self.port,
+                '--latency=%s' % (self.latency * 1000.0),
+                '--rows=%d' % self.rows, '--row-width=%d' % self.rowWidth]
+        if self.unix:
+            args.append('--unix=%s' % self.unix)
+        self.process = subprocess.Popen(args)
+        if not _waitForServerUp(self.port):
+            self.stop()
+            raise AssertionError('Could not start the fake backend on port %s'
+                                 % self.port)
+        return self
+
+
+    __enter__ = start
+
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('port', 'p', 5432, 'The port to listen on.', int),
+        ('interface', '', '127.0.0.1', 'The interface to listen on.'),
+        ('latency', 'l', 0.0, 'Milliseconds to delay every reply by.', float),
+        ('rows', 'r', 1, 'Rows returned by unrecognized queries.', int),
+        ('row-width', 'w', 8, 'Bytes in each row returned.', int),
+        ('unix', '', None, 'A directory to also listen on a Unix socket in.'),
+        ]
+
+
+
+def main(argv=None):
+    config = Options()
+    config.parseOptions(argv)
+    factory = FakeBackendFactory(
+        config['latency'] / 1000.0, config['rows'], config['row-width'])
+    reactor.listenTCP(config['port'], factory, interface=config['interface'])
+    log.msg('Fake backend listening on port %d' % config['port'])
+    if config['unix']:
+        from unix import socketPath
+        path = socketPath(config['unix'], config['port'])
+        reactor.listenUNIX(path, factory, wantPID=True)
+        log.msg('Fake backend listening on %s' % path)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,9 @@ class FIFOBuffer(object):
     A class that is handy for treating a raw string as an input stream, 
     and reading different datatypes out of it. 
     """
+    __slots__ = ('str_buf', 'pos')
+
+
     def __init__(self, data=''):
         self.str_buf = data
         self.pos = 0
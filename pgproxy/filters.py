@@ -8,6 +8,11 @@ Each protocol instance is generally associated with one filter instance.
 """
 from twisted.internet import reactor
 from twisted.python import log
+from timing import clock
+from writeset import truncateQuery
+from statements import PreparedStatements
+import admin
+import budget
 import messages
 import re
 import time
@@ -36,6 +41,11 @@ class Filter(object):
     with it. The protocol using the filter is available via the self.protocol
     field. 
     """
+    # A filter is made for every connection, so it keeps only the 
+    # attributes it needs. 
+    __slots__ = ('protocol', 'dropMessages')
+
+
     def __init__(self, protocol):
         self.protocol = protocol
         self.dropMessages = ''
@@ -73,6 +83,8 @@ class Filter(object):
         """
         Converts the message to one or more different messages. 
         """
+        if self.protocol.stats:
+            self.protocol.stats.countAction('translate')
         return messages, None
 
 
@@ -84,6 +96,8 @@ class Filter(object):
         if why:
             l += ' because: %s' % why
         log.msg(l)
+        if self.protocol.stats:
+            self.protocol.stats.countAction('drop')
         return None, None
 
 
@@ -92,8 +106,23 @@ class Filter(object):
         Sends the provided list of messages back to the protocol's transport. 
         """
         log.msg('Spoofing data: %s' % ''.join(map(str, messages)))
+        if self.protocol.capture:
+            self.protocol.captureMessages(
+                self.protocol.direction.lower(), messages)
+        if self.protocol.stats:
+            self.protocol.stats.countAction('spoof')
+            self.protocol.stats.countMessages(
+                self.protocol.direction.lower(), messages)
+        timing = self.protocol.timing
+        if timing is not None:
+            start = clock()
         data = ''.join([m.serialize() for m in messages])
-        reactor.callLater(0, lambda: self.protocol.transport.write(data))
+        (self.protocol.clock or reactor).callLater(
+            0, lambda: self.protocol.transport.write(data))
+        if timing is not None:
+            timing.add('spoof', self.protocol.direction.lower() + 
+                       messages[0].type, self.protocol.captureClientId(), 
+                       clock() - start)
 
 
 
@@ -128,6 +157,16 @@ class FrontendFilter(Filter):
         messages.commandComplete('ROLLBACK'),
         messages.readyForQuery('transaction'),)
 
+    # Committed tests are not wrapped in a transaction, so the replies to 
+    # their start and (empty) reset leave the connection idle. 
+    spoofed_begin_committed = (
+        messages.commandComplete('BEGIN'),
+        messages.readyForQuery('idle'),)
+
+    spoofed_rollback_committed = (
+        messages.commandComplete('ROLLBACK'),
+        messages.readyForQuery('idle'),)
+
     # psycopg2 issues a BEGIN; SET TRANSACTION ISOLATION LEVEL READ COMMITTED; 
     # query at the start of every connection. It's not legal to set the 
     # transaction isolation level except at the (real) beginning of a 
@@ -148,21 +187,33 @@ class FrontendFilter(Filter):
 
 
     # Match pgproxy special syntax
-    begin_test_re = re.compile("begin test '([^']*)';?$")
+    begin_test_re = re.compile(
+        r"begin test '([^']*)'(?:\s+with\s*\(([^)]*)\))?\s*;?$")
+    begin_committed_test_re = re.compile(
+        r"begin committed test '([^']*)'(?:\s+with\s*\(([^)]*)\))?\s*;?$")
     rollback_test_re = re.compile("rollback test '([^']*)';?$")
 
+    # Match the admin queries, [SHOW] PGPROXY <command>
+    admin_re = re.compile(
+        r"(?:show\s+)?pgproxy\s+(\w+(?:\s+\w+)*)\s*;?$")
+
     # sentinel value for match_* functions to return when they fail to match 
     # a query. 
     no_match = (False, 0)
 
-    # This is a stack of the savepoint names that have been created by this 
-    # filter / connection. 
-    savepoints = []
+    __slots__ = ('savepoints', 'prepared')
 
 
     def __init__(self, protocol):
         Filter.__init__(self, protocol)
-        self.savepoints = []
+
+        # This is a stack of the savepoint names that have been created by 
+        # this filter / connection. The list is made when the first one is. 
+        self.savepoints = ()
+
+        # The client's statements.PreparedStatements, made when statement 
+        # statistics are first kept for it. 
+        self.prepared = None
     
 
     def filter_Startup(self, msg):
@@ -184,7 +235,27 @@ class FrontendFilter(Filter):
         test. Accepts a special query syntax: 
 
         <BEGIN|ROLLBACK> TEST "<test name>";
+
+        Tests that need to commit their data can be started with: 
+
+        BEGIN COMMITTED TEST "<test name>";
+
+        These are not run inside of a transaction. Rolling one back 
+        truncates the tables that it wrote to instead. 
+
+        Either can be given a budget (see the budget module) with a 
+        WITH (...) clause. 
         """
+        m = self.begin_committed_test_re.match(sql)
+        if m:
+            name = m.groups()[0]
+            if not self.setBudget(name, m.groups()[1]):
+                return True, self.drop(msg, 'bad budget')
+            log.msg('BEGIN committed test: %s' % name)
+            self.protocol.signalTest(True, name, committed=True)
+            self.spoof(self.spoofed_begin_committed)
+            return True, self.drop(msg, 'committed test')
+
         for rx, stmt, test in ((self.begin_test_re, 'BEGIN', True), 
                                (self.rollback_test_re, 'ROLLBACK', False),):
             m = rx.match(sql)
@@ -195,16 +266,156 @@ class FrontendFilter(Filter):
                 # automatically issue the BEGINs, so it's not really possible to
                 # require that the frontend only issue the begin statements 
                 # within tests.)
-                self.protocol.signalTest(test)
-
                 name = m.groups()[0]
+                if test and not self.setBudget(name, m.groups()[1]):
+                    return True, self.drop(msg, 'bad budget')
+                committed = self.postgresProtocol().committedTest
+                self.protocol.signalTest(test, name)
+                if not test:
+                    self.endRepeats(name)
+                    error = self.checkBudget(name)
+                    tables = self.postgresProtocol().writeSets.discard(name)
+                    if committed:
+                        return True, self.resetCommittedTest(
+                            msg, name, tables, error)
+
                 log.msg('%s test: %s' % (stmt, name))
                 ret = self.translate(messages.query('%s; -- %s' % (stmt, name)))
+                if not test and error:
+                    self.failRollback(error)
                 return True, ret
 
         return self.no_match
 
 
+    def setBudget(self, name, clause):
+        """
+        Sets the budget of a test that is beginning, given the inside of 
+        its WITH (...) clause, if any. If the clause is bad, an error is 
+        spoofed and False returned. 
+        """
+        pg = self.postgresProtocol()
+        pg.budget = None
+        if clause is None:
+            return True
+        try:
+            pg.budget = budget.parse(name, clause)
+        except budget.BudgetError, e:
+            self.spoof([messages.errorResponse(
+                        ('S', 'ERROR'), ('C', '42601'), ('M', str(e))),
+                        messages.readyForQuery(pg.transactionStatus or 'idle')])
+            return False
+        return True
+
+
+    def checkBudget(self, name):
+        """
+        Checks the budget of a test that is ending. Returns the error to 
+        fail the test with, if it was over budget and budgets are enforced. 
+        """
+        pg = self.postgresProtocol()
+        b, pg.budget = pg.budget, None
+        if b is None or b.test != name:
+            return None
+        violations = b.violations()
+        if not violations:
+            return None
+
+        error = 'pgproxy: test %s is over budget: %s' % (
+            name, ', '.join(violations))
+        log.msg(error)
+        stats = self.protocol.stats
+        if stats and stats.tests is not None:
+            stats.tests.recordViolations(name, violations)
+        if pg.budgetAction == 'report':
+            return None
+        return error
+
+
+    def failRollback(self, error):
+        """
+        Answers the ROLLBACK that ends a test with an error in place of 
+        its CommandComplete. 
+        """
+        self.spoof([messages.errorResponse(
+                    ('S', 'ERROR'), ('C', '54000'), ('M', error))])
+        self._ignoreBackendMessages('C')
+
+
+    def countQuery(self):
+        """
+        Counts a statement against the budget of the running test. 
+        """
+        b = self.postgresProtocol().budget
+        if b is not None:
+            b.queries += 1
+
+
+    def match_admin(self, msg, sql):
+        """
+        Answers the proxy's admin queries, [SHOW] PGPROXY <command>. These 
+        never reach the server. See the admin module for the commands.
+        """
+        m = self.admin_re.match(sql)
+        if not m:
+            return self.no_match
+
+        name = ' '.join(m.group(1).split())
+        command = admin.commands.get(name)
+        try:
+            if command is None:
+                raise admin.AdminError('unknown pgproxy command: %s' % name)
+            columns, rows = command(self.protocol)
+            reply = ([messages.rowDescription(columns)] + 
+                     [messages.dataRow(r) for r in rows] + 
+                     [messages.commandComplete('SHOW')])
+        except admin.AdminError, e:
+            reply = [messages.errorResponse(
+                    ('S', 'ERROR'), ('C', '42601'), ('M', str(e)))]
+        status = self.postgresProtocol().transactionStatus or 'idle'
+        self.spoof(reply + [messages.readyForQuery(status)])
+        return True, self.drop(msg, 'admin query')
+
+
+    def resetCommittedTest(self, msg, name, tables, error=None):
+        """
+        Ends a committed test by truncating the tables that it wrote to, 
+        in one statement. If it didn't write anything, the reset is 
+        spoofed. If the test was over budget, it fails with the error. 
+        """
+        if not tables:
+            if error:
+                self.spoof([messages.errorResponse(
+                            ('S', 'ERROR'), ('C', '54000'), ('M', error)),
+                            messages.readyForQuery('idle')])
+            else:
+                self.spoof(self.spoofed_rollback_committed)
+            return self.drop(msg, 'committed test wrote no tables')
+
+        log.msg('Resetting committed test %s: %s' % (name, ', '.join(tables)))
+        ret = self.translate(
+            messages.query('%s; -- %s' % (truncateQuery(tables), name)))
+        if error:
+            self.failRollback(error)
+        return ret
+
+
+    def recordWrites(self, sql, lowerSql):
+        """
+        Adds the tables written to by the statement to the current test's 
+        write set. 
+        """
+        pg = self.postgresProtocol()
+        if pg.testName is None or not (pg.in_test or pg.committedTest):
+            return
+
+        # cheap check before running the regexes
+        for verb in ('insert', 'update', 'delete', 'copy'):
+            if verb in lowerSql:
+                pg.writeSets.record(pg.testName, sql)
+                return
+
+
     def match_commit(self, msg, sql):
         """
         Drops commit statements outside of tests, and maps them to
@@ -323,7 +534,12 @@ class FrontendFilter(Filter):
         Returns the query message to be sent to the backend.
         """
         name = 'sp_%s' % str(time.time()).replace('.', '_')
+        if not self.savepoints:
+            self.savepoints = []
         self.savepoints.append(name)
+        stats = self.protocol.stats
+        if stats and stats.tests is not None:
+            stats.tests.recordSavepoint(self.postgresProtocol().activeTest())
         return messages.query('SAVEPOINT %s' % name)
 
 
@@ -332,7 +548,8 @@ class FrontendFilter(Filter):
         Inspects query messages in order to support special syntax, and 
         to play games with transactions. 
         """
-        filters = (self.match_test_syntax, 
+        filters = (self.match_admin,
+                   self.match_test_syntax, 
                    self.match_begin,
                    self.match_commit,
                    self.match_end_work,
@@ -347,6 +564,109 @@ class FrontendFilter(Filter):
                 return val
 
         # nothing matched, just pass on the query. 
+        self.recordWrites(msg.data[:-1], sql)
+        self.checkRepeats(msg.data[:-1])
+        self.countQuery()
+        return self.transmit(msg)
+
+
+    def checkRepeats(self, sql):
+        """
+        Looks for queries repeated within the active test, if that's being 
+        done (--detect-repeats). Findings are logged, added to the test 
+        report, and optionally sent to the client as a warning. 
+        """
+        stats = self.protocol.stats
+        if not stats or stats.repeats is None:
+            return
+        test = self.postgresProtocol().activeTest()
+        if not test:
+            return
+        for f in stats.repeats.observe(test, sql):
+            log.msg(f.message())
+            if stats.tests is not None:
+                stats.tests.recordRepeat(f)
+            if stats.repeats.notice:
+                self.spoof([messages.noticeResponse(
+                            ('S', 'WARNING'), ('C', '01000'), 
+                            ('M', f.message()))])
+
+
+    def endRepeats(self, name):
+        """
+        Forgets the queries of a test that is ending, if repeats are being 
+        looked for. 
+        """
+        stats = self.protocol.stats
+        if stats and stats.repeats is not None:
+            stats.repeats.end(name)
+
+
+    def preparedStatements(self):
+        """
+        Returns the client's statements.PreparedStatements, or None if 
+        statement statistics aren't being kept. 
+        """
+        stats = self.protocol.stats
+        if not stats or stats.statements is None:
+            return None
+        if self.prepared is None:
+            self.prepared = PreparedStatements()
+        return self.prepared
+
+
+    def filter_P(self, msg):
+        """
+        Inspects parse messages for writes made through the extended 
+        query protocol. 
+        """
+        name, sql = msg.data.split('\x00')[:2]
+        self.recordWrites(sql, sql.lower())
+        prepared = self.preparedStatements()
+        if prepared is not None:
+            prepared.parse(name, sql)
+        return self.transmit(msg)
+
+
+    def filter_B(self, msg):
+        """
+        Notes which prepared statement a portal is bound to. 
+        """
+        prepared = self.preparedStatements()
+        if prepared is not None:
+            prepared.bind(*msg.data.split('\x00')[:2])
+        return self.transmit(msg)
+
+
+    def filter_E(self, msg):
+        """
+        Counts executes against the test's budget. 
+        """
+        self.countQuery()
+        prepared = self.preparedStatements()
+        if prepared is not None:
+            prepared.execute(msg.data.split('\x00')[0])
+        return self.transmit(msg)
+
+
+    def filter_C(self, msg):
+        """
+        Forgets a prepared statement or portal that the client closes. 
+        """
+        prepared = self.preparedStatements()
+        if prepared is not None:
+            prepared.close(msg.data[0], msg.data[1:].split('\x00')[0])
+        return self.transmit(msg)
+
+
+    def filter_S(self, msg):
+        """
+        Gives a Sync the SQL its batch executed, for the statement 
+        statistics. 
+        """
+        prepared = self.preparedStatements()
+        if prepared is not None:
+            msg.executed = prepared.sync()
         return self.transmit(msg)
 
 
@@ -363,6 +683,9 @@ class BackendFilter(Filter):
     Filters the messages coming from the PG server to the client. 
     """    
 
+    __slots__ = ()
+
+
     def saveAuth(self, msg):
         """
         Saves authentication response messages from the backend. These will be
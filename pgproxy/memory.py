@@ -0,0 +1,231 @@
+"""
+Module for accounting for the memory the proxy holds on behalf of its
+connections. For each protocol, it counts the bytes of:
+
+    parse      - the message being received, until it's complete
+    held       - the messages of a client held while the server answers
+                 another one
+    transport  - data written to the connection that the socket hasn't
+                 taken yet, as when a client reads a large result slowly
+
+and for the server connection, the authentication response that's saved
+for new clients (auth).
+
+SHOW PGPROXY MEMORY lists them, computed from every protocol when it's
+run. The metrics are scraped often, so they're rendered from
+MemoryAccounts instead: the running totals kept as messages are buffered
+and drained.
+
+SHOW PGPROXY MEMORY DIFF is about the proxy's own memory. It compares
+tracemalloc snapshots, where tracemalloc is available: the first run
+starts tracing, and each one after lists the biggest changes since the
+one before.
+
+"""
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+
+def transportBytes(transport):
+    """
+    Returns the number of bytes written to a transport that it hasn't
+    sent yet.
+
+    A Twisted transport's buffers are private attributes that can change
+    between versions, so each one is optional, and one that isn't what's
+    expected counts as empty.
+    """
+    size = getattr(transport, 'writeBufferSize', None)
+    if size is not None:
+        # an aio.AioTransport
+        return size()
+    n = _count(getattr(transport, '_tempDataLen', 0))
+    buf = getattr(transport, 'dataBuffer', None)
+    if isinstance(buf, str) and buf:
+        n += max(len(buf) - _count(getattr(transport, 'offset', 0)), 0)
+    return n
+
+
+def _count(n):
+    if isinstance(n, (int, long)) and n > 0:
+        return n
+    return 0
+
+
+class ConnectionMemory(object):
+    """
+    The bytes held for one protocol. connection is the client connection
+    id, or 'server'.
+    """
+
+    def __init__(self, p, connection):
+        self.connection = connection
+        self.parse = p._message is not None and len(p._message.buffer) or 0
+        self.held = sum([m.length for m in getattr(p, 'heldMessages', ())])
+        self.transport = transportBytes(p.transport)
+        if connection == 'server':
+            self.auth = sum([m.length for m in p.authenticationResponse])
+        else:
+            self.auth = 0
+
+
+    def total(self):
+        return self.parse + self.held + self.transport + self.auth
+
+
+
+def usage(factory):
+    """
+    Returns a ConnectionMemory for each of the factory's connections, the
+    server first if there is one.
+    """
+    pg = factory.postgresProtocol
+    if pg is None:
+        return []
+    return ([ConnectionMemory(pg, 'server')] +
+            [ConnectionMemory(c, c.connectionId) for c in pg.clientStack])
+
+
+class MemoryAccounts(object):
+    """
+    Running totals of the bytes the protocols hold, so that they can be 
+    read without looking at every connection. The parse and held bytes 
+    are added up as they change. Transports are only looked at once 
+    they've been backlogged, when more than their buffer size waited to 
+    be written, and until they're found to be empty. Less than that is 
+    bounded for each connection, and is the normal state of any that's 
+    being written to. 
+    """
+
+    def __init__(self):
+        self.parse = 0
+        self.held = 0
+        # The protocols holding parse or held bytes, and those whose 
+        # transports have been backlogged. 
+        self.holding = set()
+        self.backlogged = set()
+
+
+    def setParse(self, p, n):
+        """
+        Records that p holds n bytes of a message it's receiving. 
+        """
+        self.parse += n - p.parseBytes
+        p.parseBytes = n
+        self._update(p)
+
+
+    def addHeld(self, p, n):
+        """
+        Records that p holds n more bytes of held messages (or fewer, if 
+        n is negative). 
+        """
+        self.held += n
+        p.heldBytes += n
+        self._update(p)
+
+
+    def _update(self, p):
+        if p.parseBytes or p.heldBytes:
+            self.holding.add(p)
+        else:
+            self.holding.discard(p)
+
+
+    def backlog(self, p):
+        """
+        Records that p's transport has more waiting than its buffer size. 
+        """
+        self.backlogged.add(p)
+
+
+    def forget(self, p):
+        """
+        Stops accounting for a protocol that has lost its connection. 
+        """
+        self.parse -= p.parseBytes
+        self.held -= p.heldBytes
+        p.parseBytes = p.heldBytes = 0
+        self.holding.discard(p)
+        self.backlogged.discard(p)
+
+
+    def connections(self, server):
+        """
+        Returns a ConnectionMemory for the server protocol, if there is 
+        one, and for each client that holds memory. 
+        """
+        for p in [p for p in self.backlogged 
+                  if not transportBytes(p.transport)]:
+            self.backlogged.discard(p)
+        clients = self.holding | self.backlogged
+        clients.discard(server)
+        return ([ConnectionMemory(server, 'server')] if server else []) + [
+            ConnectionMemory(p, p.connectionId) for p in clients]
+
+
+    def totals(self, connections):
+        """
+        Returns the bytes held by all of the connections, by kind, given 
+        what connections() returned. 
+        """
+        t = totals(connections)
+        t['parse'], t['held'] = self.parse, self.held
+        return t
+
+
+
+def totals(connections):
+    """
+    Returns the bytes held by the connections, by kind.
+    """
+    t = {'parse': 0, 'held': 0, 'transport': 0, 'auth': 0}
+    for c in connections:
+        for k in t:
+            t[k] += getattr(c, k)
+    return t
+
+
+def top(connections, n):
+    """
+    Returns the n connections holding the most memory.
+    """
+    return sorted(connections, key=lambda c: -c.total())[:n]
+
+
+
+class SnapshotDiff(object):
+    """
+    Compares each tracemalloc snapshot with the one taken before it.
+    """
+
+    def __init__(self):
+        self.last = None
+
+
+    def available(self):
+        return tracemalloc is not None
+
+
+    def diff(self, limit=20):
+        """
+        Takes a snapshot, and returns the largest changes since the last
+        one as (location, size change, size, count change) tuples. The
+        first call starts tracing and returns nothing.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+        last, self.last = self.last, snapshot
+        if last is None:
+            return []
+        return [(str(s.traceback), s.size_diff, s.size, s.count_diff)
+                for s in snapshot.compare_to(last, 'lineno')[:limit]]
+
+
+# The snapshots compared by SHOW PGPROXY MEMORY DIFF. tracemalloc traces
+# the whole process, so there's one for the process too.
+snapshots = SnapshotDiff()
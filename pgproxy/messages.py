@@ -10,13 +10,21 @@ http://developer.postgresql.org/pgdocs/postgres/protocol-message-formats.html
 
 """
 from fifobuffer import FIFOBuffer
-from data import pack_int32
+from data import pack_int32, pack_int16
 
 
 # constant values
 eight_packed = pack_int32(8)
 five_packed = pack_int32(5)
 
+# The fields of a RowDescription after the column name, for a text column: 
+# table oid, column number, type oid, type size (-1), type modifier (-1), 
+# and format code. 
+text_column = (pack_int32(0) + pack_int16(0) + pack_int32(25) + 
+               pack_int16(0xffff) + pack_int32(0xffffffff) + pack_int16(0))
+
+null_packed = pack_int32(0xffffffff)
+
 
 class Message(object):
     """
@@ -30,6 +38,15 @@ class Message(object):
 
     """
 
+    # The time the proxy received the message from a client, when that's
+    # being measured (see the statements module). 
+    received = None
+
+    # The SQL of the statements executed by the batch that a Sync ends, 
+    # when that's being measured (see the statements module). 
+    executed = ()
+
+
     def __init__(self):
         self.buffer = FIFOBuffer()
         self.parsed_header = False
@@ -291,6 +308,12 @@ def _char_message(t, c, cls):
     return m
 
 
+def _message(t, payload, cls=BackendMessage):
+    m = cls()
+    m.consume('%s%s%s' % (t, pack_int32(len(payload) + 4), payload))
+    return m
+
+
 def query(sql):
     """
     Constructs a new Query message containing the given SQL string.
@@ -326,13 +349,16 @@ def parameterStatus(name, value):
     return m
 
 
-def startup(user):
+def startup(user, database=None):
     """
     Constructs a new Startup message. 
     """
     m = FrontendMessage()
     payload = ('\x00\x03\x00\x00' 
                'user\x00%s\x00' % user)
+    if database:
+        payload += 'database\x00%s\x00' % database
+    payload += '\x00'
     m.consume(pack_int32(len(payload)+4) + payload)
     return m
 
@@ -353,11 +379,16 @@ def terminate():
     return m
 
 
-def errorResponse(*fields):
+def sync():
     """
-    Creates an ErrorResponse message. Fields should be a list of 2-tuples
-    consisting of a single-byte field type and a string. 
+    Constructs a new Sync message. 
     """
+    m = FrontendMessage()
+    m.consume('S\x00\x00\x00\x04')
+    return m
+
+
+def _fields_message(t, fields):
     m = BackendMessage()
     
     # convert fields to strings 
@@ -366,8 +397,99 @@ def errorResponse(*fields):
     # four bytes for the length, one byte plus string length plus \0 for
     # each field, one terminating \0. 
     length = pack_int32(4 + sum([1+1+len(f) for _, f in fields]) + 1)
-    m.consume('E' + length)
+    m.consume(t + length)
     for b, f in fields:
         m.consume(b+f+'\x00')
     m.consume('\x00')
     return m
+
+
+def errorResponse(*fields):
+    """
+    Creates an ErrorResponse message. Fields should be a list of 2-tuples
+    consisting of a single-byte field type and a string. 
+    """
+    return _fields_message('E', fields)
+
+
+def noticeResponse(*fields):
+    """
+    Creates a NoticeResponse message. The fields are the same as those of
+    an ErrorResponse. 
+    """
+    return _fields_message('N', fields)
+
+
+def backendKeyData(pid, key):
+    """
+    Constructs a BackendKeyData message. 
+    """
+    return _message('K', pack_int32(pid) + pack_int32(key))
+
+
+def rowDescription(columns):
+    """
+    Constructs a RowDescription message, describing text columns with the 
+    given names. 
+    """
+    return _message('T', pack_int16(len(columns)) + ''.join(
+            ['%s\x00%s' % (c, text_column) for c in columns]))
+
+
+def dataRow(values):
+    """
+    Constructs a DataRow message holding the given values, which are sent
+    as text. None is sent as NULL. 
+    """
+    fields = [pack_int16(len(values))]
+    for v in values:
+        if v is None:
+            fields.append(null_packed)
+        else:
+            v = str(v)
+            fields.append(pack_int32(len(v)) + v)
+    return _message('D', ''.join(fields))
+
+
+def emptyQueryResponse():
+    """
+    Constructs an EmptyQueryResponse message. 
+    """
+    return _message('I', '')
+
+
+def parseComplete():
+    """
+    Constructs a ParseComplete message. 
+    """
+    return _message('1', '')
+
+
+def bindComplete():
+    """
+    Constructs a BindComplete message. 
+    """
+    return _message('2', '')
+
+
+def closeComplete():
+    """
+    Constructs a CloseComplete message. 
+    """
+    return _message('3', '')
+
+
+def noData():
+    """
+    Constructs a NoData message. 
+    """
+    return _message('n', '')
+
+
+def parameterDescription(types=()):
+    """
+    Constructs a ParameterDescription message for parameters with the
+    given type oids.
+    """
+    return _message('t', pack_int16(len(types)) + ''.join(
+            [pack_int32(t) for t in types]))
@@ -0,0 +1,267 @@
+"""
+Module for serving the proxy's metrics in the Prometheus text format, on
+a port of their own (--metrics-port). The page is rendered from the
+factory's ProxyStats when it is scraped, so nothing is done on the relay
+path beyond updating the counters. The memory is rendered from the
+factory's memory.MemoryAccounts, so a scrape only looks at the connections
+that hold some.
+
+"""
+from twisted.web import resource, server
+import memory
+
+
+
+# The upper bounds of the latency histogram buckets, in seconds.
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+directions = {
+    'F': 'from_client',
+    'B': 'from_server',
+    'f': 'to_client',
+    'b': 'to_server',
+    }
+
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join([
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(labels.items())])
+
+
+class _Page(object):
+
+    def __init__(self):
+        self.lines = []
+
+
+    def metric(self, name, type, help, samples):
+        """
+        Adds a metric, given a list of (labels dict, value) samples.
+        """
+        self.header(name, type, help)
+        for labels, value in samples:
+            self.sample(name, labels, value)
+
+
+    def header(self, name, type, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, type))
+
+
+    def sample(self, name, labels, value):
+        self.lines.append('%s%s %s' % (name, _labels(**labels), value))
+
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+
+def bufferedBytes(accounts):
+    """
+    Returns the number of bytes held in the proxy's buffers: partly
+    received messages, and the messages of clients that are waiting for
+    the server.
+    """
+    return accounts.parse + accounts.held
+
+
+def render(factory):
+    """
+    Returns the metrics page for a PGProxyServerFactory.
+    """
+    stats = factory.stats
+    pg = factory.postgresProtocol
+    page = _Page()
+
+    page.metric('pgproxy_uptime_seconds', 'gauge',
+                'Seconds since the proxy started.',
+                [({}, '%.3f' % stats.snapshot()['uptime'])])
+
+    c = stats.connections
+    page.metric('pgproxy_client_connections', 'gauge',
+                'Client connections that are open.',
+                [({}, c['client_opened'] - c['client_closed'])])
+    page.metric('pgproxy_client_connections_total', 'counter',
+                'Client connections accepted.', [({}, c['client_opened'])])
+    page.metric('pgproxy_client_connections_reaped_total', 'counter',
+                'Client connections closed for going over a limit.',
+                [({}, c['client_reaped'])])
+    page.metric('pgproxy_server_connections_total', 'counter',
+                'Connections made to the server, including reconnects.',
+                [({}, c['backend_opened'])])
+    page.metric('pgproxy_server_up', 'gauge',
+                'Whether the proxy is connected to the server.',
+                [({}, int(pg is not None and not pg.dead))])
+    page.metric('pgproxy_waiting_clients', 'gauge',
+                'Clients whose messages are held until the server is free.',
+                [({}, len(pg.waitingClients) if pg else 0)])
+
+    for name, counts, help in (
+        ('pgproxy_messages_total', stats.messages, 'Messages relayed.'),
+        ('pgproxy_bytes_total', stats.bytes, 'Bytes of messages relayed.')):
+        page.metric(name, 'counter', help, [
+                (dict(direction=directions.get(k[0], k[0]), type=k[1:]), v)
+                for k, v in sorted(counts.items())])
+
+    page.metric('pgproxy_filter_actions_total', 'counter',
+                'Messages dropped, spoofed or translated by the filters.',
+                [(dict(action=k), v) for k, v in sorted(stats.actions.items())])
+
+    name = 'pgproxy_reply_latency_seconds'
+    page.header(name, 'histogram',
+                'Seconds from sending a message to the server until it is '
+                'ready for the next query.')
+    for t, h in sorted(stats.latency.items()):
+        for le in latency_buckets:
+            page.sample(name + '_bucket', dict(type=t, le=le),
+                        h.countAtMost(int(le * 1000000)))
+        page.sample(name + '_bucket', dict(type=t, le='+Inf'), h.count)
+        page.sample(name + '_sum', dict(type=t), '%.6f' % (h.total / 1e6))
+        page.sample(name + '_count', dict(type=t), h.count)
+
+    if factory.timing is not None:
+        page.metric('pgproxy_stage_seconds_total', 'counter',
+                    'Seconds spent in each stage of relaying messages.',
+                    [(dict(stage=stage, direction=directions.get(t[0], t[0]),
+                           type=t[1:]), '%.6f' % seconds)
+                     for (stage, t), (n, seconds) 
+                     in sorted(factory.timing.types.items())])
+
+    accounts = factory.memory
+    connections = accounts.connections(pg)
+    page.metric('pgproxy_buffered_bytes', 'gauge',
+                'Bytes of messages buffered in the proxy.',
+                [({}, bufferedBytes(accounts))])
+    page.metric('pgproxy_memory_bytes', 'gauge',
+                'Bytes held for connections, by what holds them.',
+                [(dict(kind=k), v) 
+                 for k, v in sorted(accounts.totals(connections).items())])
+    page.metric('pgproxy_connection_memory_bytes', 'gauge',
+                'Bytes held for the connections holding the most.',
+                [(dict(connection=c.connection), c.total())
+                 for c in memory.top(connections, 
+                                     factory.config.get('memory-top', 10))])
+
+    if factory.capture:
+        page.metric('pgproxy_capture_dropped_total', 'counter',
+                    'Messages that were not captured because the queue '
+                    'was full.', [({}, factory.capture.dropped)])
+
+    return page.render()
+
+
+
+def _number(value):
+    if '.' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+def aggregate(pages, maxima=('pgproxy_uptime_seconds',)):
+    """
+    Returns one metrics page with the samples of several pages (those of
+    the --workers) added up, except for those named in maxima, of which
+    the largest is kept. The samples of each metric are listed under
+    its first HELP and TYPE lines, in the order they were first seen.
+    """
+    families, headers, samples, values = [], {}, {}, {}
+    for page in pages:
+        family = None
+        for line in page.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                family = line.split(' ', 3)[2]
+                if family not in headers:
+                    families.append(family)
+                    headers[family], samples[family] = [], []
+                if len(headers[family]) < 2:
+                    headers[family].append(line)
+                continue
+
+            key, value = line.rsplit(' ', 1)
+            value = _number(value)
+            if key not in values:
+                samples[family].append(key)
+                values[key] = value
+            elif key.split('{', 1)[0] in maxima:
+                values[key] = max(values[key], value)
+            else:
+                values[key] += value
+
+    lines = []
+    for family in families:
+        lines.extend(headers[family])
+        for key in samples[family]:
+            value = values[key]
+            if isinstance(value, float):
+                value = '%.6f' % value
+            lines.append('%s %s' % (key, value))
+    return '\n'.join(lines) + '\n'
+
+
+
+class AggregateResource(resource.Resource):
+    """
+    The metrics of a workers.Supervisor: its own, and the total of those
+    of its workers.
+    """
+    isLeaf = True
+
+    def __init__(self, supervisor):
+        resource.Resource.__init__(self)
+        self.supervisor = supervisor
+
+
+    def render_GET(self, request):
+        supervisor = self.supervisor
+        page = _Page()
+        page.metric('pgproxy_workers', 'gauge', 'Worker processes running.',
+                    [({}, len(supervisor.workers))])
+        page.metric('pgproxy_worker_restarts_total', 'counter',
+                    'Worker processes restarted after exiting.',
+                    [({}, supervisor.restarted)])
+
+        def scraped(pages):
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            request.write(page.render() + aggregate(pages))
+            request.finish()
+        supervisor.scrape().addCallback(scraped)
+        return server.NOT_DONE_YET
+
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, factory):
+        resource.Resource.__init__(self)
+        self.factory = factory
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return render(self.factory)
+
+
+
+def metricsSite(factory):
+    """
+    Returns a twisted.web site serving the metrics of the factory at any
+    path.
+    """
+    return server.Site(MetricsResource(factory))
+
+
+def aggregateSite(supervisor):
+    """
+    Returns a twisted.web site serving the metrics of a supervisor and 
+    its workers at any path. 
+    """
+    return server.Site(AggregateResource(supervisor))
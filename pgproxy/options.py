@@ -0,0 +1,146 @@
+"""
+Module containing the proxy's own options: the ones pgproxy.twistd adds to
+twistd's. The asyncio engine and the proxies run in process parse them
+with Options, so that they don't import twistd at all. defaults() is what
+an option that's left out is.
+
+"""
+from twisted.python import usage
+
+
+
+optFlags = [
+    ('detect-repeats', '', 
+     'Look for queries repeated many times within a test.'),
+    ('repeat-notice', '', 
+     'Warn clients of repeated queries with a NOTICE.'),
+    ('stage-timing', '', 
+     'Time each stage of relaying messages (see SHOW PGPROXY STAGES).'),
+    ('no-tcp', '', 'Listen only on --listen-unix, not on --listen-port.'),
+    ]
+
+optParameters = [
+    ('listen-port', '', 5433, 'The port to listen on.', int),
+    ('server-host', '', 'localhost', 'The host of the postgres server.'),
+    ('server-port', '', 5432, 'The port of the postgres server.', int),
+    ('record', '', None, 'Record the traffic of each test to a cassette.'),
+    ('replay', '', None, 
+     'Answer queries from a cassette instead of the postgres server.'),
+    ('on-divergence', '', 'fallback', 
+     'When a replay stops matching the cassette: fallback or fail. '
+     'Falling back needs a server that trusts the proxy.'),
+    ('capture', '', None, 'Write a binary capture of all traffic.'),
+    ('capture-queue', '', 10000, 
+     'Messages waiting to be captured before they are dropped.', int),
+    ('metrics-port', '', None, 
+     'Serve metrics in the Prometheus text format on this port.', int),
+    ('report', '', None, 
+     'Write a report of the work done by each test to this file, as '
+     'CSV if it ends in .csv or else JSON.'),
+    ('repeat-run', '', 10, 
+     'Flag a query repeated this many times in a row in a test.', int),
+    ('repeat-count', '', 50, 
+     'Flag a query run this many times in all in a test.', int),
+    ('statements', '', None, 
+     'Keep statistics of up to this many query fingerprints.', int),
+    ('statements-file', '', None, 
+     'Write the statement statistics to this file, as CSV if it ends '
+     'in .csv or else JSON.'),
+    ('profile-dir', '', None, 
+     'The directory profiles are written to. The default is the '
+     'temporary directory.'),
+    ('profile-limit', '', 60, 
+     'Seconds after which a profile stops by itself.', float),
+    ('memory-top', '', 10, 
+     'The number of connections whose memory is shown in the metrics.',
+     int),
+    ('high-water', '', 1 << 20, 
+     'Stop reading from a connection while more than this many bytes '
+     '(at least 64KB) wait to be written to its peer. 0 turns this '
+     'off.', int),
+    ('low-water', '', 1 << 18, 
+     'Resume reading once this many bytes or fewer wait.', int),
+    ('idle-timeout', '', None, 
+     'Disconnect clients idle for this many seconds.', float),
+    ('idle-in-transaction-timeout', '', None, 
+     'Disconnect clients idle for this many seconds with a '
+     'transaction open.', float),
+    ('max-client-buffer', '', None, 
+     'Disconnect clients with more than this many bytes waiting to be '
+     'read by them.', int),
+    ('max-message-size', '', None, 
+     'Disconnect clients that send a message larger than this many '
+     'bytes.', int),
+    ('budget-action', '', 'fail', 
+     'When a test goes over its budget: fail or report.'),
+    ('workers', '', None, 
+     'Run this many proxy processes, sharing the listening port. Each '
+     'has its own connection to the server (see pgproxy.workers).', int),
+    ('worker', '', None, 
+     'The index of this process among the --workers. Set by the '
+     'process that starts them.', int),
+    ('ready-fd', '', None, 
+     'Write the port to this file descriptor, and close it, once '
+     'listening (see pgproxy.ready).', int),
+    ('listen-unix', '', None, 
+     'Also listen on a Unix socket in this directory, named '
+     '.s.PGSQL.<listen-port> as libpq expects, or at this path if it is '
+     'named that way (see pgproxy.unix).'),
+    ('server-unix', '', None, 
+     'Connect to the postgres server by its Unix socket in this '
+     'directory, or at this path, rather than by TCP.'),
+    ]
+
+
+
+def validate(config):
+    """
+    Raises usage.UsageError if the options in config don't make sense
+    together.
+    """
+    if config['on-divergence'] not in ('fallback', 'fail'):
+        raise usage.UsageError(
+            '--on-divergence must be either fallback or fail.')
+    if config['budget-action'] not in ('fail', 'report'):
+        raise usage.UsageError(
+            '--budget-action must be either fail or report.')
+    if config['no-tcp'] and not config['listen-unix']:
+        raise usage.UsageError('--no-tcp needs --listen-unix.')
+    if config['listen-unix']:
+        from unix import isDirectory
+        if config['workers'] is not None:
+            raise usage.UsageError(
+                '--listen-unix can not be used with --workers.')
+        if isDirectory(config['listen-unix']) and not config['listen-port']:
+            raise usage.UsageError(
+                '--listen-unix needs a --listen-port other than 0 to name '
+                'the socket.')
+    if config['workers'] is not None:
+        from workers import SO_REUSEPORT
+        if config['workers'] < 1:
+            raise usage.UsageError('--workers must be at least 1.')
+        if not config['listen-port']:
+            raise usage.UsageError(
+                '--workers needs a --listen-port other than 0.')
+        if SO_REUSEPORT is None:
+            raise usage.UsageError(
+                '--workers needs SO_REUSEPORT, which this platform '
+                'lacks.')
+
+
+def defaults():
+    """
+    Returns a dict of the default value of each option.
+    """
+    return dict([(p[0], p[2]) for p in optParameters] + 
+                [(f[0], False) for f in optFlags])
+
+
+
+class Options(usage.Options):
+    optFlags = optFlags
+    optParameters = optParameters
+
+
+    def postOptions(self):
+        validate(self)
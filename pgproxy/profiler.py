@@ -0,0 +1,135 @@
+"""
+Module for profiling the running proxy, started and stopped with the
+admin statements PGPROXY PROFILE START and PGPROXY PROFILE STOP (see the
+admin module), so that it can be profiled under the load it really gets.
+
+There are two profilers:
+
+    sample    - A thread that samples the reactor thread's stack every few
+                milliseconds. It costs the proxy little, and writes the
+                stacks in the collapsed format of flame graph tools: one
+                line per distinct stack, root first, with its count.
+    cprofile  - cProfile, on the reactor thread. It's exact but slows the
+                proxy down, and writes a pstats file.
+
+A profile stops by itself after --profile-limit seconds, in case it's
+forgotten.
+
+"""
+from __future__ import with_statement
+from collections import defaultdict
+import os
+import sys
+import threading
+import time
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+
+
+class StackSampler(object):
+    """
+    Samples the stack of the thread that starts it, from a thread of its
+    own, every interval seconds.
+    """
+
+    suffix = '.folded'
+
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        target = get_ident()
+        self._thread = threading.Thread(target=self._run, args=(target,),
+                                        name='pgproxy-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self, target):
+        while not self._stopped.isSet():
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                break
+            self.stacks[self.collapse(frame)] += 1
+            self.samples += 1
+            frame = None
+            self._stopped.wait(self.interval)
+
+
+    def collapse(self, frame):
+        """
+        Returns the stack leading to frame, as 'file:function' entries
+        separated by semicolons, root first.
+        """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                    code.co_name))
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, n))
+
+
+
+class CProfiler(object):
+    """
+    Runs cProfile on the thread that starts it.
+    """
+
+    suffix = '.pstats'
+
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.samples = None
+
+
+    def start(self):
+        self.profile.enable()
+
+
+    def stop(self):
+        self.profile.disable()
+
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+
+profilers = {
+    'sample': StackSampler,
+    'cprofile': CProfiler,
+    }
+
+
+def profilePath(directory, profiler):
+    """
+    Returns a new path in directory for the output of a profiler.
+    """
+    return os.path.join(directory, 'pgproxy-%d-%s%s' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S'), profiler.suffix))
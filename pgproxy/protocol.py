@@ -15,6 +15,7 @@ from __future__ import with_statement
 from twisted.internet import protocol
 from twisted.internet.defer import DeferredList
 from twisted.python import log
+from timing import clock
 
 
 
@@ -38,12 +39,30 @@ class MessageProtocol(protocol.Protocol):
     # method, outlined above. 
     messageType = None
 
+    # A timing.StageTimes that the time spent in each stage of handling 
+    # messages is added to, if they're being timed. Only FilteringProtocols
+    # are timed. 
+    timing = None
+
+    # What timed calls are scheduled with, if not the Twisted reactor: an 
+    # aio.LoopClock when the protocol runs on asyncio (see the aio module). 
+    clock = None
+
+    # The state of each connection starts out as these class attributes, 
+    # and only gets an instance attribute of its own when it changes, so 
+    # that an idle connection costs as little memory as possible. 
+
+    # This field stores an incomplete message while it is being
+    # constructed.
+    _message = None
+
+    # The time spent parsing the incomplete message so far. 
+    _parseTime = 0.0
+
 
     def __init__(self):
-        # This field stores an incomplete message while it is being
-        # constructed.
-        self._message = None
-        self._queue = []
+        # Nothing is allocated until the connection needs it; see above. 
+        pass
 
 
     def dataReceived(self, data):
@@ -51,18 +70,30 @@ class MessageProtocol(protocol.Protocol):
         Parses as many messages as possible with the given data, resuming
         the previous message if there was one.
         """
+        timing = self.timing
+        queue = []
         while 1:
             m = self._message or self.messageType()
-            done, extra = m.consume(data)
+            if timing is None:
+                done, extra = m.consume(data)
+            else:
+                start = clock()
+                done, extra = m.consume(data)
+                self._parseTime += clock() - start
 
             if done:
+                if timing is not None:
+                    timing.add('parse', self.direction + m.type, 
+                               self.captureClientId(), self._parseTime)
+                    self._parseTime = 0.0
+
                 # Discard the previous message, if there was one. This 
                 # prevents an infinite loop. 
                 self._message = None
 
                 # Entire message was contained in the data, raise
                 # the notification. 
-                self._queue.append(m)
+                queue.append(m)
                 if extra:
                     data = extra
                 else:
@@ -71,28 +102,24 @@ class MessageProtocol(protocol.Protocol):
                 # More data is necessary to complete this message.
                 self._message = m
                 break
-        return self._receive()
+        return self._receive(queue)
 
 
-    def _receive(self):
+    def _receive(self, queue):
         """
-        Processes all of the messages currently in the receive queue. 
+        Processes the messages parsed from the data received. 
         """
-        log.msg('recv %s' % ''.join(map(str, self._queue)))
+        log.msg('recv %s' % ''.join(map(str, queue)))
         ds = []
-        try:
-            for x in self._queue:
-                ds.append(self.messageReceived(x))
+        for x in queue:
+            ds.append(self.messageReceived(x))
 
-            # Only return deferred if necessary. If we return deferred
-            # from, for example, a Startup message, the client will disconnect
-            # as it expects us to read its entire message. 
-            ds = [d for d in ds if d]
-            if ds:
-                return DeferredList(ds)
-
-        finally:
-            self._queue = []
+        # Only return deferred if necessary. If we return deferred
+        # from, for example, a Startup message, the client will disconnect
+        # as it expects us to read its entire message. 
+        ds = [d for d in ds if d]
+        if ds:
+            return DeferredList(ds)
 
 
     def messageReceived(self, message):
@@ -111,6 +138,7 @@ class MessageProtocol(protocol.Protocol):
     
     def discardMessage(self):
         self._message = None
+        self._parseTime = 0.0
 
 
 
@@ -118,6 +146,28 @@ class MessageProtocol(protocol.Protocol):
 class FilteringProtocol(MessageProtocol):
     filterType = None
 
+    # The direction code used when capturing the messages received by 
+    # this protocol. Messages written to it are captured with the lower 
+    # case version. See the capture module. 
+    direction = None
+
+    # A capture.CaptureWriter, if the traffic is being captured. 
+    capture = None
+
+    # The stats.ProxyStats that the traffic is counted in, if any. 
+    stats = None
+
+    # The memory.MemoryAccounts that the bytes held for the connection are 
+    # counted in, if any, and the bytes counted there. 
+    memory = None
+    parseBytes = 0
+    heldBytes = 0
+
+
+    # The reasons that reading from the transport is paused for. The set 
+    # is only made when it's first paused. 
+    pausedFor = frozenset()
+
 
     def __init__(self):
         self.filter = self.filterType(self)
@@ -125,6 +175,40 @@ class FilteringProtocol(MessageProtocol):
         MessageProtocol.__init__(self)
 
 
+    def dataReceived(self, data):
+        d = MessageProtocol.dataReceived(self, data)
+        if self.memory is not None:
+            m = self._message
+            n = m is not None and len(m.buffer) or 0
+            if n != self.parseBytes:
+                self.memory.setParse(self, n)
+        return d
+
+
+    def discardMessage(self):
+        MessageProtocol.discardMessage(self)
+        if self.parseBytes:
+            self.memory.setParse(self, 0)
+
+
+    def pauseReading(self, reason):
+        """
+        Stops reading from the transport until resumeReading is called 
+        with the same reason, and with every other reason it was paused for.
+        """
+        if not self.pausedFor:
+            self.transport.pauseProducing()
+            self.pausedFor = set()
+        self.pausedFor.add(reason)
+
+
+    def resumeReading(self, reason):
+        if reason in self.pausedFor:
+            self.pausedFor.remove(reason)
+            if not self.pausedFor:
+                self.transport.resumeProducing()
+
+
     def getPeer(self):
         """
         Gets the companion protocol, that receives the filtered
@@ -133,26 +217,72 @@ class FilteringProtocol(MessageProtocol):
         pass
 
 
+    def captureClientId(self):
+        """
+        Returns the id of the client connection that the traffic through 
+        this protocol belongs to. 
+        """
+        return 0
+
+
+    def captureTestName(self):
+        """
+        Returns the name of the test currently running, if any. 
+        """
+        return None
+
+
+    def captureMessages(self, direction, messages):
+        """
+        Adds the messages to the capture. 
+        """
+        self.capture.record(direction, self.captureClientId(), 
+                            self.captureTestName(), messages)
+
+
     def writePeer(self, messages):
         """
         Serializes and writes the message to the peer. 
         """
         p = self.getPeer()
         if p:        
+            if self.capture:
+                self.captureMessages(p.direction.lower(), messages)
+            if self.stats:
+                self.stats.countMessages(p.direction.lower(), messages)
+            if self.timing is None:
+                data = ''.join([m.serialize() for m in messages])
+                return p.transport.write(data)
+
+            start = clock()
             data = ''.join([m.serialize() for m in messages])
-            return p.transport.write(data)
+            r = p.transport.write(data)
+            self.timing.add('write', p.direction.lower() + messages[0].type, 
+                            self.captureClientId(), clock() - start)
+            return r
         log.msg('Dropping message(s): %s, peer disconnected.' % 
-                ' '.join(messages))
+                ' '.join(map(str, messages)))
     
 
     def messageReceived(self, msg):
+        if self.capture:
+            self.captureMessages(self.direction, [msg])
+        if self.stats:
+            self.stats.countMessages(self.direction, [msg])
+
         # cases - 
         #   just write the message 
         #   write a different set of messages
         #   don't write the message
         #   write a different set of messages, process those replies, 
         #      then write a response (either spoofed or geniune)
-        m, cb = self.filterMessage(msg)
+        if self.timing is None:
+            m, cb = self.filterMessage(msg)
+        else:
+            start = clock()
+            m, cb = self.filterMessage(msg)
+            self.timing.add('filter', self.direction + msg.type, 
+                            self.captureClientId(), clock() - start)
 
         messages = [m] if hasattr(m, 'serialize') else m
         if not messages:
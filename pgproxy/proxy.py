@@ -8,16 +8,25 @@ protocol is created as needed by the client factory.
 
 The single postgres backend protocol maintains a list of its clients,
 and designates one of them as the active connection, which will 
-receive the replies. 
+receive the replies. While the server is answering one client, the 
+messages of the others are held until it is done. 
 
 """
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import reactor, defer, protocol, task
 from twisted.python import log
 from protocol import FilteringProtocol
 from messages import FrontendMessage, BackendMessage
 from filters import FrontendFilter, BackendFilter
+from writeset import WriteSetIndex
+from stats import ProxyStats
+from memory import transportBytes, MemoryAccounts
+from registry import ClientRegistry
 from itertools import count
+from collections import deque
 import messages
+import os
+import tempfile
+import time
 
 
 
@@ -26,10 +35,33 @@ class PostgresClientProtocol(FilteringProtocol):
 
     messageType = BackendMessage
     filterType = BackendFilter
+    direction = 'B'
     dead = False
     in_test = False
     transactionStatus = None
 
+    # The name of the most recently started test, and whether that test
+    # commits its data instead of running inside of a transaction.
+    testName = None
+    committedTest = False
+
+    # The client whose messages the server is answering, and the number of 
+    # ReadyForQuery replies that it is still owed. 
+    owner = None
+    pendingReplies = 0
+
+    # True while the owner has sent extended query messages that no Sync 
+    # has closed yet. 
+    openBatch = False
+
+    # Replies still owed to an owner that disconnected. They are dropped. 
+    droppedReplies = 0
+
+    # The budget.Budget of the running test, if it has one, and what to do 
+    # when a test goes over it: fail or report. 
+    budget = None
+    budgetAction = 'fail'
+
 
     def __init__(self):
         FilteringProtocol.__init__(self)
@@ -38,13 +70,30 @@ class PostgresClientProtocol(FilteringProtocol):
         # automatically designate the next one in the list as the active. 
         # However, queries can be received from clients in any order. When a 
         # frontend recieves a query, it will call this instance back so that 
-        # we know to send it the reply. 
-        self.clientStack = []
+        # we know to send it the reply. It's a registry.ClientRegistry, 
+        # which moves and removes clients in constant time, since there 
+        # can be very many of them. 
+        self.clientStack = ClientRegistry()
 
         # The first set of authentication response messages (between the
         # AuthenticationOk/R and the ReadyForQuery/Z) are saved here. 
         self.authenticationResponse = []
 
+        # The tables written to by each test, used to reset committed tests.
+        self.writeSets = WriteSetIndex()
+
+        # Clients with messages held until the owner's replies are done, 
+        # in the order they arrived. 
+        self.waitingClients = ClientRegistry()
+
+        # What's to be done once the server is free, before the waiting 
+        # clients go on. 
+        self.whenFree = deque()
+
+        # The messages owed ReadyForQuery replies, when they were sent and
+        # the test they were sent in, for the stats. 
+        self.sentAt = deque()
+
 
     def setTransactionStatus(self, status):
         self.transactionStatus = status
@@ -56,22 +105,49 @@ class PostgresClientProtocol(FilteringProtocol):
 
     def connectionLost(self, *a):
         log.msg('PostgresClientProtocol connection lost.')
+        if self.memory is not None:
+            self.memory.forget(self)
         self.pgproxyFactory.postgresClientLost()
         self.dead = True
 
 
-    def signalTest(self, value):
+    def signalTest(self, value, name=None, committed=False):
         """
         Called to start or end a test. Inside tests, BEGIN/(ROLLBACK|COMMIT) 
         pairs are rewritten to use savepoints.        
+
+        Committed tests are not run inside of a transaction, so they are 
+        not considered to be in a test for the purposes of the rewriting. 
+        The tables they write to are reset when they end instead. 
         """
-        self.in_test = value
+        self.in_test = value and not committed
+        self.committedTest = value and committed
+        if name is not None:
+            self.testName = name
 
 
     def inTest(self):
         return self.in_test
 
 
+    def activeTest(self):
+        """
+        Returns the name of the test that is running, whether or not it is
+        a committed test. Returns None between tests.
+        """
+        if self.in_test or self.committedTest:
+            return self.testName
+        return None
+
+
+    def captureClientId(self):
+        c = self.getPeer()
+        return c.connectionId if c else 0
+
+
+    captureTestName = activeTest
+
+
     def attachClient(self, client):
         """
         Adds a new client to the list. 
@@ -91,28 +167,138 @@ class PostgresClientProtocol(FilteringProtocol):
         if self.parsingMessage:
             self.discardMessage()
         self.clientStack.remove(client)
+        self.waitingClients.discard(client)
+        if (not self.clientStack and self.stats and 
+            self.stats.repeats is not None):
+            # nobody is left to end the test. 
+            self.stats.repeats.clear()
+        if client is self.owner:
+            # The server will still answer the messages it was sent, but 
+            # nobody is left to read the replies. They're dropped as they 
+            # arrive, and the next client's replies follow them. A batch 
+            # the client left open is closed, so that the next client's 
+            # messages aren't taken as part of it. 
+            if self.openBatch:
+                self.transport.write(messages.sync().serialize())
+                self.pendingReplies += 1
+                self.openBatch = False
+            self.droppedReplies += self.pendingReplies
+            self.pendingReplies = 0
+            self.releaseOwner()
+
+
+    def expectReplies(self, client, messages):
+        """
+        Called as a client's messages are written to the server. The 
+        server belongs to the client until it has sent a ReadyForQuery 
+        reply for each of the messages that are answered with one (see 
+        PGProxyProtocol.syncTypes). It also belongs to the client from the 
+        first message of an extended query batch, like a Parse, until the 
+        Sync that ends the batch has been answered, so that no other 
+        client's messages are sent in the middle of it. 
+        """
+        synced = []
+        for m in messages:
+            if m.type in client.syncTypes:
+                synced.append(m)
+                self.openBatch = False
+            elif m.type in client.batchTypes:
+                self.openBatch = True
+        self.pendingReplies += len(synced)
+        if self.pendingReplies or self.openBatch:
+            self.owner = client
+        if self.stats and synced:
+            now, test = time.time(), self.activeTest()
+            self.sentAt.extend([(m, now, test) for m in synced])
+
+
+    def busyFor(self, client):
+        """
+        Returns true if the server is answering a different client. 
+        """
+        return self.owner is not None and self.owner is not client
+
+
+    def messageReceived(self, msg):
+        stats = self.stats
+        if stats and (stats.tests is not None or 
+                      stats.statements is not None):
+            stats.recordResult(msg, self.activeTest())
+        if self.budget is not None and msg.type == 'D':
+            self.budget.rows += 1
+
+        d = FilteringProtocol.messageReceived(self, msg)
+        if msg.type == 'Z' and (self.pendingReplies or self.droppedReplies):
+            if self.sentAt:
+                m, sent, test = self.sentAt.popleft()
+                now = time.time()
+                stats.recordReply(m, now - sent, test)
+                if self.budget is not None and test == self.budget.test:
+                    self.budget.seconds += now - sent
+                if self.timing is not None:
+                    self.timing.add('wait', 'F' + m.type, 
+                                    self.captureClientId(), now - sent)
+                if stats.statements is not None:
+                    # the client's wait started when the proxy received
+                    # the message, not when it was sent on. 
+                    stats.statements.recordReply(m, now - (m.received or sent))
+            if self.droppedReplies:
+                self.droppedReplies -= 1
+            else:
+                self.pendingReplies -= 1
+                if not self.pendingReplies and not self.openBatch:
+                    self.releaseOwner()
+        return d
+
+
+    def releaseOwner(self):
+        """
+        Lets the waiting clients send their messages, in the order that 
+        they arrived, until one of them owns the server. 
+        """
+        self.owner = None
+        while self.whenFree and self.owner is None:
+            self.whenFree.popleft()()
+        while self.waitingClients and self.owner is None:
+            self.waitingClients.popleft().resumeMessages()
+
+
+    def callWhenFree(self, f):
+        """
+        Calls f now if no client owns the server, and otherwise once the 
+        owner's replies are done. 
+        """
+        if self.owner is None:
+            f()
+        else:
+            self.whenFree.append(f)
 
 
     def activateClient(self, client):
         """
         Activates a client that is already attached. 
         """
-        if client == self.currentClient():
-            return
-        self.clientStack.remove(client)
-        self.clientStack.append(client)
+        self.clientStack.moveToEnd(client)
 
 
     def currentClient(self):
         """
         Returns the current client (the one that will receive reply messages). 
         """
-        if not self.clientStack:
-            return None
-        return self.clientStack[-1]
+        return self.clientStack.last()
 
 
-    getPeer = currentClient
+    def getPeer(self):
+        """
+        Returns the client that receives the server's replies: the one 
+        whose messages are being answered, or the current client. There 
+        is none while replies owed to a disconnected owner arrive. 
+        """
+        if self.droppedReplies:
+            return None
+        if self.owner is not None:
+            return self.owner
+        return self.currentClient()
 
 
     def saveAuthMessage(self, msg):
@@ -187,19 +373,42 @@ class PGProxyProtocol(FilteringProtocol):
 
     messageType = FrontendMessage
     filterType = FrontendFilter
+    direction = 'F'
 
+    # A number identifying this client connection, assigned by the factory. 
+    connectionId = 0
 
-    def __init__(self):
-        FilteringProtocol.__init__(self)
-        self.postgresProtocol = None
+    # Messages that the server answers with a ReadyForQuery. 
+    syncTypes = ('Q', 'S', 'Startup')
+
+    # Extended query messages, which the server doesn't answer with a 
+    # ReadyForQuery until a Sync follows them: Parse, Bind, Describe, 
+    # Execute, Close and Flush. 
+    batchTypes = ('P', 'B', 'D', 'E', 'C', 'H')
+
+    # The largest message accepted from the client, if there's a limit. 
+    maxMessageSize = None
+
+    # When a message was last received from the client. 
+    lastReceived = 0
+
+    # True once the client has been disconnected for going over a limit. 
+    reaped = False
 
+    # The server connection this client is attached to. 
+    postgresProtocol = None
 
-    def signalTest(self, value):
+    # Messages received while the server was answering another client. 
+    # The list is only made when there are some. 
+    heldMessages = ()
+
+
+    def signalTest(self, value, name=None, committed=False):
         """
         Called to set the current testing state. This determines whether
         or not BEGINs/ROLLBACKs are rewritten to SAVEPOINTs.
         """
-        self.postgresProtocol.signalTest(value)
+        self.postgresProtocol.signalTest(value, name, committed)
 
     
     def inTest(self):
@@ -211,29 +420,217 @@ class PGProxyProtocol(FilteringProtocol):
 
     def connectionMade(self):
         log.msg('PGProxyProtocol connection made.')
+        self.factory.limitWrites(self)
         return self.factory.attachPostgresProtocol(self)
 
 
     def connectionLost(self, reason=protocol.connectionDone):
         log.msg('PGProxyProtocol connection lost')
+        if self.stats:
+            self.stats.countConnection('client_closed')
+        if self.timing:
+            self.timing.forget(self.connectionId)
         if self.postgresProtocol:
-            #  HACK: Rollback savepoints on disconnect
-            if self == self.postgresProtocol.currentClient():
+            #  HACK: Rollback savepoints on disconnect. A reaped client's 
+            #  were taken care of by reap. 
+            if (not self.reaped and 
+                self == self.postgresProtocol.currentClient()):
                 self.filter.cleanUpSavepoints()
             self.postgresProtocol.detachClient(self)
+        if self.memory is not None:
+            self.memory.forget(self)
 
 
     def getPeer(self):
         return self.postgresProtocol
 
 
+    def captureClientId(self):
+        return self.connectionId
+
+
+    def captureTestName(self):
+        if self.postgresProtocol:
+            return self.postgresProtocol.activeTest()
+        return None
+
+
+    def dataReceived(self, data):
+        if self.reaped:
+            return
+        d = FilteringProtocol.dataReceived(self, data)
+        m = self._message
+        # a message over the limit is refused before it's all buffered. 
+        if (self.maxMessageSize and m is not None and not self.reaped and 
+            m.length > self.maxMessageSize):
+            self.reap('message of %d bytes is over the limit of %d' % 
+                      (m.length, self.maxMessageSize), '54000')
+        return d
+
+
     def messageReceived(self, msg):
+        if self.reaped:
+            return
+        self.lastReceived = time.time()
+        if self.maxMessageSize and msg.length > self.maxMessageSize:
+            return self.reap('message of %d bytes is over the limit of %d' % 
+                             (msg.length, self.maxMessageSize), '54000')
+        if (msg.received is None and self.stats and 
+            self.stats.statements is not None):
+            msg.received = time.time()
+
+        pg = self.postgresProtocol
+        if self.heldMessages or pg.busyFor(self):
+            # Another client's messages are being answered. Stop reading 
+            # from this one until they're done. 
+            if not self.heldMessages:
+                self.pauseReading('held')
+                pg.waitingClients.append(self)
+                self.heldMessages = []
+            self.heldMessages.append(msg)
+            if self.memory is not None:
+                self.memory.addHeld(self, msg.length)
+            return
+
         # tell the postgres protocol to mark this one as the active, 
         # because it will need to see the reply for this message. 
-        self.postgresProtocol.activateClient(self)
+        pg.activateClient(self)
         return FilteringProtocol.messageReceived(self, msg)
 
 
+    def resumeMessages(self):
+        """
+        Handles the messages that were held while another client owned 
+        the server. 
+        """
+        held = self.dropHeldMessages()
+        self.resumeReading('held')
+        for msg in held:
+            self.messageReceived(msg)
+
+
+    def dropHeldMessages(self):
+        """
+        Returns the held messages, and holds no more. 
+        """
+        held, self.heldMessages = self.heldMessages, ()
+        if self.heldBytes:
+            self.memory.addHeld(self, -self.heldBytes)
+        return held
+
+
+    def reap(self, why, code):
+        """
+        Disconnects the client for going over one of the limits, with a 
+        fatal ErrorResponse saying why. The savepoints it left open are 
+        rolled back now if the server is free, and otherwise once the 
+        client that owns it is done. 
+        """
+        log.msg('Reaping client %s: %s' % (self.connectionId, why))
+        self.reaped = True
+        if self.stats:
+            self.stats.countConnection('client_reaped')
+        self.transport.write(messages.errorResponse(
+                ('S', 'FATAL'), ('C', code), 
+                ('M', 'pgproxy: %s' % why)).serialize())
+
+        pg = self.postgresProtocol
+        if pg and self.filter.savepoints:
+            pg.callWhenFree(self.cleanUpSavepoints)
+
+        self.dropHeldMessages()
+        self.discardMessage()
+        if code == '53000':
+            # it isn't reading, so the error can't be flushed. 
+            getattr(self.transport, 'abortConnection', 
+                    self.transport.loseConnection)()
+        else:
+            self.transport.loseConnection()
+
+
+    def cleanUpSavepoints(self):
+        """
+        Rolls back the savepoints the client left open, ignoring the 
+        replies. 
+        """
+        pg = self.postgresProtocol
+        if self in pg.clientStack:
+            pg.activateClient(self)
+        self.filter.cleanUpSavepoints()
+
+
+    def writePeer(self, messages):
+        pg = self.postgresProtocol
+        if pg:
+            pg.expectReplies(self, messages)
+        return FilteringProtocol.writePeer(self, messages)
+
+
+
+class WriteBufferProducer(object):
+    """
+    The producer registered with the transport of a protocol. When more 
+    than highWater bytes are waiting in the transport's write buffer, the 
+    protocol's peer isn't read from until the buffer is down to lowWater 
+    bytes. That way a slow reader holds up its writer, instead of the 
+    proxy buffering everything in between. 
+
+    The transport asks its producer to pause on every write while its 
+    buffer is past its bufferSize (64KB), which is also the size of its 
+    reads, so the high-water mark is checked here instead of by changing 
+    that. It only resumes its producer when the buffer is empty, so while 
+    the peer is paused the buffer is checked every pollInterval seconds. 
+    Being asked to pause is also how the protocol's memory.MemoryAccounts 
+    learns that the transport is backlogged. 
+    """
+
+    pollInterval = 0.01
+
+
+    def __init__(self, protocol, highWater, lowWater):
+        self.protocol = protocol
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.pausedPeer = None
+        self.poll = None
+
+
+    def pauseProducing(self):
+        memory = self.protocol.memory
+        if memory is not None:
+            memory.backlog(self.protocol)
+        if self.pausedPeer is not None or not self.highWater:
+            return
+        if transportBytes(self.protocol.transport) <= self.highWater:
+            return
+        peer = self.protocol.getPeer()
+        if peer is None:
+            return
+        self.pausedPeer = peer
+        peer.pauseReading(self)
+        self.poll = reactor.callLater(self.pollInterval, self.check)
+
+
+    def check(self):
+        self.poll = None
+        if transportBytes(self.protocol.transport) <= self.lowWater:
+            self.resumeProducing()
+        else:
+            self.poll = reactor.callLater(self.pollInterval, self.check)
+
+
+    def resumeProducing(self):
+        peer, self.pausedPeer = self.pausedPeer, None
+        if self.poll is not None:
+            self.poll.cancel()
+            self.poll = None
+        if peer is not None:
+            peer.resumeReading(self)
+
+
+    stopProducing = resumeProducing
+
+
 
 class PGProxyServerFactory(protocol.ServerFactory):
     """
@@ -250,19 +647,219 @@ class PGProxyServerFactory(protocol.ServerFactory):
     # created. 
     creatingPostgresProtocol = None
 
+    # How often, in seconds, clients are checked against the limits on 
+    # idle time and buffered bytes, if there are any. 
+    reapInterval = 1.0
+
+    # The LoopingCall that checks them. 
+    reaper = None
+
+    # What timed calls are scheduled with, if not the Twisted reactor (see 
+    # the aio module). 
+    clock = None
+
     
     def __init__(self, pgproxy):
         self.pgproxy = pgproxy
+        self.config = pgproxy.config
         self.postgresProtocol = None
 
         # Give postgres clients access to this factory
         PostgresClientProtocol.pgproxyFactory = self
 
+        # The cassettes being recorded to or replayed from, if any. 
+        self.recording = self.replaying = None
+        if self.config.get('record'):
+            self.recording = self.loadCassette(self.config['record'])
+        if self.config.get('replay'):
+            self.replaying = self.loadCassette(self.config['replay'])
+
+        # Workers number their clients apart, so the ids are unique across 
+        # all of them. 
+        worker = self.config.get('worker')
+        if worker is None:
+            self.connectionIds = count(1)
+        else:
+            self.connectionIds = count(1 + worker, self.config['workers'])
+        self.stats = ProxyStats()
+        self.memory = MemoryAccounts()
+        if self.config.get('report'):
+            from report import TestReport
+            self.stats.tests = TestReport()
+        if self.config.get('detect-repeats'):
+            from repeats import RepeatDetector
+            self.stats.repeats = RepeatDetector(
+                self.config.get('repeat-run', 10), 
+                self.config.get('repeat-count', 50),
+                bool(self.config.get('repeat-notice')))
+        if self.config.get('statements'):
+            from statements import StatementTable
+            self.stats.statements = StatementTable(self.config['statements'])
+        # The profiler.StackSampler or CProfiler that is running, if any, 
+        # and the call that stops it at the --profile-limit. 
+        self.profiler = None
+        self.profileLimit = None
+
+        self.timing = None
+        if self.config.get('stage-timing'):
+            from timing import StageTimes
+            self.timing = StageTimes()
+        self.capture = None
+        if self.config.get('capture'):
+            from capture import CaptureWriter
+            self.capture = CaptureWriter(
+                self.config['capture'], self.config.get('capture-queue', 10000))
+
+
+    def buildProtocol(self, addr):
+        p = protocol.ServerFactory.buildProtocol(self, addr)
+        p.connectionId = self.connectionIds.next()
+        p.maxMessageSize = self.config.get('max-message-size')
+        p.lastReceived = time.time()
+        p.capture = self.capture
+        p.stats = self.stats
+        p.timing = self.timing
+        p.memory = self.memory
+        self.stats.countConnection('client_opened')
+        return p
+
+
+    def loadCassette(self, path):
+        from cassette import Cassette
+        if os.path.exists(path):
+            return Cassette.load(path)
+        return Cassette()
+
+
+    def startFactory(self):
+        self.reaper = None
+        if (self.config.get('idle-timeout') or 
+            self.config.get('idle-in-transaction-timeout') or 
+            self.config.get('max-client-buffer')):
+            self.reaper = task.LoopingCall(self.reapClients)
+            self.reaper.clock = self.clock or reactor
+            self.reaper.start(self.reapInterval, 
+                              now=False)
+
 
     def stopFactory(self):
+        if self.reaper is not None:
+            self.reaper.stop()
         if self.postgresProtocol:
             log.msg('Sending terminate to postgres.')
             self.postgresProtocol.terminate()
+        if self.recording:
+            log.msg('Saving cassette: %s' % self.config['record'])
+            self.recording.save(self.config['record'])
+        if self.capture:
+            log.msg('Closing capture, %d messages dropped.' % 
+                    self.capture.dropped)
+            self.capture.close()
+        if self.profiler is not None:
+            self.stopProfile()
+        log.msg('Proxy stats: %r' % (self.stats.snapshot(),))
+        if self.stats.tests is not None:
+            self.writeReport()
+        if self.stats.statements is not None and self.config.get(
+            'statements-file'):
+            self.writeStatements()
+
+
+    def writeReport(self):
+        """
+        Writes the per-test report to the path given by --report. 
+        """
+        path = self.config['report']
+        log.msg('Writing test report: %s' % path)
+        self.stats.tests.write(path)
+        return path
+
+
+    def startProfile(self, mode):
+        """
+        Starts profiling the proxy, with the profiler of the given mode 
+        (sample or cprofile). It stops after --profile-limit seconds. 
+        """
+        from profiler import profilers
+        self.profiler = profilers[mode]()
+        self.profiler.start()
+        self.profileLimit = (self.clock or reactor).callLater(
+            self.config.get('profile-limit', 60), self.stopProfile)
+        log.msg('Started %s profile.' % mode)
+
+
+    def stopProfile(self):
+        """
+        Stops the running profile and writes it to the --profile-dir. 
+        Returns the path it was written to. 
+        """
+        from profiler import profilePath
+        p, self.profiler = self.profiler, None
+        if self.profileLimit.active():
+            self.profileLimit.cancel()
+        p.stop()
+        path = profilePath(
+            self.config.get('profile-dir') or tempfile.gettempdir(), p)
+        log.msg('Writing profile: %s' % path)
+        p.write(path)
+        return path
+
+
+    def writeStatements(self):
+        """
+        Writes the statement statistics to the path given by 
+        --statements-file. 
+        """
+        path = self.config['statements-file']
+        log.msg('Writing statement statistics: %s' % path)
+        self.stats.statements.write(path)
+        return path
+
+
+    def reapClients(self):
+        """
+        Disconnects the clients that are over the limits: those that have 
+        been idle for longer than --idle-timeout, or for longer than 
+        --idle-in-transaction-timeout with savepoints open, and those with 
+        more than --max-client-buffer bytes waiting to be written to them. 
+        A client isn't idle while it's waiting for the server. 
+        """
+        pg = self.postgresProtocol
+        if pg is None:
+            return
+        now = time.time()
+        idle = self.config.get('idle-timeout')
+        idleInTransaction = self.config.get('idle-in-transaction-timeout')
+        maxBuffer = self.config.get('max-client-buffer')
+
+        for c in list(pg.clientStack):
+            if maxBuffer and transportBytes(c.transport) > maxBuffer:
+                c.reap('more than %d bytes are waiting to be read' % 
+                       maxBuffer, '53000')
+                continue
+            if c is pg.owner or c.heldMessages:
+                continue
+            if c.filter.savepoints:
+                limit, what, code = (idleInTransaction, 
+                                     'idle in transaction', '25P03')
+            else:
+                limit, what, code = idle, 'idle', '57P05'
+            if limit and now - c.lastReceived > limit:
+                c.reap('%s for more than %s seconds' % (what, limit), code)
+
+
+    def limitWrites(self, p):
+        """
+        Registers a WriteBufferProducer with a protocol's transport, so 
+        that its peer stops being read while more than --high-water bytes 
+        are waiting to be written to it (unless it's 0), and so that its 
+        backlogs are accounted for. 
+        """
+        high = self.config.get('high-water', 1 << 20)
+        if not hasattr(p.transport, 'registerProducer'):
+            return
+        p.transport.registerProducer(WriteBufferProducer(
+                p, high, self.config.get('low-water', 1 << 18)), True)
 
 
     def attachPostgresProtocol(self, pgproxyProtocol):
@@ -281,9 +878,9 @@ class PGProxyServerFactory(protocol.ServerFactory):
 
         # If this is the first client, we need to stop reading from 
         # it until the connection is made. 
-        pgproxyProtocol.transport.pauseProducing()
+        pgproxyProtocol.pauseReading('connecting')
         def resume(s):
-            pgproxyProtocol.transport.resumeProducing()
+            pgproxyProtocol.resumeReading('connecting')
             return s
 
         d = self.makePostgresProtocol().addCallback(attach)
@@ -318,13 +915,46 @@ class PGProxyServerFactory(protocol.ServerFactory):
                     return self.postgresProtocol
 
             log.msg('Got PostgresClientProtocol instance.')
+            p.capture = self.capture
+            p.stats = self.stats
+            p.timing = self.timing
+            p.memory = self.memory
+            p.clock = self.clock
+            self.limitWrites(p)
+            p.budgetAction = self.config.get('budget-action', 'fail')
+            self.stats.countConnection('backend_opened')
             self.postgresProtocol = p
             self.creatingPostgresProtocol = None
             return p
 
-        cc = protocol.ClientCreator(reactor, PostgresClientProtocol)
-        self.creatingPostgresProtocol = cc.connectTCP(
-            self.pgproxy.config['server-host'],
-            self.pgproxy.config['server-port']).addCallback(gotProto)
+        if self.replaying:
+            from cassette import ReplayPostgresProtocol, ReplayTransport
+            p = ReplayPostgresProtocol(
+                self.replaying, self.config.get('on-divergence', 'fallback'),
+                self.connectBackend)
+            p.makeConnection(ReplayTransport(p))
+            d = defer.succeed(p)
+        elif self.recording:
+            from cassette import RecordingPostgresProtocol
+            d = self.connectBackend(RecordingPostgresProtocol, self.recording)
+        else:
+            d = self.connectBackend(PostgresClientProtocol)
+
+        self.creatingPostgresProtocol = d.addCallback(gotProto)
         return self.creatingPostgresProtocol
 
+
+    def connectBackend(self, protocolClass, *args):
+        """
+        Connects a new instance of protocolClass to the postgres server, 
+        by TCP or by its --server-unix socket. Returns a deferred that 
+        fires with the protocol.
+        """
+        cc = protocol.ClientCreator(reactor, protocolClass, *args)
+        if self.config.get('server-unix'):
+            from unix import socketPath
+            return cc.connectUNIX(socketPath(
+                    self.config['server-unix'], self.config['server-port']))
+        return cc.connectTCP(
+            self.config['server-host'], self.config['server-port'])
+
@@ -0,0 +1,52 @@
+"""
+Module for telling the process that started the proxy that it's ready.
+With --ready-fd, the proxy writes the port it's listening on to that file
+descriptor, as a line, once it's listening, and then closes it. If the
+proxy fails to start, the descriptor is closed without a line being
+written, when the process exits. This is how pgproxy.PGProxy knows the
+proxy is up without polling it, and which port it got with
+--listen-port=0.
+
+"""
+from twisted.application import service
+from twisted.internet import defer
+from twisted.python import log
+import os
+
+
+
+class ReadySignal(service.Service):
+    """
+    Writes the port to fd once getPort's result (a port, or a Deferred
+    that fires with one) is known, after the services before it have
+    started.
+    """
+
+    def __init__(self, fd, getPort):
+        self.fd = fd
+        self.getPort = getPort
+
+
+    def startService(self):
+        service.Service.startService(self)
+        d = defer.maybeDeferred(self.getPort)
+        d.addCallback(self.signal)
+        d.addErrback(log.err, 'Could not signal readiness')
+
+
+    def signal(self, port):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        try:
+            os.write(fd, '%d\n' % port)
+        finally:
+            os.close(fd)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            os.close(fd)
+
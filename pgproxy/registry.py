@@ -0,0 +1,118 @@
+"""
+Module containing the registry of the clients attached to the server
+connection. A proxy in front of a large test suite can have tens of
+thousands of clients attached at once, and the current one changes with
+nearly every message, so adding, removing and moving a client to the end
+of the registry take constant time, where a list would scan it.
+
+"""
+from collections import OrderedDict
+
+
+
+class ClientRegistry(object):
+    """
+    An ordered set of clients. Clients are appended to the end, and can
+    be moved back there, so that the last one is the most recently
+    active. Iterating gives the oldest first.
+    """
+
+    __slots__ = ('_clients', '_last')
+
+
+    def __init__(self, clients=()):
+        self._clients = OrderedDict()
+
+        # The client at the end, kept so that finding it, and moving it to 
+        # where it already is, cost next to nothing. 
+        self._last = None
+        for c in clients:
+            self.append(c)
+
+
+    def append(self, client):
+        """
+        Adds a client to the end. Adding one that is already registered
+        moves it to the end.
+        """
+        self._clients.pop(client, None)
+        self._clients[client] = None
+        self._last = client
+
+
+    def moveToEnd(self, client):
+        """
+        Moves a registered client to the end, raising ValueError if it
+        isn't registered.
+        """
+        if client is self._last:
+            return
+        self.remove(client)
+        self._clients[client] = None
+        self._last = client
+
+
+    def remove(self, client):
+        """
+        Removes a client, raising ValueError if it isn't registered, as
+        list.remove does.
+        """
+        try:
+            del self._clients[client]
+        except KeyError:
+            raise ValueError('client is not registered: %r' % (client,))
+        if client is self._last:
+            self._last = self._end()
+
+
+    def discard(self, client):
+        """
+        Removes a client, if it's registered.
+        """
+        if client in self._clients:
+            self.remove(client)
+
+
+    def last(self):
+        """
+        Returns the client at the end, or None if there are none.
+        """
+        return self._last
+
+
+    def _end(self):
+        for c in reversed(self._clients):
+            return c
+        return None
+
+
+    def popleft(self):
+        """
+        Removes and returns the client at the start.
+        """
+        if not self._clients:
+            raise IndexError('pop from an empty registry')
+        client = self._clients.popitem(last=False)[0]
+        if client is self._last:
+            self._last = None
+        return client
+
+
+    def __len__(self):
+        return len(self._clients)
+
+
+    def __iter__(self):
+        return iter(self._clients)
+
+
+    def __reversed__(self):
+        return reversed(self._clients)
+
+
+    def __contains__(self, client):
+        return client in self._clients
+
+
+    def __repr__(self):
+        return 'ClientRegistry(%r)' % (list(self._clients),)
@@ -0,0 +1,146 @@
+"""
+Module for finding repeated queries within tests, like the N+1 queries of
+an ORM loading related rows one at a time.
+
+Each query is reduced to a fingerprint, with its literals and parameters
+replaced by ? and its whitespace and case normalized. A test is flagged
+when the same fingerprint runs many times in a row (a 'run'), or many
+times in total (a 'count'). Each fingerprint is flagged at most once of
+each kind per test.
+
+The fingerprints of a test are only kept while it runs. They're dropped
+when it ends, when another test starts, or when the last client leaves,
+so a long running proxy doesn't keep those of every test it has seen.
+Only the findings are kept.
+
+"""
+import re
+
+
+
+_string_re = re.compile(r"[eEbBxXnN]?'(?:[^']|'')*'")
+_number_re = re.compile(r'(?<![\w$.])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b', re.I)
+_param_re = re.compile(r'\$\d+')
+_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_space_re = re.compile(r'\s+')
+_comment_re = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+
+
+def fingerprint(sql):
+    """
+    Returns the fingerprint of a query: its text without comments, with
+    literals, parameters and lists of them replaced by ?, in lower case
+    and with single spaces.
+    """
+    sql = _comment_re.sub(' ', sql)
+    sql = _string_re.sub('?', sql)
+    sql = _param_re.sub('?', sql)
+    sql = _number_re.sub('?', sql)
+    sql = _list_re.sub('(?)', sql)
+    return _space_re.sub(' ', sql).strip().rstrip(';').strip().lower()
+
+
+
+class Finding(object):
+    """
+    A fingerprint that was repeated too often in a test. kind is 'run' or
+    'count', and times is how many times it had been seen when flagged.
+    """
+
+    def __init__(self, test, fingerprint, kind, times):
+        self.test = test
+        self.fingerprint = fingerprint
+        self.kind = kind
+        self.times = times
+
+
+    def message(self):
+        if self.kind == 'run':
+            what = '%d times in a row' % self.times
+        else:
+            what = '%d times' % self.times
+        return 'pgproxy: query repeated %s in test %s: %s' % (
+            what, self.test, self.fingerprint)
+
+
+    def asDict(self):
+        return {'fingerprint': self.fingerprint, 'kind': self.kind,
+                'times': self.times}
+
+
+
+class _TestQueries(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.last = None
+        self.run = 0
+        self.flagged = set()
+
+
+
+class RepeatDetector(object):
+    """
+    Watches the queries of each test for repeated fingerprints. run is the
+    number of consecutive repetitions, and count the total number, that a
+    test is flagged for. If notice is true, the proxy warns the client of
+    each finding with a NoticeResponse.
+    """
+
+    def __init__(self, run=10, count=50, notice=False):
+        self.runThreshold = run
+        self.countThreshold = count
+        self.notice = notice
+        # The queries of the running test, by its name, and the Findings 
+        # of every test, by name. 
+        self.tests = {}
+        self.found = {}
+
+
+    def observe(self, test, sql):
+        """
+        Adds a query run in a test. Returns a list of the new Findings.
+        """
+        t = self.tests.get(test)
+        if t is None:
+            # one test runs at a time, so the others have ended. 
+            self.tests.clear()
+            t = self.tests[test] = _TestQueries()
+
+        fp = fingerprint(sql)
+        n = t.counts[fp] = t.counts.get(fp, 0) + 1
+        if fp == t.last:
+            t.run += 1
+        else:
+            t.last, t.run = fp, 1
+
+        found = []
+        for kind, times, threshold in (('run', t.run, self.runThreshold),
+                                       ('count', n, self.countThreshold)):
+            if times >= threshold and (fp, kind) not in t.flagged:
+                t.flagged.add((fp, kind))
+                found.append(Finding(test, fp, kind, times))
+        if found:
+            self.found.setdefault(test, []).extend(found)
+        return found
+
+
+    def end(self, test):
+        """
+        Forgets the queries of a test that has ended. 
+        """
+        self.tests.pop(test, None)
+
+
+    def clear(self):
+        """
+        Forgets the queries of every test. 
+        """
+        self.tests.clear()
+
+
+    def findings(self):
+        """
+        Returns all of the Findings, by test name.
+        """
+        return dict(self.found)
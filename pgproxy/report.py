@@ -0,0 +1,170 @@
+"""
+Module for the per-test performance report. While it's enabled (with
+--report), the proxy adds up the database work done by each test: the
+queries it sent, the time the server spent answering them, the rows and
+bytes returned, the savepoints made for it, and its slowest statements.
+If repeated queries are being detected too (--detect-repeats), the queries
+each test repeated are listed with it, and so are the limits it exceeded
+if it had a budget (see the budget module).
+
+The report is written when the proxy stops, or when SHOW PGPROXY REPORT
+is run. It's CSV if the path ends in .csv, and JSON otherwise.
+
+"""
+from __future__ import with_statement
+import csv
+import heapq
+import os
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+
+class TestStats(object):
+    """
+    The totals of one test.
+    """
+
+    # The number of slowest statements kept, and the length they're
+    # shortened to.
+    slowestKept = 5
+    sqlLength = 200
+
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.savepoints = 0
+        self.slowest = []
+
+        # The repeats.Findings of the test, if any.
+        self.repeats = []
+
+        # Descriptions of the budget limits the test exceeded. 
+        self.violations = []
+
+
+    def addQuery(self, sql, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        item = (seconds, sql[:self.sqlLength])
+        if len(self.slowest) < self.slowestKept:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+
+    def slowestStatement(self):
+        """
+        Returns (seconds, sql) for the slowest statement, or (None, None).
+        """
+        if not self.slowest:
+            return None, None
+        return max(self.slowest)
+
+
+    def asDict(self):
+        return {
+            'queries': self.queries,
+            'backend_seconds': round(self.seconds, 6),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'savepoints': self.savepoints,
+            'slowest': [{'seconds': round(s, 6), 'sql': sql}
+                        for s, sql in sorted(self.slowest, reverse=True)],
+            'repeats': [f.asDict() for f in self.repeats],
+            'budget_violations': self.violations,
+            }
+
+
+
+class TestReport(object):
+    """
+    The TestStats of each test, by name.
+    """
+
+    def __init__(self):
+        self.tests = {}
+
+
+    def test(self, name):
+        t = self.tests.get(name)
+        if t is None:
+            t = self.tests[name] = TestStats()
+        return t
+
+
+    def recordQuery(self, name, msg, seconds):
+        """
+        Adds a message that the server answered with a ReadyForQuery after
+        the given number of seconds.
+        """
+        if msg.type == 'Q':
+            sql = msg.data[:-1]
+        elif msg.type == 'S':
+            sql = '(extended query)'
+        else:
+            return
+        self.test(name).addQuery(sql, seconds)
+
+
+    def recordResult(self, name, msg):
+        """
+        Adds a message received from the server.
+        """
+        t = self.test(name)
+        t.bytes += msg.length
+        if msg.type == 'D':
+            t.rows += 1
+
+
+    def recordSavepoint(self, name):
+        self.test(name).savepoints += 1
+
+
+    def recordRepeat(self, finding):
+        self.test(finding.test).repeats.append(finding)
+
+
+    def recordViolations(self, name, violations):
+        self.test(name).violations.extend(violations)
+
+
+    def ranked(self):
+        """
+        Returns (name, TestStats) pairs, the slowest tests first.
+        """
+        return sorted(self.tests.items(), key=lambda i: -i[1].seconds)
+
+
+    def write(self, path):
+        """
+        Writes the report to path, replacing it atomically.
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            if path.endswith('.csv'):
+                self.writeCSV(f)
+            else:
+                json.dump(dict([(name, t.asDict())
+                                for name, t in self.tests.items()]),
+                          f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+
+    def writeCSV(self, f):
+        w = csv.writer(f)
+        w.writerow(['test', 'queries', 'backend_seconds', 'rows', 'bytes',
+                    'savepoints', 'repeats', 'budget_violations',
+                    'slowest_seconds', 'slowest_sql'])
+        for name, t in self.ranked():
+            seconds, sql = t.slowestStatement()
+            w.writerow([name, t.queries, '%.6f' % t.seconds, t.rows, t.bytes,
+                        t.savepoints, len(t.repeats), '; '.join(t.violations),
+                        seconds is not None and '%.6f' % seconds or '',
+                        sql or ''])
@@ -0,0 +1,224 @@
+"""
+Module for the proxy's statement statistics, like those of postgres's
+pg_stat_statements. While it's enabled (with --statements), each query is
+reduced to its fingerprint (see the repeats module), and the calls,
+latency, rows and bytes of each fingerprint are added up.
+
+The latency is measured from the query arriving at the proxy until the
+ReadyForQuery that answers it is relayed, so it's what the client sees:
+the proxy's own time, the network, and any wait for another client's
+queries are included.
+
+The table keeps at most a fixed number of fingerprints. When it's full,
+the one used least recently is evicted, so queries that run rarely make
+way for the ones that run often.
+
+Queries sent with the extended query protocol are charged when the Sync
+that ends their batch is answered, to the SQL of the statements the batch
+executed. That's looked up through each client's PreparedStatements, so
+that a named statement executed again without a fresh Parse is charged
+to its own SQL.
+
+The table is listed by SHOW PGPROXY STATEMENTS, and written to the
+--statements-file when the proxy stops or SHOW PGPROXY DUMP STATEMENTS is
+run. The file is CSV if its path ends in .csv, and JSON otherwise.
+
+"""
+from __future__ import with_statement
+from collections import OrderedDict
+from repeats import fingerprint
+from stats import Histogram
+import csv
+import os
+import re
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+
+_tag_rows_re = re.compile(r'(\d+)$')
+
+
+class StatementStats(object):
+    """
+    The totals of one fingerprint.
+    """
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.calls = 0
+        self.rows = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+    def asDict(self):
+        h = self.latency
+        ms = lambda us: us is not None and round(us / 1000.0, 3) or 0.0
+        return {
+            'fingerprint': self.fingerprint,
+            'calls': self.calls,
+            'total_ms': ms(h.total),
+            'mean_ms': ms(h.count and h.total / float(h.count)),
+            'p95_ms': ms(h.percentile(95)),
+            'p99_ms': ms(h.percentile(99)),
+            'max_ms': ms(h.max),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            }
+
+
+
+class PreparedStatements(object):
+    """
+    The prepared statements and portals of one client, by name, and the
+    SQL of the statements executed since its last Sync. The unnamed
+    statement and portal are named ''.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self.portals = {}
+        self.executed = []
+
+
+    def parse(self, name, sql):
+        self.statements[name] = sql
+
+
+    def bind(self, portal, name):
+        self.portals[portal] = name
+
+
+    def execute(self, portal):
+        sql = self.statements.get(self.portals.get(portal))
+        if sql is not None:
+            self.executed.append(sql)
+
+
+    def close(self, kind, name):
+        """
+        Forgets a statement (kind 'S') or a portal (kind 'P').
+        """
+        if kind == 'S':
+            self.statements.pop(name, None)
+        else:
+            self.portals.pop(name, None)
+
+
+    def sync(self):
+        """
+        Returns the SQL executed since the last Sync, and starts over.
+        """
+        executed, self.executed = self.executed, []
+        return executed
+
+
+
+class StatementTable(object):
+    """
+    The StatementStats of at most maxSize fingerprints. Results are added
+    as they arrive from the server with recordResult, and belong to the
+    query that the next ReadyForQuery answers, which is given to
+    recordReply. A Sync is given with the SQL its batch executed, as its
+    executed attribute (see PreparedStatements).
+    """
+
+    columns = ('fingerprint', 'calls', 'total_ms', 'mean_ms', 'p95_ms',
+               'p99_ms', 'max_ms', 'rows', 'bytes')
+
+
+    def __init__(self, maxSize=1000):
+        self.maxSize = maxSize
+        self.statements = OrderedDict()
+        self.evicted = 0
+
+        # The rows and bytes of the reply being received, and the DataRows
+        # since the last CommandComplete.
+        self.rows = self.bytes = self.dataRows = 0
+
+
+    def recordResult(self, msg):
+        self.bytes += msg.length
+        if msg.type == 'D':
+            self.dataRows += 1
+        elif msg.type == 'C':
+            # INSERT, UPDATE and the like only count their rows in the tag.
+            m = _tag_rows_re.search(msg.data[:-1])
+            self.rows += m and int(m.group(1)) or self.dataRows
+            self.dataRows = 0
+
+
+    def recordReply(self, msg, seconds):
+        """
+        Adds a message that was answered after the given number of seconds,
+        with the results received since the last reply.
+        """
+        rows, nbytes = self.rows + self.dataRows, self.bytes
+        self.rows = self.bytes = self.dataRows = 0
+        if msg.type == 'Q':
+            sql = msg.data[:-1]
+        elif msg.type == 'S' and msg.executed:
+            # like a Query of several statements, a batch that executed
+            # several is one fingerprint.
+            sql = '; '.join(msg.executed)
+        else:
+            return
+
+        s = self.statement(fingerprint(sql))
+        s.calls += 1
+        s.rows += rows
+        s.bytes += nbytes
+        s.latency.record(seconds)
+
+
+    def statement(self, fp):
+        """
+        Returns the StatementStats of a fingerprint, making it the most
+        recently used.
+        """
+        s = self.statements.pop(fp, None)
+        if s is None:
+            s = StatementStats(fp)
+            if len(self.statements) >= self.maxSize:
+                self.statements.popitem(last=False)
+                self.evicted += 1
+        self.statements[fp] = s
+        return s
+
+
+    def ranked(self):
+        """
+        Returns the StatementStats, those with the most total time first.
+        """
+        return sorted(self.statements.values(),
+                      key=lambda s: -s.latency.total)
+
+
+    def table(self, limit=None):
+        """
+        Returns a row of values for each of the columns, for each of the
+        StatementStats in order.
+        """
+        return [[s.asDict()[c] for c in self.columns]
+                for s in self.ranked()[:limit]]
+
+
+    def write(self, path):
+        """
+        Writes the table to path, replacing it atomically.
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            if path.endswith('.csv'):
+                w = csv.writer(f)
+                w.writerow(self.columns)
+                w.writerows(self.table())
+            else:
+                json.dump({'evicted': self.evicted,
+                           'statements': [s.asDict() for s in self.ranked()]},
+                          f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
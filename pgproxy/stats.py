@@ -0,0 +1,204 @@
+"""
+Module for the proxy's own statistics: counts of the messages and bytes
+passing through it, counts of what the filters did with them, and
+histograms of how long the server takes to answer.
+
+Messages are counted by direction and type code. The directions are the
+same as those of a capture (see the capture module): F and B for messages
+received from a frontend or the backend, f and b for messages the proxy
+wrote to them.
+
+Everything is kept in plain counters and fixed buckets, so that it's cheap
+enough to leave on all the time.
+
+"""
+from collections import defaultdict
+import time
+
+
+
+class Histogram(object):
+    """
+    A histogram of durations, in the style of an HDR histogram. Values are
+    recorded in microseconds into buckets that double in width every
+    subBuckets / 2 buckets, so any value is known to within about 6%
+    using a few hundred integers.
+    """
+
+    subBits = 5
+    subBuckets = 1 << subBits
+
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+
+    def index(self, v):
+        if v < self.subBuckets:
+            return v
+        shift = v.bit_length() - self.subBits
+        return (shift << (self.subBits - 1)) + (v >> shift)
+
+
+    def lowest(self, i):
+        """
+        Returns the smallest value that falls into bucket i.
+        """
+        if i < self.subBuckets:
+            return i
+        shift = (i >> (self.subBits - 1)) - 1
+        return (i - (shift << (self.subBits - 1))) << shift
+
+
+    def record(self, seconds):
+        v = int(seconds * 1000000)
+        i = self.index(v)
+        counts = self.counts
+        if i >= len(counts):
+            counts.extend([0] * (i + 1 - len(counts)))
+        counts[i] += 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+
+    def countAtMost(self, us):
+        """
+        Returns the number of values recorded in the buckets that end at or
+        below us microseconds.
+        """
+        n = 0
+        for i, c in enumerate(self.counts):
+            if self.lowest(i + 1) > us + 1:
+                break
+            n += c
+        return n
+
+
+    def percentile(self, p):
+        """
+        Returns the p-th percentile (0-100) in microseconds, or None if
+        nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(p / 100.0 * self.count + 0.5))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.lowest(i), self.max)
+        return self.max
+
+
+    def summary(self):
+        """
+        Returns a dict of the count, mean, percentiles and extremes, in
+        milliseconds.
+        """
+        if not self.count:
+            return {'count': 0}
+        ms = lambda us: round(us / 1000.0, 3)
+        return {
+            'count': self.count,
+            'mean': ms(self.total / float(self.count)),
+            'min': ms(self.min),
+            'p50': ms(self.percentile(50)),
+            'p90': ms(self.percentile(90)),
+            'p99': ms(self.percentile(99)),
+            'max': ms(self.max),
+            }
+
+
+
+class ProxyStats(object):
+    """
+    The statistics of one proxy. The factory owns the instance, and the
+    protocols and their filters update it.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.messages = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.actions = defaultdict(int)
+
+        # Counts of connections: client_opened, client_closed,
+        # client_reaped and backend_opened.
+        self.connections = defaultdict(int)
+
+        # Histograms of the time between a message being sent to the
+        # server and its ReadyForQuery, by the type of message (Q, S or
+        # Startup).
+        self.latency = defaultdict(Histogram)
+
+        # A report.TestReport, if the work of each test is being reported.
+        self.tests = None
+
+        # A repeats.RepeatDetector, if repeated queries are being detected.
+        self.repeats = None
+
+        # A statements.StatementTable, if statement statistics are kept.
+        self.statements = None
+
+
+    def countMessages(self, direction, messages):
+        for m in messages:
+            key = direction + m.type
+            self.messages[key] += 1
+            self.bytes[key] += m.length
+
+
+    def countAction(self, action):
+        """
+        Counts a message being dropped, spoofed or translated by a filter.
+        """
+        self.actions[action] += 1
+
+
+    def countConnection(self, event):
+        self.connections[event] += 1
+
+
+    def recordResult(self, msg, test=None):
+        """
+        Records a message received from the server during the given test.
+        """
+        if test and self.tests is not None:
+            self.tests.recordResult(test, msg)
+        if self.statements is not None:
+            self.statements.recordResult(msg)
+
+
+    def recordReply(self, msg, seconds, test=None):
+        """
+        Records the time the server took to answer a message (until its
+        ReadyForQuery), sent during the given test.
+        """
+        self.latency[msg.type].record(seconds)
+        if test and self.tests is not None:
+            self.tests.recordQuery(test, msg, seconds)
+
+
+    def snapshot(self):
+        """
+        Returns all of the statistics as a dict, ready to be serialized.
+        Message and byte counts are keyed by direction and type code, as
+        in 'FQ' for queries received from clients.
+        """
+        return {
+            'uptime': round(time.time() - self.started, 3),
+            'messages': dict(self.messages),
+            'bytes': dict(self.bytes),
+            'actions': dict(self.actions),
+            'connections': dict(self.connections),
+            'latency_ms': dict([(t, h.summary())
+                                for t, h in self.latency.items()]),
+            }
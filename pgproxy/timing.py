@@ -0,0 +1,86 @@
+"""
+Module for timing the stages of the relay path, to find out where the
+proxy's own time goes. While it's enabled (with --stage-timing), the time
+spent in each of these stages is added up:
+
+    parse   - consuming received data into messages
+    filter  - dispatching a message to its filter
+    write   - serializing messages and writing them to the peer
+    spoof   - serializing and scheduling spoofed replies
+    wait    - waiting for the server, from a message being sent until the
+              ReadyForQuery that answers it
+
+Totals are kept by stage and message type, and by stage for each open
+client connection. Message types are prefixed with their direction, as in
+the stats module, so 'FQ' is a query received from a client and 'fC' a
+CommandComplete written to one. Messages written together are counted
+under the type of the first.
+
+The totals are listed by SHOW PGPROXY STAGES, and served with the metrics.
+
+"""
+from collections import defaultdict
+import time
+
+
+
+# The highest resolution clock available.
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def _total():
+    return [0, 0.0]
+
+
+def _stages():
+    return defaultdict(_total)
+
+
+
+class StageTimes(object):
+    """
+    The counts and seconds of each stage. The protocols that share the
+    instance call add as they finish each stage.
+    """
+
+    stages = ('parse', 'filter', 'write', 'spoof', 'wait')
+
+
+    def __init__(self):
+        # [count, seconds] by (stage, type).
+        self.types = defaultdict(_total)
+
+        # [count, seconds] by stage, by client connection id.
+        self.connections = defaultdict(_stages)
+
+
+    def add(self, stage, type, connection, seconds):
+        t = self.types[stage, type]
+        t[0] += 1
+        t[1] += seconds
+        c = self.connections[connection][stage]
+        c[0] += 1
+        c[1] += seconds
+
+
+    def forget(self, connection):
+        """
+        Drops the totals of a client connection that has closed.
+        """
+        self.connections.pop(connection, None)
+
+
+    def rows(self):
+        """
+        Returns a (scope, key, stage, count, seconds) row for each total,
+        by type and then by connection.
+        """
+        rows = []
+        for (stage, type), (n, seconds) in sorted(self.types.items()):
+            rows.append(('type', type, stage, n, seconds))
+        for connection, stages in sorted(self.connections.items()):
+            for stage in self.stages:
+                if stage in stages:
+                    n, seconds = stages[stage]
+                    rows.append(('connection', connection, stage, n, seconds))
+        return rows
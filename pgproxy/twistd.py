@@ -1,13 +1,16 @@
 from twisted.scripts.twistd import ServerOptions, runApp
 from twisted.application import app
+import options
 
 
 class Options(ServerOptions):
-    optParameters = [
-        ('listen-port', '', 5433, 'The port to listen on.', int),
-        ('server-host', '', 'localhost', 'The host of the postgres server.'),
-        ('server-port', '', 5432, 'The port of the postgres server.', int),
-        ]
+    optFlags = options.optFlags
+    optParameters = options.optParameters
+
+
+    def postOptions(self):
+        ServerOptions.postOptions(self)
+        options.validate(self)
 
 
 def run():
@@ -0,0 +1,30 @@
+"""
+Module for the Unix-domain sockets that postgres listens on. libpq finds
+the socket of the server on a port in a directory (its host), by the name
+.s.PGSQL.<port>. A path given to --listen-unix or --server-unix is such a
+directory, unless it already ends in a socket named that way.
+
+"""
+import os
+
+
+
+prefix = '.s.PGSQL.'
+
+
+def socketPath(path, port):
+    """
+    Returns the path of the socket for port, given a directory or the
+    path of the socket itself.
+    """
+    if os.path.basename(path).startswith(prefix):
+        return path
+    return os.path.join(path, '%s%d' % (prefix, port))
+
+
+def isDirectory(path):
+    """
+    Returns true if path names a directory that the socket goes in,
+    rather than the socket itself.
+    """
+    return not os.path.basename(path).startswith(prefix)
@@ -0,0 +1,335 @@
+"""
+Module for running the proxy as several processes, to use more than one
+core. With --workers N, the twistd process is a supervisor that starts N
+worker processes, each an ordinary proxy with its own connection to the
+server. The workers all listen on the same port with SO_REUSEPORT, so the
+kernel spreads new client connections between them.
+
+Since each worker has its own server connection, a test only sees the
+clients that connected to the same worker. --workers suits suites whose
+tests each use one connection, or that run many tests in parallel.
+
+The supervisor restarts a worker that exits while it's running, waiting
+longer after each crash in a row, and stops the workers when it stops.
+Each worker serves its metrics on 127.0.0.1, at --metrics-port plus one
+plus its index, and the supervisor serves the total of all of them on
+--metrics-port (see metrics.aggregate). Each worker tells the supervisor
+when it's listening on its --ready-fd, and the supervisor's own
+--ready-fd is written once all of them have. The files a worker writes
+(--record, --capture, --report, --statements-file and the log) get the
+worker's index before their extension, as in report.1.json.
+
+"""
+from twisted.application import service
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.python import log
+import os
+import signal
+import socket
+import sys
+import time
+
+
+
+_this_dir = os.path.realpath(os.path.dirname(__file__))
+
+# The socket option, which older Pythons don't name.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       sys.platform.startswith('linux') and 15 or None)
+
+# The options whose files each worker writes a copy of.
+workerFiles = ('record', 'capture', 'report', 'statements-file')
+
+# The descriptor each worker signals readiness on (see pgproxy.ready).
+readyFd = 3
+
+
+def reusePortSocket(port, interface=''):
+    """
+    Returns a listening, non-blocking socket bound to port with
+    SO_REUSEPORT, so that other processes can listen on it too.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(50)
+        s.setblocking(False)
+    except:
+        s.close()
+        raise
+    return s
+
+
+def workerPath(path, index):
+    """
+    Returns the path of a worker's copy of a file.
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%d%s' % (root, index, ext)
+
+
+def metricsPort(config, index):
+    """
+    Returns the port a worker serves its metrics on.
+    """
+    return config['metrics-port'] + 1 + index
+
+
+
+class ReusePortServer(service.Service):
+    """
+    Listens on a port shared with the other workers.
+    """
+
+    def __init__(self, port, factory, interface=''):
+        self.port = port
+        self.factory = factory
+        self.interface = interface
+        self.listener = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        s = reusePortSocket(self.port, self.interface)
+        try:
+            self.listener = reactor.adoptStreamPort(
+                s.fileno(), socket.AF_INET, self.factory)
+        finally:
+            # the port has its own copy of the descriptor.
+            s.close()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            return defer.maybeDeferred(listener.stopListening)
+
+
+
+class OrphanWatch(service.Service):
+    """
+    Stops a worker whose supervisor has gone away without stopping it.
+    """
+
+    interval = 1.0
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.parent = os.getppid()
+        self.loop = task.LoopingCall(self.check)
+        self.loop.clock = reactor
+        self.loop.start(self.interval, now=False)
+
+
+    def check(self):
+        if os.getppid() != self.parent:
+            log.msg('The supervisor has exited, stopping.')
+            self.loop.stop()
+            reactor.stop()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.loop.running:
+            self.loop.stop()
+
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    The supervisor's end of a worker process. What the worker writes is
+    logged, and the supervisor is told when it ends.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.started = time.time()
+        self.ended = defer.Deferred()
+        self.buffers = {1: '', 2: ''}
+
+
+    def childDataReceived(self, fd, data):
+        if fd == readyFd:
+            return self.supervisor.workerReady(self.index)
+        lines = (self.buffers[fd] + data).split('\n')
+        self.buffers[fd] = lines.pop()
+        for l in lines:
+            log.msg('worker %d: %s' % (self.index, l))
+
+
+    def processEnded(self, reason):
+        for l in self.buffers.values():
+            if l:
+                log.msg('worker %d: %s' % (self.index, l))
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class Supervisor(service.Service):
+    """
+    Starts the --workers, and restarts them when they exit.
+    """
+
+    # The seconds to wait before restarting a worker that crashed, which
+    # doubles with each crash in a row, up to maxRestartDelay. A worker
+    # that ran for stableAfter seconds starts the count over.
+    restartDelay = 0.5
+    maxRestartDelay = 30.0
+    stableAfter = 10.0
+
+    # The seconds given to the workers to stop before they're killed.
+    killTimeout = 10.0
+
+
+    def __init__(self, config):
+        self.config = config
+        self.count = config['workers']
+
+        # The WorkerProcess of each running worker, by index.
+        self.workers = {}
+
+        # Crashes in a row, and the pending restart call, by index.
+        self.crashes = dict.fromkeys(range(self.count), 0)
+        self.restarts = {}
+
+        # The number of times workers have been restarted.
+        self.restarted = 0
+
+        # Fires with the port once every worker has started listening.
+        self.ready = defer.Deferred()
+        self.readyWorkers = set()
+
+
+    def workerArgs(self, index):
+        """
+        Returns the command line of a worker: the supervisor's pgproxy
+        options, with the worker's own files and metrics port.
+        """
+        from options import optFlags, optParameters
+        config = self.config
+        args = [sys.executable, os.path.join(_this_dir, 'twistd.py'),
+                '-n', '-y', os.path.join(_this_dir, 'service.tac'),
+                '--pidfile=', '--workers=%d' % self.count,
+                '--worker=%d' % index, '--ready-fd=%d' % readyFd]
+        if config.get('logfile'):
+            args.append('--logfile=%s' % workerPath(config['logfile'], index))
+
+        for p in optParameters:
+            name, default = p[0], p[2]
+            value = config.get(name)
+            if (name in ('workers', 'worker', 'ready-fd') or 
+                value in (None, default)):
+                continue
+            if name in workerFiles:
+                value = workerPath(value, index)
+            elif name == 'metrics-port':
+                value = metricsPort(config, index)
+            args.append('--%s=%s' % (name, value))
+        for f in optFlags:
+            if config.get(f[0]):
+                args.append('--%s' % f[0])
+        return args
+
+
+    def startService(self):
+        service.Service.startService(self)
+        log.msg('Starting %d workers.' % self.count)
+        for i in range(self.count):
+            self.spawn(i)
+
+
+    def spawn(self, index):
+        self.restarts.pop(index, None)
+        p = WorkerProcess(self, index)
+        reactor.spawnProcess(p, sys.executable, self.workerArgs(index),
+                             env=os.environ, 
+                             childFDs={0: 'w', 1: 'r', 2: 'r', readyFd: 'r'})
+        self.workers[index] = p
+        log.msg('Started worker %d, pid %s.' % (index, p.transport.pid))
+        return p
+
+
+    def workerReady(self, index):
+        self.readyWorkers.add(index)
+        if len(self.readyWorkers) == self.count and not self.ready.called:
+            log.msg('All %d workers are listening.' % self.count)
+            self.ready.callback(self.config['listen-port'])
+
+
+    def workerEnded(self, p, reason):
+        if self.workers.get(p.index) is not p:
+            return
+        del self.workers[p.index]
+        if not self.running:
+            log.msg('Worker %d stopped.' % p.index)
+            return
+        log.msg('Worker %d exited: %s' % (p.index, reason.value))
+
+        if time.time() - p.started >= self.stableAfter:
+            self.crashes[p.index] = 0
+        delay = min(self.maxRestartDelay,
+                    self.restartDelay * 2 ** self.crashes[p.index])
+        self.crashes[p.index] += 1
+        self.restarted += 1
+        log.msg('Restarting worker %d in %s seconds.' % (p.index, delay))
+        self.restarts[p.index] = reactor.callLater(delay, self.spawn, p.index)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in self.restarts.values():
+            call.cancel()
+        self.restarts.clear()
+
+        workers = self.workers.values()
+        if not workers:
+            return
+        for p in workers:
+            self.signal(p, signal.SIGTERM)
+        kill = reactor.callLater(self.killTimeout, self.killAll)
+        d = defer.DeferredList([p.ended for p in workers])
+        def stopped(_):
+            if kill.active():
+                kill.cancel()
+        return d.addCallback(stopped)
+
+
+    def killAll(self):
+        for p in self.workers.values():
+            log.msg('Killing worker %d.' % p.index)
+            self.signal(p, signal.SIGKILL)
+
+
+    def signal(self, p, sig):
+        try:
+            p.transport.signalProcess(sig)
+        except error.ProcessExitedAlready:
+            pass
+
+
+    def scrape(self):
+        """
+        Returns a Deferred list of the metrics pages of the running
+        workers. A worker that can't be scraped is left out.
+        """
+        from twisted.web.client import Agent, readBody
+        agent = Agent(reactor)
+        def failed(f, index):
+            log.msg('Could not scrape worker %d: %s' % (index, f.value))
+            return None
+        ds = []
+        for i in sorted(self.workers):
+            d = agent.request(
+                'GET', 'http://127.0.0.1:%d/metrics' % metricsPort(
+                    self.config, i))
+            d.addCallback(readBody)
+            d.addErrback(failed, i)
+            ds.append(d)
+        d = defer.gatherResults(ds)
+        return d.addCallback(lambda pages: [p for p in pages if p])
@@ -0,0 +1,127 @@
+"""
+Module that keeps track of the tables written to by each test.
+
+Tests that commit real data can't be undone with a ROLLBACK. Instead, the
+proxy remembers which tables were the targets of INSERT, UPDATE, DELETE and
+COPY statements during the test, and resets only those tables with a single
+TRUNCATE when the test is rolled back. The TRUNCATE cascades to the tables
+with foreign keys to them, which would otherwise make it fail.
+
+The statement inspection is done with regular expressions, so it is not
+a real SQL parser. It errs on the side of finding too many tables.
+
+"""
+import re
+
+
+
+# An optionally schema-qualified and optionally quoted table name.
+_name = r'(?:"[^"]+"|[a-z_][a-z0-9_$]*)'
+_table = r'(%s(?:\.%s)?)' % (_name, _name)
+
+# Statements that write to the table that follows them. UPDATE and DELETE 
+# are not matched where they name an action rather than do it: "FOR UPDATE"
+# and "DO UPDATE" lock or upsert a table named elsewhere, "ON UPDATE" and 
+# "ON DELETE" are foreign key actions, and "BEFORE UPDATE", "AFTER UPDATE", 
+# "INSTEAD OF UPDATE" and "OR UPDATE" are the events of a trigger or rule. 
+# Whitespace has been collapsed to single spaces, so the lookbehinds can be 
+# of a fixed width.
+_write_re = re.compile(
+    r'(?<![a-z0-9_$"])'
+    r'(?<!for )(?<!do )(?<!on )(?<!before )(?<!after )(?<!instead of )(?<!or )'
+    r'(?:insert into|update|delete from) (?:only )?' + _table, re.I)
+
+# COPY only writes to the table when it is copying FROM something.
+_copy_re = re.compile(
+    r'(?<![a-z0-9_$"])copy ' + _table + r'(?: ?\([^)]*\))? from\b', re.I)
+
+# Comments and string literals (quoted or dollar quoted) are removed before 
+# matching, so that statements inside of them are not mistaken for writes. 
+# Quoted names are matched only so that what's inside them is left alone. 
+_strip_re = re.compile(
+    r'("(?:[^"]|"")*")|\'(?:[^\']|\'\')*\'|\$([a-z_]*)\$.*?\$\2\$|--[^\n]*'
+    r'|/\*.*?\*/', re.I | re.S)
+
+# Statements that mention UPDATE and DELETE as privileges. 
+_grant_re = re.compile(r'\s*(?:grant|revoke)\b', re.I)
+
+# Words that can follow UPDATE without being a table name. ON is reserved, 
+# so it is never an unquoted table name. 
+_not_tables = frozenset(['set', 'of', 'nowait', 'skip', 'on'])
+
+
+
+def writtenTables(sql):
+    """
+    Returns the set of table names that the given SQL writes to. Unquoted
+    names are folded to lower case, the way postgres folds them.
+    """
+    sql = ' '.join(_strip_re.sub(_strip, sql).split())
+    tables = set()
+    for statement in sql.split(';'):
+        if _grant_re.match(statement):
+            continue
+        for rx in (_write_re, _copy_re):
+            for name in rx.findall(statement):
+                if name.lower() in _not_tables:
+                    continue
+                tables.add(_fold(name))
+    return tables
+
+
+def _strip(match):
+    """
+    Replaces a comment or literal with a space, and keeps a quoted name. 
+    """
+    return match.group(1) or ' '
+
+
+def _fold(name):
+    """
+    Lower-cases the unquoted parts of a (possibly qualified) table name.
+    """
+    return '.'.join([p if p.startswith('"') else p.lower()
+                     for p in re.findall(_name, name, re.I)])
+
+
+def truncateQuery(tables):
+    """
+    Returns the SQL that resets the given tables, including any sequences
+    owned by their columns, and the tables that refer to them.
+    """
+    return 'TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(tables)
+
+
+
+class WriteSetIndex(object):
+    """
+    Maps test names to the set of tables written to during the test.
+    """
+
+    def __init__(self):
+        self.tests = {}
+
+
+    def record(self, test, sql):
+        """
+        Adds the tables written to by sql to the test's write set. Returns
+        the tables that were found.
+        """
+        tables = writtenTables(sql)
+        if tables:
+            self.tests.setdefault(test, set()).update(tables)
+        return tables
+
+
+    def tables(self, test):
+        """
+        Returns a sorted list of the tables the test has written to so far.
+        """
+        return sorted(self.tests.get(test, ()))
+
+
+    def discard(self, test):
+        """
+        Forgets the test's write set, returning it as a sorted list.
+        """
+        return sorted(self.tests.pop(test, ()))
@@ -9,5 +9,8 @@ setup(
     author_email = 'mcfunley@gmail.com',
     url = 'http://mcfunley.com/',
     package_data = { 'pgproxy': ['service.tac'] },
-    packages = find_packages(exclude=['tests'])
+    packages = find_packages(exclude=['tests']),
+    entry_points = {
+        'console_scripts': ['pgproxy-bench = pgproxy.bench:main'],
+        },
 )
@@ -18,6 +18,25 @@ class MockTransport(object):
         self.write = die
 
 
+class CollectingTransport(MockTransport):
+    paused = False
+
+    def __init__(self):
+        self.data = []
+
+
+    def write(self, data):
+        self.data.append(data)
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
 class MockPeer(object):
     transport = MockTransport()
 
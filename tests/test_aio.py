@@ -0,0 +1,145 @@
+from twisted.trial import unittest
+from twisted.internet import defer, error
+from pgproxy.fakebackend import FakeBackendFactory
+from pgproxy.bench.client import BenchClientProtocol
+from pgproxy import aio
+
+
+
+class AioTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if not aio.available():
+            raise unittest.SkipTest('asyncio is not available')
+        self.loop = aio.newEventLoop()
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def wait(self, thing, timeout=5):
+        """
+        Runs the loop until a future, or a Deferred, is done, and returns
+        its result.
+        """
+        if isinstance(thing, defer.Deferred):
+            f = aio.asyncio.Future(loop=self.loop)
+            def done(result):
+                if not f.done():
+                    f.set_result(result)
+            def failed(reason):
+                if not f.done():
+                    f.set_exception(reason.value)
+            thing.addCallbacks(done, failed)
+            thing = f
+        return self.loop.run_until_complete(
+            aio.asyncio.wait_for(thing, timeout, loop=self.loop))
+
+
+
+class LoopClockTests(AioTestCase):
+
+    def setUp(self):
+        AioTestCase.setUp(self)
+        self.clock = aio.LoopClock(self.loop)
+        self.calls = []
+
+
+    def runFor(self, seconds):
+        self.wait(aio.asyncio.sleep(seconds, loop=self.loop))
+
+
+    def test_callLater(self):
+        c = self.clock.callLater(0, self.calls.append, 1)
+        self.assertTrue(c.active())
+        self.runFor(0.01)
+        self.assertEqual(self.calls, [1])
+        self.assertFalse(c.active())
+        self.assertRaises(error.AlreadyCalled, c.cancel)
+
+
+    def test_cancel(self):
+        c = self.clock.callLater(0, self.calls.append, 1)
+        c.cancel()
+        self.runFor(0.01)
+        self.assertEqual(self.calls, [])
+        self.assertFalse(c.active())
+        self.assertRaises(error.AlreadyCancelled, c.cancel)
+
+
+    def test_seconds(self):
+        before = self.loop.time()
+        seconds = self.clock.seconds()
+        self.assertTrue(before <= seconds <= self.loop.time())
+
+
+
+class AioProxyTests(AioTestCase):
+    """
+    Runs the fake backend, the proxy and the clients all on the loop.
+    """
+
+    def setUp(self):
+        AioTestCase.setUp(self)
+        self.backendFactory = FakeBackendFactory()
+        self.backend = self.wait(self.loop.create_server(
+                lambda: aio.AioConnection(self.backendFactory),
+                '127.0.0.1', 0))
+        self.proxy = aio.AioProxy({
+                'listen-port': 0, 'server-host': '127.0.0.1',
+                'server-port': self.backend.sockets[0].getsockname()[1]},
+                self.loop)
+        self.wait(self.proxy.start())
+        self.clients = []
+
+
+    def tearDown(self):
+        for c in self.clients:
+            if c.transport and not c.transport.disconnecting:
+                c.terminate()
+        if self.proxy.server is not None:
+            self.wait(self.proxy.stop())
+        self.backend.close()
+        self.wait(self.backend.wait_closed())
+        AioTestCase.tearDown(self)
+
+
+    def connect(self):
+        c = BenchClientProtocol()
+        self.wait(self.loop.create_connection(
+                lambda: aio.AioConnection(self.proxy.factory, c),
+                '127.0.0.1', self.proxy.port))
+        self.wait(c.startup())
+        self.clients.append(c)
+        return c
+
+
+    def test_query(self):
+        c = self.connect()
+        self.wait(c.query('select 1'))
+        self.assertEqual(c.errors, 0)
+        self.assertEqual(c.rows, 1)
+
+
+    def test_sharedConnection(self):
+        """
+        The clients share the proxy's one connection to the server.
+        """
+        a, b = self.connect(), self.connect()
+        self.wait(a.query('select 1'))
+        self.wait(b.query('select 1'))
+        self.assertEqual(len(self.backendFactory.protocols), 1)
+        pg = self.proxy.factory.postgresProtocol
+        self.assertEqual(len(pg.clientStack), 2)
+
+
+    def test_stop(self):
+        """
+        Stopping the proxy disconnects its clients.
+        """
+        c = self.connect()
+        lost = defer.Deferred()
+        c.connectionLost = lambda reason: lost.callback(None)
+        self.wait(self.proxy.stop())
+        self.wait(lost)
@@ -0,0 +1,113 @@
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.proxy import PGProxyServerFactory, WriteBufferProducer
+from pgproxy import proxy
+from test_fake_backend import _Service
+
+
+
+class BufferingTransport(CollectingTransport):
+    """
+    A transport with a write buffer like a Twisted TCP connection's, 
+    which asks its producer to pause on writes past bufferSize. 
+    """
+    bufferSize = 50
+    producer = None
+
+    def __init__(self):
+        CollectingTransport.__init__(self)
+        self._tempDataLen = 0
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def write(self, data):
+        self._tempDataLen += len(data)
+        if self.producer and self._tempDataLen > self.bufferSize:
+            self.producer.pauseProducing()
+
+
+    def drain(self, n):
+        self._tempDataLen -= n
+        if not self._tempDataLen and self.producer:
+            self.producer.resumeProducing()
+
+
+
+class BackpressureTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(proxy, 'reactor', self.clock)
+        self.b, self.f = self.protocols()
+        self.b.transport = CollectingTransport()
+        self.f.transport = BufferingTransport()
+        self.factory = PGProxyServerFactory(
+            _Service({'high-water': 100, 'low-water': 40}))
+
+
+    def test_limitWrites(self):
+        self.factory.limitWrites(self.f)
+        self.assertEqual(self.f.transport.bufferSize, 50)
+        self.assertTrue(isinstance(self.f.transport.producer, 
+                                   WriteBufferProducer))
+
+        # the replay transport can't buffer. 
+        self.b.transport = object()
+        self.factory.limitWrites(self.b)
+
+        # with no high-water mark, the producer only accounts for the 
+        # transport's backlog. 
+        off = PGProxyServerFactory(_Service({'high-water': 0}))
+        self.b.transport = CollectingTransport()
+        self.f.transport = BufferingTransport()
+        self.f.memory = off.memory
+        off.limitWrites(self.f)
+        self.f.transport.write('x' * 1000)
+        self.assertFalse(self.b.transport.paused)
+        self.assertEqual(off.memory.backlogged, set([self.f]))
+
+
+    def test_slow_client_pauses_server(self):
+        self.factory.limitWrites(self.f)
+        self.f.transport.write('x' * 100)
+        self.assertFalse(self.b.transport.paused)
+        self.f.transport.write('x')
+        self.assertTrue(self.b.transport.paused)
+
+        # not below the low-water mark yet
+        self.f.transport.drain(50)
+        self.f.transport.write('x' * 10)
+        self.clock.advance(WriteBufferProducer.pollInterval)
+        self.assertTrue(self.b.transport.paused)
+
+        self.f.transport.drain(30)
+        self.clock.advance(WriteBufferProducer.pollInterval)
+        self.assertFalse(self.b.transport.paused)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # resumed by the transport when empty, too.
+        self.f.transport.write('x' * 100)
+        self.assertTrue(self.b.transport.paused)
+        self.f.transport.drain(131)
+        self.assertFalse(self.b.transport.paused)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_pause_reasons(self):
+        self.factory.limitWrites(self.f)
+        self.b.pauseReading('other')
+        self.f.transport.write('x' * 101)
+        self.f.transport.drain(101)
+        self.assertTrue(self.b.transport.paused)
+        self.b.resumeReading('other')
+        self.assertFalse(self.b.transport.paused)
+
+
+    def test_closed_client_resumes_server(self):
+        self.factory.limitWrites(self.f)
+        self.f.transport.write('x' * 101)
+        self.f.transport.producer.stopProducing()
+        self.assertFalse(self.b.transport.paused)
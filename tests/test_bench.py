@@ -0,0 +1,253 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from pgproxy.bench.measure import percentile, summarize
+from pgproxy.bench.replay import statements, readStreams, Replay
+from pgproxy.capture import CaptureWriter, CaptureReader
+from pgproxy.bench import micro, clients, startup
+from pgproxy.bench.e2e import EndToEnd
+from pgproxy.fakebackend import FakeBackendFactory
+from pgproxy.proxy import PGProxyServerFactory
+from test_fake_backend import _Service
+from StringIO import StringIO
+import socket
+import time
+from pgproxy import messages, filters
+
+
+
+class MeasureTests(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([], 50), None)
+
+
+    def test_summarize(self):
+        s = summarize([0.001, 0.003, 0.002])
+        self.assertEqual(s['count'], 3)
+        self.assertEqual(s['p50'], 2.0)
+        self.assertEqual(s['max'], 3.0)
+        self.assertEqual(summarize([]), {'count': 0})
+
+
+
+class ReplayStatementTests(unittest.TestCase):
+
+    def frontend(self, *ms):
+        return [(float(i), m) for i, m in enumerate(ms)]
+
+
+    def test_grouping(self):
+        parse = messages.FrontendMessage()
+        parse.consume('P\x00\x00\x00\x08\x00x\x00\x00')
+        sync = messages.FrontendMessage()
+        sync.consume('S\x00\x00\x00\x04')
+        ms = self.frontend(messages.startup('postgres'),
+                           messages.query('select 1'),
+                           parse, sync,
+                           messages.query('insert into foo values (1)'),
+                           messages.terminate(),
+                           messages.query('never sent'))
+        ss = list(statements(ms))
+        self.assertEqual([(ts, label) for ts, label, _ in ss],
+                         [(0.0, 'startup'), (1.0, 'SELECT'),
+                          (2.0, 'extended'), (4.0, 'INSERT')])
+        self.assertEqual(ss[2][2], parse.serialize() + sync.serialize())
+
+
+    def test_copy_data_sent_with_query(self):
+        data = messages.FrontendMessage()
+        data.consume('d\x00\x00\x00\x061\n')
+        done = messages.FrontendMessage()
+        done.consume('c\x00\x00\x00\x04')
+        q = messages.query('copy foo from stdin')
+        ss = list(statements(self.frontend(q, data, done)))
+        self.assertEqual(len(ss), 1)
+        self.assertEqual(
+            ss[0][2], q.serialize() + data.serialize() + done.serialize())
+
+
+
+class ReplayStreamTests(unittest.TestCase):
+
+    def capture(self):
+        path = self.mktemp()
+        w = CaptureWriter(path)
+        w.record('F', 2, None, [messages.startup('postgres')])
+        w.record('F', 1, None, [messages.startup('postgres')])
+        w.record('B', 2, None, [messages.readyForQuery('idle')])
+        w.record('F', 2, 'foo', [messages.query('select 2')])
+        w.record('F', 1, 'foo', [messages.query('insert into foo values (1)')])
+        w.record('F', 2, 'bar', [messages.query('select 3')])
+        w.record('B', 3, None, [messages.readyForQuery('idle')])
+        w.close()
+        r = CaptureReader(path)
+        self.addCleanup(r.close)
+        return r
+
+
+    def test_streams(self):
+        """
+        Connections are in the order they started, and their statements are
+        read from the capture, skipping what the backend sent.
+        """
+        r = self.capture()
+        streams = readStreams(r)
+        self.assertEqual(len(streams), 3)
+        starts = [ts for ts, _ in streams]
+        self.assertEqual(starts, sorted(starts))
+        self.assertTrue(starts[0] >= r.start)
+        self.assertEqual([[label for _, label, _ in ss] for _, ss in streams],
+                         [['startup', 'SELECT', 'SELECT'],
+                          ['startup', 'INSERT'], []])
+
+
+    def test_streams_for_test(self):
+        streams = readStreams(self.capture(), 'foo')
+        self.assertEqual([[label for _, label, _ in ss] for _, ss in streams],
+                         [['SELECT'], ['INSERT']])
+
+
+    def test_one_clock(self):
+        """
+        With a speed-up, statements are due relative to the start of the
+        whole replay, not to the start of their connection.
+        """
+        replay = Replay({'speedup': 2.0})
+        replay.began, replay.first = time.time() - 1.0, 100.0
+        self.assertEqual(replay.wait(101.0), None)
+        d = replay.wait(104.0)
+        self.assertNotEqual(d, None)
+        d.cancel()
+        return self.assertFailure(d, defer.CancelledError)
+
+
+
+class MicroTests(unittest.TestCase):
+
+    def test_benchmarks_run(self):
+        results = micro.runBenchmarks(seconds=0.001)
+        self.assertTrue(results['allocations'] in ('blocks', 'objects'))
+        results = results['benchmarks']
+        self.assertEqual(sorted(results), sorted([n for n, _ in micro.benchmarks]))
+        for r in results.values():
+            self.assertTrue(r['messages_per_second'] > 0)
+            self.assertTrue(isinstance(r['allocations_per_message'], float))
+
+
+    def test_frontend_filter_answered(self):
+        """
+        The queries of the filter benchmark are answered, so the server 
+        is free after each run and nothing builds up. 
+        """
+        made, _proxy = [], micro._proxy
+        def proxy():
+            made.append(_proxy())
+            return made[-1]
+        self.patch(micro, '_proxy', proxy)
+        clock = task.Clock()
+        self.patch(filters, 'reactor', clock)
+        run = micro.frontend_filter_q()[0]
+        b, f = made[0]
+        for _ in range(3):
+            run()
+            clock.advance(0)
+            self.assertEqual(b.owner, None)
+            self.assertEqual(b.pendingReplies, 0)
+            self.assertEqual(b.filter.dropMessages, '')
+
+
+    def test_compare(self):
+        def results(**rates):
+            return {'benchmarks': dict(
+                    [(k, {'messages_per_second': v}) for k, v in rates.items()])}
+        rows = micro.compare(results(a=100.0, b=100.0, c=1.0),
+                             results(a=110.0, b=90.0))
+        self.assertEqual(rows, [('a', 100.0, 110.0, 10.0),
+                                ('b', 100.0, 90.0, -10.0)])
+        out = StringIO()
+        self.assertEqual(micro.printComparison(out, rows, 5.0), 1)
+        self.assertTrue('REGRESSION' in out.getvalue().splitlines()[2])
+
+
+
+class ClientsTests(unittest.TestCase):
+
+    def test_counts_run(self):
+        results = clients.runCounts([1, 100], seconds=0.001)['counts']
+        self.assertEqual(sorted(results), ['1', '100'])
+        for r in results.values():
+            self.assertTrue(r['usec_per_message'] > 0)
+        out = StringIO()
+        clients.printResults(out, {'counts': results})
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+
+class EndToEndTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeBackendFactory()
+        self.backendPort = reactor.listenTCP(
+            0, self.backend, interface='127.0.0.1')
+        self.proxy = PGProxyServerFactory(_Service({
+                    'server-host': '127.0.0.1',
+                    'server-port': self.backendPort.getHost().port}))
+        self.proxyPort = reactor.listenTCP(0, self.proxy, interface='127.0.0.1')
+        self.e2e = EndToEnd({'server-host': '127.0.0.1', 'clients': 3,
+                             'queries': 5, 'large-rows': 100,
+                             'user': 'postgres', 'database': None})
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.proxyPort.stopListening()
+        yield self.backendPort.stopListening()
+        yield defer.gatherResults([p.lost for p in self.backend.protocols])
+
+
+    @defer.inlineCallbacks
+    def _workload_test(self, name, queries):
+        for port in (self.backendPort, self.proxyPort):
+            s = yield self.e2e.runWorkload(name, port.getHost().port)
+            self.assertEqual(s['count'], queries)
+        self.assertEqual(self.e2e.errors, 0)
+
+
+    def test_short(self):
+        return self._workload_test('short', 15)
+
+
+    def test_large(self):
+        return self._workload_test('large', 15)
+
+
+    def test_churn(self):
+        return self._workload_test('churn', 15)
+
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_modes_run(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        results = startup.runModes(['subprocess', 'inprocess'], 1, port)
+        for name in ('subprocess', 'inprocess'):
+            r = results['modes'][name]
+            self.assertEqual(r['start']['count'], 1)
+            self.assertTrue(r['first_query']['p50'] >= r['start']['p50'])
+        out = StringIO()
+        startup.printResults(out, results)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+
+
+    def test_unknown_mode(self):
+        from twisted.python import usage
+        self.assertRaises(usage.UsageError, startup.Options().parseOptions,
+                          ['--modes=subprocess,fork'])
@@ -0,0 +1,118 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.budget import Budget, BudgetError, parse
+from pgproxy.report import TestReport
+from pgproxy.stats import ProxyStats
+from pgproxy import messages, filters
+
+
+
+class BudgetTests(unittest.TestCase):
+
+    def test_parse(self):
+        b = parse('t', 'max_queries = 2, max_backend_ms=1.5,max_rows=10')
+        self.assertEqual(b.maxima, {'max_queries': 2, 'max_backend_ms': 1.5,
+                                    'max_rows': 10})
+
+
+    def test_parse_zero(self):
+        b = parse('t', 'max_backend_ms = 0.0, max_rows = 0')
+        self.assertEqual(b.maxima, {'max_backend_ms': 0.0, 'max_rows': 0})
+        self.assertEqual(type(b.maxima['max_backend_ms']), float)
+
+
+    def test_parse_errors(self):
+        self.assertRaises(BudgetError, parse, 't', 'max_queries')
+        self.assertRaises(BudgetError, parse, 't', 'max_tables = 2')
+
+
+    def test_violations(self):
+        b = Budget('t', max_queries=2, max_rows=10)
+        b.queries, b.rows = 3, 10
+        self.assertEqual(b.violations(), ['queries 3 > 2'])
+
+
+
+class BudgetProxyTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(filters, 'reactor', self.clock)
+
+
+    def runTest(self, budget, queries=3, action='fail'):
+        b, f = self.protocols()
+        b.transport = CollectingTransport()
+        f.transport = CollectingTransport()
+        b.stats = f.stats = ProxyStats()
+        b.stats.tests = TestReport()
+        b.budgetAction = action
+        self.receiveAuth(b)
+
+        f.messageReceived(messages.query("begin test 'foo' %s" % budget))
+        b.messageReceived(messages.commandComplete('BEGIN'))
+        b.messageReceived(messages.readyForQuery('transaction'))
+        for i in range(queries):
+            f.messageReceived(messages.query('select %d' % i))
+            b.messageReceived(messages.dataRow(['1']))
+            b.messageReceived(messages.commandComplete('SELECT 1'))
+            b.messageReceived(messages.readyForQuery('transaction'))
+        self.clock.advance(0)
+        del f.transport.data[:]
+
+        f.messageReceived(messages.query("rollback test 'foo'"))
+        self.clock.advance(0)
+        b.messageReceived(messages.commandComplete('ROLLBACK'))
+        b.messageReceived(messages.readyForQuery('idle'))
+        self.clock.advance(0)
+        return b, f, [d[0] for d in f.transport.data]
+
+
+    def test_within_budget(self):
+        b, f, types = self.runTest('with (max_queries = 3, max_rows = 3)')
+        self.assertEqual(types, ['C', 'Z'])
+        self.assertEqual(b.stats.tests.tests['foo'].violations, [])
+
+
+    def test_over_budget_fails(self):
+        b, f, types = self.runTest('with (max_queries=2)')
+        self.assertEqual(types, ['E', 'Z'])
+        self.assertTrue('queries 3 > 2' in f.transport.data[0])
+        self.assertEqual(b.stats.tests.tests['foo'].violations,
+                         ['queries 3 > 2'])
+
+
+    def test_over_budget_reported(self):
+        b, f, types = self.runTest('with (max_rows=1)', action='report')
+        self.assertEqual(types, ['C', 'Z'])
+        self.assertEqual(b.stats.tests.tests['foo'].violations,
+                         ['rows 3 > 1'])
+
+
+    def test_zero_float_budget(self):
+        b, f, types = self.runTest('with (max_rows = 0.0)')
+        self.assertEqual(types, ['E', 'Z'])
+        self.assertEqual(b.stats.tests.tests['foo'].violations,
+                         ['rows 3 > 0.0'])
+
+
+    def test_budget_ends_with_test(self):
+        b, f, types = self.runTest('with (max_queries=2)')
+        self.assertEqual(b.budget, None)
+        b, f, types = self.runTest('', queries=5)
+        self.assertEqual(types, ['C', 'Z'])
+
+
+    def test_bad_budget(self):
+        b, f = self.protocols()
+        b.transport.expectNothing()
+        self.receiveAuth(b)
+        f.transport = CollectingTransport()
+        f.messageReceived(
+            messages.query("begin test 'foo' with (max_tables = 1)"))
+        self.clock.advance(0)
+        self.assertEqual(len(f.transport.data), 1)
+        self.assertTrue(f.transport.data[0].startswith('E'))
+        self.assertTrue('unknown budget limit' in f.transport.data[0])
+        self.assertFalse(b.inTest())
@@ -0,0 +1,122 @@
+from corefilter import FilterTest
+from twisted.trial import unittest
+from pgproxy.capture import CaptureWriter, CaptureReader
+from pgproxy import messages
+import threading
+
+
+
+class CaptureFileTests(unittest.TestCase):
+
+    def capture(self):
+        path = self.mktemp()
+        w = CaptureWriter(path)
+        w.record('F', 1, None, [messages.startup('postgres')])
+        w.record('F', 1, 'foo', [messages.query('select 1')])
+        w.record('B', 1, 'foo', [messages.commandComplete('SELECT 1'),
+                                 messages.readyForQuery('transaction')])
+        w.record('F', 2, 'bar', [messages.query('select 2')])
+        w.record('F', 1, 'foo', [messages.query('select 3')])
+        w.close()
+        self.assertEqual(w.written, 6)
+        r = CaptureReader(path)
+        self.addCleanup(r.close)
+        return r
+
+
+    def test_tests(self):
+        self.assertEqual(self.capture().tests(), ['foo', 'bar'])
+
+
+    def test_all_records(self):
+        rs = list(self.capture().records())
+        self.assertEqual([(d, c, t) for d, c, _, t, _ in rs],
+                         [('F', 1, '\x00'), ('F', 1, 'Q'), ('B', 1, 'C'),
+                          ('B', 1, 'Z'), ('F', 2, 'Q'), ('F', 1, 'Q')])
+        self.assertEqual(rs[1][4], messages.query('select 1').serialize())
+
+
+    def test_runs(self):
+        runs = list(self.capture().runs())
+        self.assertEqual([(t, c) for t, c, _, _, _ in runs],
+                         [(None, 1), ('foo', 1), ('bar', 2), ('foo', 1)])
+        offsets = [o for _, _, o, _, _ in runs]
+        self.assertEqual(offsets, sorted(offsets))
+
+
+    def test_records_for_test(self):
+        rs = list(self.capture().records(test='foo'))
+        self.assertEqual(
+            [data for _, _, _, _, data in rs],
+            [messages.query('select 1').serialize(),
+             messages.commandComplete('SELECT 1').serialize(),
+             messages.readyForQuery('transaction').serialize(),
+             messages.query('select 3').serialize()])
+
+
+    def test_records_for_client(self):
+        rs = list(self.capture().records(client=2))
+        self.assertEqual(len(rs), 1)
+        self.assertEqual(list(self.capture().records(test='nope')), [])
+
+
+    def test_full_queue_drops(self):
+        """
+        Messages are dropped rather than waiting for a writer that can't 
+        keep up. 
+        """
+        started, release = threading.Event(), threading.Event()
+        writeRecord = CaptureWriter.writeRecord
+        def blockedWrite(self, *a):
+            started.set()
+            release.wait()
+            writeRecord(self, *a)
+        self.patch(CaptureWriter, 'writeRecord', blockedWrite)
+
+        w = CaptureWriter(self.mktemp(), maxQueue=1)
+        w.record('F', 1, None, [messages.query('select 0')])
+        started.wait(10)
+        # the writer is busy with the first message, and the queue has 
+        # room for one more. 
+        for i in range(1, 4):
+            w.record('F', 1, None, [messages.query('select %d' % i)])
+        self.assertEqual(w.dropped, 2)
+        release.set()
+        w.close()
+        self.assertEqual(w.written, 2)
+
+
+
+class FakeCapture(object):
+    def __init__(self):
+        self.records = []
+
+
+    def record(self, direction, clientId, test, ms):
+        for m in ms:
+            self.records.append((direction, clientId, test, str(m)))
+
+
+
+class ProtocolCaptureTests(FilterTest):
+
+    def test_directions(self):
+        b, f = self.protocols()
+        b.capture = f.capture = c = FakeCapture()
+        f.connectionId = 7
+        b.signalTest(True, 'foo')
+
+        f.messageReceived(messages.query('select 1'))
+        b.messageReceived(messages.commandComplete('SELECT 1'))
+        self.assertEqual(c.records, [
+                ('F', 7, 'foo', 'Q select 1'),
+                ('b', 7, 'foo', 'Q select 1'),
+                ('B', 7, 'foo', 'C[SELECT 1]'),
+                ('f', 7, 'foo', 'C[SELECT 1]')])
+
+
+    def test_spoofs_captured(self):
+        b, f = self.protocols()
+        f.capture = c = FakeCapture()
+        f.messageReceived(messages.query('commit'))
+        self.assertEqual([r[0] for r in c.records], ['F', 'f', 'f'])
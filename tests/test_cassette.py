@@ -0,0 +1,248 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from corefilter import MockTransport, CollectingTransport
+from pgproxy.cassette import (Cassette, RecordingPostgresProtocol,
+                              ReplayPostgresProtocol, ReplayTransport,
+                              interactionKey, scrubPasswords)
+from pgproxy.data import pack_int32
+from pgproxy.proxy import PGProxyProtocol
+from pgproxy import messages, cassette
+import os
+
+
+
+def serialize(*ms):
+    return ''.join([m.serialize() for m in ms])
+
+
+auth = serialize(messages.authenticationOk(),
+                 messages.parameterStatus('foo', 'bar'),
+                 messages.readyForQuery('idle'))
+
+md5Request = messages._message('R', pack_int32(5) + 'salt').serialize()
+password = messages._message('p', 'md5secret\x00',
+                             messages.FrontendMessage).serialize()
+
+
+
+class CassetteFileTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        c = Cassette()
+        c.prelude = [['startup', 'auth']]
+        q = messages.query('select 1').serialize()
+        c.untested[interactionKey(q)] = [q, ['one', 'two']]
+        c.tests['foo'] = [['a', 'b'], ['c', '']]
+
+        path = self.mktemp()
+        c.save(path)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        c2 = Cassette.load(path)
+        self.assertEqual(c2.prelude, [['startup', 'auth']])
+        self.assertEqual(c2.untested, {interactionKey(q): [q, 'onetwo']})
+        self.assertEqual(c2.tests, {'foo': [['a', 'b'], ['c', '']]})
+
+
+    def test_not_a_cassette(self):
+        path = self.mktemp()
+        open(path, 'wb').write('nope')
+        self.assertRaises(ValueError, Cassette.load, path)
+
+
+    def test_passwords_scrubbed_on_load(self):
+        startup = messages.startup('postgres').serialize()
+        c = Cassette()
+        c.prelude = [[startup, md5Request], [password, auth]]
+        path = self.mktemp()
+        c.save(path)
+        c2 = Cassette.load(path)
+        self.assertEqual(c2.prelude[0], [startup, md5Request])
+        self.assertFalse('secret' in c2.prelude[1][0])
+        self.assertEqual(c2.prelude[1][0], scrubPasswords(password))
+
+
+    def test_savepoint_names_ignored(self):
+        self.assertEqual(
+            interactionKey(messages.query('SAVEPOINT sp_1_2').serialize()),
+            interactionKey(messages.query('SAVEPOINT sp_3_45').serialize()))
+
+
+
+class RecordingTests(unittest.TestCase):
+
+    def test_interactions_recorded_per_test(self):
+        c = Cassette()
+        b = RecordingPostgresProtocol(c)
+        b.makeConnection(MockTransport())
+
+        startup = messages.startup('postgres').serialize()
+        b.transport.write(startup)
+        b.dataReceived(auth)
+        self.assertEqual(c.prelude, [[startup, [auth]]])
+
+        b.signalTest(True, 'foo')
+        begin = messages.query('BEGIN; -- foo').serialize()
+        b.transport.write(begin)
+        b.dataReceived('reply1')
+        b.signalTest(False, 'foo')
+        rollback = messages.query('ROLLBACK; -- foo').serialize()
+        b.transport.write(rollback)
+        b.dataReceived('reply2')
+
+        # after the rollback, we're outside of the test again.
+        q = messages.query('select 1').serialize()
+        b.transport.write(q)
+
+        self.assertEqual(c.tests['foo'], [[begin, ['reply1']],
+                                          [rollback, ['reply2']]])
+        self.assertEqual(c.untested.keys(), [interactionKey(q)])
+
+
+
+    def test_password_not_recorded(self):
+        c = Cassette()
+        b = RecordingPostgresProtocol(c)
+        b.makeConnection(CollectingTransport())
+        startup = messages.startup('postgres').serialize()
+        b.transport.write(startup)
+        b.dataReceived(md5Request)
+        b.transport.write(password)
+        b.dataReceived(auth)
+
+        # the server still gets the password. 
+        self.assertEqual(b.transport.transport.data, [startup, password])
+        self.assertEqual([[d, ''.join(r)] for d, r in c.prelude],
+                         [[startup, md5Request], [scrubPasswords(password), 
+                                                  auth]])
+        self.assertFalse('secret' in c.prelude[1][0])
+
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(cassette, 'reactor', self.clock)
+
+
+    def replay(self, cassette, onDivergence='fail', connect=None):
+        b = ReplayPostgresProtocol(cassette, onDivergence, connect)
+        b.makeConnection(ReplayTransport(b))
+        f = PGProxyProtocol()
+        f.transport = CollectingTransport()
+        f.postgresProtocol = b
+        b.attachClient(f)
+        return b, f
+
+
+    def cassette(self):
+        c = Cassette()
+        c.prelude = [[messages.startup('postgres').serialize(), auth]]
+        c.tests['foo'] = [
+            [messages.query('BEGIN; -- foo').serialize(),
+             serialize(messages.commandComplete('BEGIN'),
+                       messages.readyForQuery('transaction'))],
+            [messages.query('select 1').serialize(),
+             serialize(messages.commandComplete('SELECT 1'),
+                       messages.readyForQuery('transaction'))],
+            [messages.query('ROLLBACK; -- foo').serialize(),
+             serialize(messages.commandComplete('ROLLBACK'),
+                       messages.readyForQuery('idle'))],]
+        return c
+
+
+    def run_test(self, f, *queries):
+        """
+        Runs the queries in test foo, returning the data the client
+        received in reply to each one. 
+        """
+        f.messageReceived(messages.startup('postgres'))
+        self.clock.advance(0)
+        replies = []
+        for q in ("begin test 'foo'",) + queries + ("rollback test 'foo'",):
+            f.transport.data = []
+            f.messageReceived(messages.query(q))
+            self.clock.advance(0)
+            replies.append(''.join(f.transport.data))
+        return replies
+
+
+    def test_replayed_from_cassette(self):
+        b, f = self.replay(self.cassette())
+        data = self.run_test(f, 'select 1')
+        c = self.cassette()
+        self.assertEqual(data, [i[1] for i in c.tests['foo']])
+        self.assertTrue(b.authenticationComplete)
+
+
+    def test_divergence_fails_test(self):
+        b, f = self.replay(self.cassette())
+        data = self.run_test(f, 'select 2', 'select 1')
+        self.assertEqual(data[1], serialize(
+                ReplayPostgresProtocol.divergence_error,
+                messages.readyForQuery('failed')))
+
+        # the rest of the test fails, even if it matches again, but the
+        # rollback succeeds.
+        self.assertEqual(data[2], data[1])
+        self.assertEqual(data[3], serialize(
+                messages.commandComplete('ROLLBACK'),
+                messages.readyForQuery('idle')))
+
+
+    def test_divergence_falls_back(self):
+        live = CollectingTransport()
+        calls = []
+        def connect(cls, replay, skip):
+            p = cls(replay, skip)
+            p.makeConnection(live)
+            calls.append(p)
+            return defer.succeed(p)
+
+        b, f = self.replay(self.cassette(), 'fallback', connect)
+        self.run_test(f, 'select 2')
+
+        c = self.cassette()
+        p = calls[0]
+
+        # startup and BEGIN are replayed to the live server, and their
+        # replies skipped.
+        self.assertEqual(p.skip, 2)
+        self.assertEqual(live.data[0], ''.join([
+                    c.prelude[0][0], c.tests['foo'][0][0],
+                    messages.query('select 2').serialize()]))
+        self.assertEqual(live.data[1],
+                         messages.query('ROLLBACK; -- foo').serialize())
+
+
+    def test_no_fallback_with_password(self):
+        """
+        A replay whose server asked for a password can't authenticate a 
+        fallback connection, so it fails the diverging query instead. 
+        """
+        calls = []
+        def connect(cls, replay, skip):
+            calls.append(replay)
+            return defer.Deferred()
+
+        c = self.cassette()
+        startup = c.prelude[0][0]
+        c.prelude = [[startup, md5Request], [scrubPasswords(password), auth]]
+        b, f = self.replay(c, 'fallback', connect)
+        f.messageReceived(messages.startup('postgres'))
+        self.clock.advance(0)
+        f.messageReceived(messages._message('p', 'md5other\x00', 
+                                            messages.FrontendMessage))
+        self.clock.advance(0)
+        self.assertTrue(b.authenticationComplete)
+
+        f.messageReceived(messages.query("begin test 'foo'"))
+        self.clock.advance(0)
+        f.transport.data = []
+        f.messageReceived(messages.query('select 2'))
+        self.clock.advance(0)
+        self.assertEqual(calls, [])
+        self.assertEqual(''.join(f.transport.data), serialize(
+                ReplayPostgresProtocol.divergence_error,
+                messages.readyForQuery('failed')))
@@ -0,0 +1,164 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from pgproxy.fakebackend import FakeBackendFactory, QueryError
+from pgproxy.proxy import PGProxyServerFactory
+from pgproxy.bench.client import connect
+from pgproxy import messages
+
+
+
+class _Service(object):
+
+    def __init__(self, config):
+        self.config = config
+
+
+
+class FakeBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeBackendFactory()
+        self.port = reactor.listenTCP(0, self.factory, interface='127.0.0.1')
+        self.clients = []
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for c in self.clients:
+            c.terminate()
+        yield self.port.stopListening()
+        yield defer.gatherResults([p.lost for p in self.factory.protocols])
+
+
+    @defer.inlineCallbacks
+    def connect(self, port=None):
+        c = yield connect('127.0.0.1', port or self.port.getHost().port)
+        self.clients.append(c)
+        got = []
+        c.messageReceived = self.collect(c, got)
+        yield c.startup()
+        c.received = got
+        defer.returnValue(c)
+
+
+    def collect(self, c, got):
+        received = c.messageReceived
+        def messageReceived(msg):
+            got.append(msg)
+            return received(msg)
+        return messageReceived
+
+
+    @defer.inlineCallbacks
+    def query(self, c, sql):
+        del c.received[:]
+        yield c.query(sql)
+        defer.returnValue([(m.type, m.data) for m in c.received])
+
+
+    @defer.inlineCallbacks
+    def test_startup(self):
+        c = yield self.connect()
+        types = [m.type for m in c.received]
+        self.assertEqual(types[0], 'R')
+        self.assertEqual(types[-2:], ['K', 'Z'])
+
+
+    @defer.inlineCallbacks
+    def test_select(self):
+        c = yield self.connect()
+        ms = yield self.query(c, 'select 42')
+        self.assertEqual(ms, [
+                ('T', messages.rowDescription(['?column?']).data),
+                ('D', messages.dataRow(['42']).data),
+                ('C', 'SELECT 1\x00'),
+                ('Z', 'I')])
+
+        ms = yield self.query(c, 'select * from fake_rows(3, 10)')
+        self.assertEqual([t for t, _ in ms], ['T', 'D', 'D', 'D', 'C', 'Z'])
+        self.assertEqual(ms[1][1], messages.dataRow(['x' * 10]).data)
+
+        ms = yield self.query(c, '')
+        self.assertEqual(ms, [('I', ''), ('Z', 'I')])
+
+
+    @defer.inlineCallbacks
+    def test_transaction_status(self):
+        c = yield self.connect()
+        ms = yield self.query(c, 'begin; insert into foo values (1)')
+        self.assertEqual(ms, [('C', 'BEGIN\x00'), ('C', 'INSERT 0 1\x00'),
+                              ('Z', 'T')])
+
+        ms = yield self.query(c, "select fake_error('boom')")
+        self.assertEqual(ms[0][0], 'E')
+        self.assertTrue('boom' in ms[0][1])
+        self.assertEqual(ms[-1], ('Z', 'E'))
+
+        ms = yield self.query(c, 'select 1')
+        self.assertTrue('25P02' in ms[0][1])
+
+        ms = yield self.query(c, 'commit')
+        self.assertEqual(ms, [('C', 'ROLLBACK\x00'), ('Z', 'I')])
+
+
+    @defer.inlineCallbacks
+    def test_extended_protocol(self):
+        c = yield self.connect()
+        parse = messages._message('P', 'p1\x00select 7\x00\x00\x00',
+                                  messages.FrontendMessage)
+        bind = messages._message('B', '\x00p1\x00' + '\x00' * 6,
+                                 messages.FrontendMessage)
+        describe = messages._message('D', 'P\x00', messages.FrontendMessage)
+        execute = messages._message('E', '\x00\x00\x00\x00\x00',
+                                    messages.FrontendMessage)
+        sync = messages._message('S', '', messages.FrontendMessage)
+        del c.received[:]
+        yield c.send(''.join([m.serialize() for m in
+                              (parse, bind, describe, execute, sync)]))
+        self.assertEqual([m.type for m in c.received],
+                         ['1', '2', 'T', 'D', 'C', 'Z'])
+
+
+    @defer.inlineCallbacks
+    def test_scripted_query(self):
+        self.factory.addQuery(r'select name from users where id = (\d+)',
+                              lambda m: (['name'], [['user%s' % m.group(1)]]))
+        def fail(m):
+            raise QueryError('no such table: widgets', '42P01')
+        self.factory.addQuery(r'select .* from widgets', fail)
+
+        c = yield self.connect()
+        ms = yield self.query(c, 'select name from users where id = 5')
+        self.assertEqual(ms[1], ('D', messages.dataRow(['user5']).data))
+
+        ms = yield self.query(c, 'select * from widgets')
+        self.assertTrue('42P01' in ms[0][1])
+
+
+    @defer.inlineCallbacks
+    def test_latency(self):
+        self.factory.latency = 0.05
+        c = yield self.connect()
+        latency = yield c.query('select 1')
+        self.assertTrue(latency >= 0.05, latency)
+
+
+    @defer.inlineCallbacks
+    def test_through_proxy(self):
+        config = {'server-host': '127.0.0.1',
+                  'server-port': self.port.getHost().port}
+        proxyFactory = PGProxyServerFactory(_Service(config))
+        proxyPort = reactor.listenTCP(0, proxyFactory, interface='127.0.0.1')
+        try:
+            c = yield self.connect(proxyPort.getHost().port)
+            ms = yield self.query(c, "begin test 'foo'")
+            self.assertEqual(ms[-1], ('Z', 'T'))
+            ms = yield self.query(c, 'select 3')
+            self.assertEqual(ms[1], ('D', messages.dataRow(['3']).data))
+            ms = yield self.query(c, "rollback test 'foo'")
+            self.assertEqual(ms[-1], ('Z', 'I'))
+        finally:
+            for c in self.clients:
+                c.terminate()
+            self.clients = []
+            yield proxyPort.stopListening()
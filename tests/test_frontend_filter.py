@@ -2,6 +2,7 @@ from corefilter import FilterTest
 from twisted.internet.defer import Deferred
 from pgproxy import messages
 from pgproxy.filters import FrontendFilter
+from pgproxy.bench.client import BenchClientProtocol
 
 
 
@@ -226,3 +227,114 @@ class FrontendFilterTests(FilterTest):
         f.messageReceived(messages.query('end work;'))
         return d
         
+
+
+    def test_begin_committed_test_spoofed(self):
+        return self._dropped_and_spoofed_test(
+            "BEGIN COMMITTED TEST 'test name'", 
+            FrontendFilter.spoofed_begin_committed)
+
+
+    def test_committed_test_writes_tracked(self):
+        b, f = self.protocols()
+        b.signalTest(True, 'test name', committed=True)
+        self.assertFalse(b.inTest())
+        f.messageReceived(messages.query('insert into foo values (1);'))
+        f.messageReceived(messages.query('select * from bar;'))
+        self.assertEqual(b.writeSets.tables('test name'), ['foo'])
+
+
+    def test_rollback_committed_test_truncates(self):
+        b, f = self.protocols()
+        b.signalTest(True, 'test name', committed=True)
+        f.messageReceived(messages.query('insert into foo values (1);'))
+        f.messageReceived(messages.query('update bar set x = 2;'))
+
+        d = Deferred()
+        b.transport.deferred = d
+
+        def check(data):
+            m = messages.query(
+                'TRUNCATE bar, foo RESTART IDENTITY CASCADE; -- test name')
+            self.assertEqual(data, m.serialize())
+            self.assertEqual(b.writeSets.tables('test name'), [])
+            self.assertFalse(b.committedTest)
+
+        d.addCallback(check)
+        f.messageReceived(messages.query("ROLLBACK TEST 'test name'"))
+        return d
+
+
+    def test_rollback_committed_test_without_writes_spoofed(self):
+        b, f = self.protocols()
+        b.signalTest(True, 'test name', committed=True)
+        b.transport.expectNothing()
+
+        d = Deferred()
+        f.transport.deferred = d
+
+        def check(data):
+            ms = FrontendFilter.spoofed_rollback_committed
+            self.assertEqual(data, ''.join([m.serialize() for m in ms]))
+
+        d.addCallback(check)
+        f.messageReceived(messages.query("ROLLBACK TEST 'test name'"))
+        return d
+
+
+    def _admin_test(self, sql, check):
+        b, f = self.protocols()
+        b.transport.expectNothing()
+        b.setTransactionStatus('idle')
+
+        d = Deferred()
+        f.transport.deferred = d
+
+        def parse(data):
+            p = BenchClientProtocol()
+            got = []
+            p.messageReceived = got.append
+            p.dataReceived(data)
+            self.assertEqual((got[-1].type, got[-1].transaction_status),
+                             ('Z', 'idle'))
+            check(got[:-1])
+
+        d.addCallback(parse)
+        f.messageReceived(messages.query(sql))
+        return d
+
+
+    def test_admin_clients(self):
+        def check(ms):
+            self.assertEqual([m.type for m in ms], ['T', 'D', 'C'])
+            self.assertEqual(ms[1].data, messages.dataRow(
+                    [0, None, 't', 'f', 0, 0]).data)
+        return self._admin_test('SHOW PGPROXY CLIENTS;', check)
+
+
+    def test_admin_pools(self):
+        def check(ms):
+            self.assertEqual([m.type for m in ms], ['T', 'D', 'C'])
+            self.assertTrue('authenticating' in ms[1].data)
+        return self._admin_test('show pgproxy pools', check)
+
+
+    def test_admin_unknown_command(self):
+        def check(ms):
+            self.assertEqual([m.type for m in ms], ['E'])
+            self.assertTrue('unknown pgproxy command: nope' in ms[0].data)
+        return self._admin_test('show pgproxy nope', check)
+
+
+    def test_admin_two_word_command(self):
+        def check(ms):
+            self.assertEqual([m.type for m in ms], ['E'])
+            self.assertTrue('(see --statements)' in ms[0].data)
+        return self._admin_test('show pgproxy dump\n statements;', check)
+
+
+    def test_admin_without_show(self):
+        def check(ms):
+            self.assertEqual([m.type for m in ms], ['E'])
+            self.assertTrue('unknown pgproxy command: nope' in ms[0].data)
+        return self._admin_test('PGPROXY NOPE;', check)
@@ -0,0 +1,207 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.proxy import PGProxyServerFactory, WriteBufferProducer
+from pgproxy.metrics import render
+from pgproxy import memory, messages, filters, admin
+from test_fake_backend import _Service
+
+
+
+class _Transport(CollectingTransport):
+    """
+    A transport with the buffers of a Twisted TCP connection.
+    """
+    dataBuffer = 'x' * 10
+    offset = 4
+    _tempDataLen = 100
+
+
+
+class MemoryTests(FilterTest):
+
+    def setUp(self):
+        self.patch(filters, 'reactor', task.Clock())
+
+
+    def test_transportBytes(self):
+        self.assertEqual(memory.transportBytes(_Transport()), 106)
+        self.assertEqual(memory.transportBytes(CollectingTransport()), 0)
+
+
+    def test_transportBytes_without_twisted_buffers(self):
+        """
+        The private buffers of a Twisted transport are optional, and ones 
+        that aren't what's expected count as empty. 
+        """
+        bare = object()
+        self.assertEqual(memory.transportBytes(bare), 0)
+        t = CollectingTransport()
+        t.dataBuffer = 'x' * 10
+        self.assertEqual(memory.transportBytes(t), 10)
+        t = CollectingTransport()
+        t._tempDataLen = 100
+        self.assertEqual(memory.transportBytes(t), 100)
+        t = CollectingTransport()
+        t.dataBuffer, t.offset, t._tempDataLen = ['x'], None, '100'
+        self.assertEqual(memory.transportBytes(t), 0)
+        t = _Transport()
+        t.offset = 20
+        self.assertEqual(memory.transportBytes(t), 100)
+
+
+    def test_show_and_metrics_without_twisted_buffers(self):
+        """
+        SHOW PGPROXY MEMORY and the metrics work with a transport that 
+        has none of the buffers they look at. 
+        """
+        class BareTransport(object):
+            def write(self, data):
+                pass
+        factory, b, f = self.factory()
+        f.transport = b.transport = BareTransport()
+        WriteBufferProducer(f, 1 << 20, 1 << 18).pauseProducing()
+        f.dataReceived(messages.query('select 1').serialize()[:7])
+
+        columns, rows = admin.memoryUsage(f)
+        rows = dict([(r[0], r) for r in rows])
+        self.assertEqual(sorted(rows), [1, 'server'])
+        self.assertEqual(rows[1][columns.index('transport')], 0)
+        self.assertEqual(rows[1][columns.index('parse')], 7)
+        lines = render(factory).splitlines()
+        self.assertTrue('pgproxy_memory_bytes{kind="transport"} 0' in lines)
+        self.assertTrue('pgproxy_memory_bytes{kind="parse"} 7' in lines)
+
+
+    def factory(self):
+        factory = PGProxyServerFactory(_Service({'memory-top': 1}))
+        b, f = self.protocols()
+        f.connectionId = 1
+        f.factory = factory
+        f.memory = b.memory = factory.memory
+        factory.postgresProtocol = b
+        self.receiveAuth(b)
+        return factory, b, f
+
+
+    def test_usage(self):
+        factory, b, f = self.factory()
+        f.transport = _Transport()
+        f.dataReceived(messages.query('select 1').serialize()[:7])
+
+        server, client = memory.usage(factory)
+        self.assertEqual(server.connection, 'server')
+        self.assertEqual(server.auth, sum([m.length for m in 
+                                           b.authenticationResponse]))
+        self.assertEqual((client.connection, client.parse, client.transport),
+                         (1, 7, 106))
+        self.assertEqual(memory.top([server, client], 1), [client])
+        self.assertEqual(memory.totals([server, client])['transport'], 106)
+
+        columns, rows = admin.memoryUsage(f)
+        self.assertEqual(rows[0][0], 1)
+        self.assertEqual(rows[0][columns.index('total')], 113)
+
+
+    def test_held(self):
+        factory, b, f = self.factory()
+        other = f.__class__()
+        other.transport = CollectingTransport()
+        other.postgresProtocol = b
+        other.connectionId = 2
+        b.attachClient(other)
+
+        f.messageReceived(messages.query('select 1'))
+        other.messageReceived(messages.query('select 2'))
+        held = [c.held for c in memory.usage(factory) if c.connection == 2]
+        self.assertEqual(held, [messages.query('select 2').length])
+
+
+    def test_metrics(self):
+        factory, b, f = self.factory()
+        f.transport = _Transport()
+        lines = render(factory).splitlines()
+        self.assertTrue('pgproxy_memory_bytes{kind="transport"} 0' in lines)
+
+        # the transport is only looked at once it's been backlogged. 
+        WriteBufferProducer(f, 1 << 20, 1 << 18).pauseProducing()
+        lines = render(factory).splitlines()
+        self.assertTrue('pgproxy_memory_bytes{kind="transport"} 106' in lines)
+        self.assertTrue(
+            'pgproxy_connection_memory_bytes{connection="1"} 106' in lines)
+        self.assertEqual(
+            len([l for l in lines 
+                 if l.startswith('pgproxy_connection_memory_bytes{')]), 1)
+
+        # and forgotten once it's found to be empty. 
+        f.transport = CollectingTransport()
+        lines = render(factory).splitlines()
+        self.assertTrue('pgproxy_memory_bytes{kind="transport"} 0' in lines)
+        self.assertEqual(factory.memory.backlogged, set())
+
+
+    def test_running_totals(self):
+        """
+        The accounts agree with what's computed from the protocols, as 
+        messages are buffered and drained. 
+        """
+        factory, b, f = self.factory()
+        other = f.__class__()
+        other.transport = CollectingTransport()
+        other.postgresProtocol = b
+        other.connectionId = 2
+        other.memory = factory.memory
+        b.attachClient(other)
+        accounts = factory.memory
+
+        def check(parse, held):
+            computed = memory.totals(memory.usage(factory))
+            self.assertEqual((accounts.parse, accounts.held), (parse, held))
+            self.assertEqual((computed['parse'], computed['held']), 
+                             (parse, held))
+            t = accounts.totals(accounts.connections(b))
+            self.assertEqual((t['parse'], t['held']), (parse, held))
+
+        q1, q2 = messages.query('select 1'), messages.query('select 2')
+        f.dataReceived(q1.serialize()[:7])
+        check(7, 0)
+        f.dataReceived(q1.serialize()[7:])
+        check(0, 0)
+        other.dataReceived(q2.serialize() + q2.serialize()[:3])
+        check(3, q2.length)
+        self.assertEqual(accounts.holding, set([other]))
+
+        # the server's reply lets other's held query go. 
+        b.dataReceived(messages.readyForQuery('idle').serialize()[:2])
+        check(5, q2.length)
+        b.dataReceived(messages.readyForQuery('idle').serialize()[2:])
+        check(3, 0)
+
+        other.connectionLost()
+        check(0, 0)
+        self.assertEqual(accounts.holding, set())
+
+
+    def test_idle_clients_not_scraped(self):
+        factory, b, f = self.factory()
+        for i in range(100):
+            c = f.__class__()
+            c.transport = CollectingTransport()
+            c.postgresProtocol = b
+            b.attachClient(c)
+        f.dataReceived(messages.query('select 1').serialize()[:7])
+        connections = factory.memory.connections(b)
+        self.assertEqual([c.connection for c in connections], ['server', 1])
+
+
+    def test_memory_diff(self):
+        b, f = self.protocols()
+        if memory.tracemalloc is None:
+            self.assertRaises(admin.AdminError, admin.memoryDiff, f)
+            return
+        snapshots = memory.SnapshotDiff()
+        self.patch(memory, 'snapshots', snapshots)
+        self.assertEqual(admin.memoryDiff(f)[1], [])
+        self.assertTrue(memory.tracemalloc.is_tracing())
+        admin.memoryDiff(f)
+        memory.tracemalloc.stop()
@@ -239,3 +239,40 @@ class MessageTests(unittest.TestCase):
         self.assertEqual(m.serialize(), 'E\x00\x00\x00\x05\x00')
         self.assertEqual(m.fields, [])
 
+
+    def test_noticeResponse(self):
+        m = messages.noticeResponse(('S', 'WARNING'), ('M', 'hi'))
+        self.assertEqual(
+            m.serialize(), 'N\x00\x00\x00\x12SWARNING\x00Mhi\x00\x00')
+
+
+
+    def test_rowDescription(self):
+        m = messages.rowDescription(['a', 'bc'])
+        self.assertEqual(m.type, 'T')
+        self.assertEqual(m.length, 1 + 4 + 2 + (2 + 18) + (3 + 18))
+        self.assertEqual(m.data[:4], '\x00\x02a\x00')
+
+
+    def test_dataRow(self):
+        self.assertEqual(
+            messages.dataRow(['ab', None, 5]).serialize(),
+            'D\x00\x00\x00\x15\x00\x03'
+            '\x00\x00\x00\x02ab'
+            '\xff\xff\xff\xff'
+            '\x00\x00\x00\x015')
+
+
+    def test_backendKeyData(self):
+        self.assertEqual(
+            messages.backendKeyData(1, 2).serialize(),
+            'K\x00\x00\x00\x0c\x00\x00\x00\x01\x00\x00\x00\x02')
+
+
+    def test_empty_messages(self):
+        for f, t in ((messages.parseComplete, '1'),
+                     (messages.bindComplete, '2'),
+                     (messages.closeComplete, '3'),
+                     (messages.noData, 'n'),
+                     (messages.emptyQueryResponse, 'I')):
+            self.assertEqual(f().serialize(), t + '\x00\x00\x00\x04')
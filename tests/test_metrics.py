@@ -0,0 +1,47 @@
+from corefilter import FilterTest
+from twisted.internet import task
+from pgproxy.proxy import PGProxyServerFactory
+from pgproxy.metrics import render
+from pgproxy import messages, filters
+from test_fake_backend import _Service
+
+
+
+class MetricsTests(FilterTest):
+
+    def setUp(self):
+        self.patch(filters, 'reactor', task.Clock())
+
+
+    def test_render(self):
+        factory = PGProxyServerFactory(_Service({}))
+        b, f = self.protocols()
+        b.stats = f.stats = factory.stats
+        factory.postgresProtocol = b
+        factory.stats.countConnection('client_opened')
+        self.receiveAuth(b)
+        f.messageReceived(messages.query('select 1'))
+        b.messageReceived(messages.readyForQuery('idle'))
+
+        lines = render(factory).splitlines()
+        for l in ('# TYPE pgproxy_reply_latency_seconds histogram',
+                  'pgproxy_client_connections 1',
+                  'pgproxy_server_up 1',
+                  'pgproxy_messages_total{direction="from_client",type="Q"} 1',
+                  'pgproxy_bytes_total{direction="to_server",type="Q"} %d' %
+                  len(messages.query('select 1').serialize()),
+                  'pgproxy_reply_latency_seconds_bucket{le="+Inf",type="Q"} 1',
+                  'pgproxy_reply_latency_seconds_count{type="Q"} 1',
+                  'pgproxy_buffered_bytes 0',):
+            self.assertTrue(l in lines, l)
+
+
+    def test_stage_timing(self):
+        factory = PGProxyServerFactory(_Service({'stage-timing': True}))
+        self.assertFalse('pgproxy_stage_seconds_total' in 
+                         render(PGProxyServerFactory(_Service({}))))
+        factory.timing.add('filter', 'FQ', 1, 0.25)
+        self.assertTrue(
+            'pgproxy_stage_seconds_total{direction="from_client",'
+            'stage="filter",type="Q"} 0.250000' in 
+            render(factory).splitlines())
@@ -0,0 +1,51 @@
+from twisted.trial import unittest
+from twisted.python import usage
+from pgproxy import options, twistd
+import os
+import subprocess
+import sys
+
+
+
+class OptionsTests(unittest.TestCase):
+
+    def test_defaults(self):
+        d = options.defaults()
+        self.assertEqual(d['listen-port'], 5433)
+        self.assertEqual(d['on-divergence'], 'fallback')
+        self.assertEqual(d['stage-timing'], False)
+
+
+    def test_validated(self):
+        self.assertRaises(usage.UsageError, options.Options().parseOptions,
+                          ['--on-divergence=ignore'])
+        self.assertRaises(usage.UsageError, twistd.Options().parseOptions,
+                          ['--budget-action=ignore'])
+
+
+    def test_same_as_twistd(self):
+        config = options.Options()
+        config.parseOptions(['--listen-port=0', '--stage-timing'])
+        full = twistd.Options()
+        full.parseOptions(['--listen-port=0', '--stage-timing'])
+        for k, v in config.items():
+            self.assertEqual(full[k], v)
+
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_twisted_not_imported(self):
+        """
+        Importing pgproxy to start a proxy doesn't import Twisted.
+        """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(
+                    options.__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + filter(None, [env.get('PYTHONPATH')]))
+        out = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, pgproxy; '
+             'print sorted(m for m in sys.modules if "twisted" in m)'],
+            stdout=subprocess.PIPE, env=env).communicate()[0]
+        self.assertEqual(out.strip(), '[]')
@@ -1,5 +1,7 @@
 from twisted.trial import unittest
-from pgproxy.proxy import PostgresClientProtocol
+from corefilter import CollectingTransport
+from pgproxy.proxy import PostgresClientProtocol, PGProxyProtocol
+from pgproxy import messages
 
 
 
@@ -32,3 +34,171 @@ class PostgresProtocolTests(unittest.TestCase):
         self.assertEqual(p.currentClient(), c1)
 
 
+
+
+    def test_clients_wait_for_replies(self):
+        p = PostgresClientProtocol()
+        p.transport = CollectingTransport()
+        a, b = PGProxyProtocol(), PGProxyProtocol()
+        for c in (a, b):
+            c.transport = CollectingTransport()
+            c.postgresProtocol = p
+
+        # b connects after a has sent its query, but a still gets the reply.
+        qa, qb = messages.query('select 1'), messages.query('select 2')
+        p.attachClient(a)
+        a.messageReceived(qa)
+        p.attachClient(b)
+        b.messageReceived(qb)
+        self.assertEqual(p.transport.data, [qa.serialize()])
+        self.assertTrue(b.transport.paused)
+
+        # b's query is sent once a has its reply. 
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual(p.transport.data, [qa.serialize(), qb.serialize()])
+        self.assertFalse(b.transport.paused)
+        self.assertEqual(len(a.transport.data), 2)
+        self.assertEqual(p.owner, b)
+
+
+    def clients(self, n):
+        p = PostgresClientProtocol()
+        p.transport = CollectingTransport()
+        clients = [PGProxyProtocol() for _ in range(n)]
+        for c in clients:
+            c.transport = CollectingTransport()
+            c.postgresProtocol = p
+            p.attachClient(c)
+        return [p] + clients
+
+
+    def test_owner_disconnects_mid_reply(self):
+        p, a, b = self.clients(2)
+        qa, qb = messages.query('select 1'), messages.query('select 2')
+        a.messageReceived(qa)
+        b.messageReceived(qb)
+        p.messageReceived(messages.rowDescription(['a']))
+        self.assertEqual(len(a.transport.data), 1)
+
+        # b's query is sent as soon as a has gone. 
+        p.detachClient(a)
+        self.assertEqual(p.transport.data, [qa.serialize(), qb.serialize()])
+        self.assertFalse(b.transport.paused)
+        self.assertEqual(p.owner, b)
+
+        # the rest of a's reply goes nowhere, and b gets its own. 
+        p.messageReceived(messages.dataRow(['1']))
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual(len(a.transport.data), 1)
+        self.assertEqual(b.transport.data, [])
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual(len(b.transport.data), 2)
+        self.assertEqual(p.owner, None)
+        self.assertEqual(p.droppedReplies, 0)
+
+
+    def test_owner_disconnects_idle(self):
+        p, a, b = self.clients(2)
+        a.messageReceived(messages.query('select 1'))
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        p.detachClient(a)
+        self.assertEqual(p.owner, None)
+        self.assertEqual(p.droppedReplies, 0)
+        self.assertEqual(p.getPeer(), b)
+
+
+    def batch(self):
+        parse = messages._message('P', 'p1\x00select 7\x00\x00\x00', 
+                                  messages.FrontendMessage)
+        bind = messages._message('B', '\x00p1\x00' + '\x00' * 6, 
+                                 messages.FrontendMessage)
+        return parse, bind
+
+
+    def test_batch_takes_server(self):
+        """
+        The first message of an extended query batch makes its client the 
+        owner, before any Sync has been sent. 
+        """
+        p, a, b = self.clients(2)
+        parse, bind = self.batch()
+        a.messageReceived(parse)
+        self.assertEqual(p.owner, a)
+        self.assertTrue(p.openBatch)
+        self.assertEqual(p.pendingReplies, 0)
+        a.messageReceived(bind)
+        a.messageReceived(messages.sync())
+        self.assertFalse(p.openBatch)
+        self.assertEqual(p.pendingReplies, 1)
+        p.messageReceived(messages.parseComplete())
+        p.messageReceived(messages.bindComplete())
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual(p.owner, None)
+        self.assertEqual(len(a.transport.data), 3)
+
+
+    def test_batch_not_interleaved(self):
+        """
+        Another client's query isn't sent in the middle of a batch, and 
+        the replies to the batch go to the client that sent it. 
+        """
+        p, a, b = self.clients(2)
+        parse, bind = self.batch()
+        qb, sync = messages.query('select 2'), messages.sync()
+        a.messageReceived(parse)
+        a.messageReceived(bind)
+        b.messageReceived(qb)
+        self.assertEqual(p.transport.data, 
+                         [parse.serialize(), bind.serialize()])
+        self.assertTrue(b.transport.paused)
+
+        p.messageReceived(messages.parseComplete())
+        p.messageReceived(messages.bindComplete())
+        self.assertEqual([m[0] for m in a.transport.data], ['1', '2'])
+        self.assertEqual(b.transport.data, [])
+
+        # the server is a's until the Sync has been answered. 
+        a.messageReceived(sync)
+        self.assertEqual(p.transport.data[-1], sync.serialize())
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual([m[0] for m in a.transport.data], ['1', '2', 'Z'])
+        self.assertEqual(p.transport.data[-1], qb.serialize())
+        self.assertFalse(b.transport.paused)
+        self.assertEqual(p.owner, b)
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual([m[0] for m in b.transport.data], ['C', 'Z'])
+        self.assertEqual(p.owner, None)
+
+
+    def test_owner_disconnects_mid_batch(self):
+        """
+        A batch left open by a client that disconnects is closed with a 
+        Sync, and the replies to it are dropped. 
+        """
+        p, a, b = self.clients(2)
+        parse, bind = self.batch()
+        qb = messages.query('select 2')
+        a.messageReceived(parse)
+        a.messageReceived(bind)
+        b.messageReceived(qb)
+        p.detachClient(a)
+        self.assertEqual(p.transport.data, 
+                         [parse.serialize(), bind.serialize(), 
+                          messages.sync().serialize(), qb.serialize()])
+        self.assertFalse(p.openBatch)
+        self.assertEqual(p.owner, b)
+        self.assertEqual(p.droppedReplies, 1)
+
+        for m in (messages.parseComplete(), messages.bindComplete(), 
+                  messages.readyForQuery('idle')):
+            p.messageReceived(m)
+        self.assertEqual(b.transport.data, [])
+        p.messageReceived(messages.commandComplete('SELECT 1'))
+        p.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual([m[0] for m in b.transport.data], ['C', 'Z'])
+        self.assertEqual(p.owner, None)
@@ -0,0 +1,77 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest
+from pgproxy.profiler import StackSampler, CProfiler
+from pgproxy.proxy import PGProxyServerFactory
+from pgproxy import admin, proxy
+from test_fake_backend import _Service
+import os
+import pstats
+import time
+
+
+
+def _busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def test_sampler(self):
+        p = StackSampler(interval=0.001)
+        p.start()
+        _busy(0.1)
+        p.stop()
+        self.assertTrue(p.samples > 0)
+        self.assertTrue([s for s in p.stacks if 'test_profiler.py:_busy' in s])
+
+        path = self.mktemp()
+        p.write(path)
+        line = open(path).readline()
+        stack, n = line.rsplit(' ', 1)
+        self.assertTrue(int(n) > 0)
+
+
+    def test_cprofile(self):
+        p = CProfiler()
+        p.start()
+        _busy(0.01)
+        p.stop()
+        path = self.mktemp()
+        p.write(path)
+        self.assertTrue([f for f in pstats.Stats(path).stats 
+                         if f[2] == '_busy'])
+
+
+
+class ProfileCommandTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(proxy, 'reactor', self.clock)
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+        b, self.client = self.protocols()
+        self.client.factory = PGProxyServerFactory(
+            _Service({'profile-dir': self.dir, 'profile-limit': 5}))
+
+
+    def test_start_stop(self):
+        self.assertEqual(admin.profileStart(self.client)[1], [['sample', 5]])
+        self.assertRaises(admin.AdminError, admin.profileStart, self.client)
+        columns, rows = admin.profileStop(self.client)
+        path = rows[0][0]
+        self.assertEqual(os.path.dirname(path), self.dir)
+        self.assertTrue(path.endswith('.folded'))
+        self.assertTrue(os.path.exists(path))
+        self.assertRaises(admin.AdminError, admin.profileStop, self.client)
+
+
+    def test_limit(self):
+        admin.commands['profile start cprofile'](self.client)
+        self.clock.advance(5)
+        self.assertEqual(self.client.factory.profiler, None)
+        self.assertTrue(os.listdir(self.dir)[0].endswith('.pstats'))
@@ -0,0 +1,104 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from pgproxy.ready import ReadySignal
+from pgproxy import PGProxy, _readLine, _serverUp
+import os
+import socket
+
+
+
+class ReadySignalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.r, w = os.pipe()
+        self.addCleanup(os.close, self.r)
+        self.ports = []
+        self.signal = ReadySignal(w, lambda: self.ports.pop())
+
+
+    def test_port(self):
+        self.ports.append(5433)
+        self.signal.startService()
+        self.assertEqual(os.read(self.r, 100), '5433\n')
+        self.assertEqual(os.read(self.r, 100), '')
+        self.signal.stopService()
+
+
+    def test_deferred(self):
+        d = defer.Deferred()
+        self.ports.append(d)
+        self.signal.startService()
+        d.callback(6543)
+        self.assertEqual(_readLine(self.r, 1), '6543')
+
+
+    def test_stopped_first(self):
+        """
+        Stopping before the port is known closes the descriptor without
+        writing to it.
+        """
+        self.ports.append(defer.Deferred())
+        self.signal.startService()
+        self.signal.stopService()
+        self.assertEqual(_readLine(self.r, 1), None)
+
+
+
+class ReadLineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.r, self.w = os.pipe()
+        self.addCleanup(os.close, self.r)
+
+
+    def test_line(self):
+        os.write(self.w, '12')
+        os.write(self.w, '3\nmore')
+        self.assertEqual(_readLine(self.r, 1), '123')
+        os.close(self.w)
+
+
+    def test_closed(self):
+        os.write(self.w, '12')
+        os.close(self.w)
+        self.assertEqual(_readLine(self.r, 1), None)
+
+
+    def test_timeout(self):
+        self.addCleanup(os.close, self.w)
+        self.assertEqual(_readLine(self.r, 0.01), None)
+
+
+
+class PGProxyTests(unittest.TestCase):
+    """
+    Starts the proxy in a subprocess.
+    """
+
+    def setUp(self):
+        self.pidfile = self.mktemp()
+
+
+    def test_ephemeral_port(self):
+        p = PGProxy(0, ('127.0.0.1', 1), pidfile=self.pidfile).start()
+        try:
+            self.assertTrue(p.port > 0)
+            self.assertTrue(_serverUp(p.port))
+        finally:
+            p.stop()
+        self.assertNotEqual(p.proxy.returncode, None)
+
+
+    def test_cannot_listen(self):
+        s = socket.socket()
+        self.addCleanup(s.close)
+        s.bind(('', 0))
+        s.listen(1)
+        port = s.getsockname()[1]
+        p = PGProxy(port, ('127.0.0.1', 1), pidfile=self.pidfile)
+        e = self.assertRaises(AssertionError, p.start)
+        self.assertTrue('CannotListenError' in str(e), str(e))
+
+
+    def test_workers_in_process(self):
+        self.assertRaises(ValueError, PGProxy, workers=2, inProcess=True)
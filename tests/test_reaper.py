@@ -0,0 +1,177 @@
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.proxy import PGProxyServerFactory, PGProxyProtocol
+from pgproxy.stats import ProxyStats
+from pgproxy import proxy, messages
+from test_fake_backend import _Service
+
+
+
+class ClosingTransport(CollectingTransport):
+    closed = None
+    _tempDataLen = 0
+
+    def loseConnection(self):
+        self.closed = 'lost'
+
+
+    def abortConnection(self):
+        self.closed = 'aborted'
+
+
+
+class ReaperTests(FilterTest):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(proxy.time, 'time', lambda: self.now)
+        self.b, self.f = self.protocols()
+        self.b.transport = CollectingTransport()
+        self.f.transport = ClosingTransport()
+        self.f.stats = ProxyStats()
+        self.f.lastReceived = self.now
+
+
+    def reaper(self, **config):
+        factory = PGProxyServerFactory(_Service(config))
+        factory.postgresProtocol = self.b
+        return factory
+
+
+    def error(self):
+        m = messages.BackendMessage()
+        m.consume(self.f.transport.data[-1])
+        self.assertEqual(m.type, 'E')
+        return m
+
+
+    def test_idle_client_reaped(self):
+        factory = self.reaper(**{'idle-timeout': 30})
+        self.now += 30
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, None)
+
+        self.f.messageReceived(messages.query('select 1'))
+        self.b.messageReceived(messages.readyForQuery('idle'))
+        self.now += 31
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, 'lost')
+        self.assertTrue('57P05' in self.error().data)
+        self.assertEqual(self.f.stats.connections['client_reaped'], 1)
+
+
+    def test_waiting_client_not_idle(self):
+        factory = self.reaper(**{'idle-timeout': 30})
+        self.f.messageReceived(messages.query('select pg_sleep(60)'))
+        self.now += 60
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, None)
+
+
+    def test_idle_in_transaction_reaped(self):
+        factory = self.reaper(**{'idle-timeout': 300,
+                                 'idle-in-transaction-timeout': 10})
+        self.b.signalTest(True)
+        self.f.filter.savepoints = ['sp1', 'sp2']
+        self.now += 11
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, 'lost')
+        self.assertTrue('25P03' in self.error().data)
+
+        # the savepoints are rolled back, and the replies ignored.
+        self.assertEqual(self.f.filter.savepoints, [])
+        sent = ''.join(self.b.transport.data)
+        self.assertTrue('ROLLBACK TO SAVEPOINT sp2' in sent)
+        self.assertTrue('ROLLBACK TO SAVEPOINT sp1' in sent)
+        self.assertEqual(self.b.owner, self.f)
+
+
+    def test_savepoints_left_while_server_busy(self):
+        """
+        A client reaped while another owns the server has its savepoints 
+        rolled back once the owner's replies are done, before the clients 
+        waiting for the server go on. 
+        """
+        factory = self.reaper(**{'idle-in-transaction-timeout': 10})
+        self.b.signalTest(True)
+        self.f.filter.savepoints = ['sp1']
+        owner, waiting = PGProxyProtocol(), PGProxyProtocol()
+        for c in (owner, waiting):
+            c.transport = CollectingTransport()
+            c.postgresProtocol = self.b
+            c.lastReceived = self.now
+            self.b.attachClient(c)
+        q = messages.query('select 1')
+        owner.messageReceived(q)
+        waiting.messageReceived(messages.query('select 2'))
+        self.now += 11
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, 'lost')
+        self.assertEqual(self.f.filter.savepoints, ['sp1'])
+        self.assertEqual(self.b.transport.data, [q.serialize()])
+
+        # it disconnects before the server is free. 
+        self.f.connectionLost()
+        self.assertEqual(self.b.transport.data, [q.serialize()])
+
+        self.b.messageReceived(messages.commandComplete('SELECT 1'))
+        self.b.messageReceived(messages.readyForQuery('idle'))
+        self.assertEqual(self.f.filter.savepoints, [])
+        self.assertEqual(len(self.b.transport.data), 2)
+        self.assertTrue('ROLLBACK TO SAVEPOINT sp1' in self.b.transport.data[1])
+        self.assertEqual(self.b.owner, self.f)
+        self.assertTrue(waiting.heldMessages)
+
+        # the cleanup's replies are ignored, and then the waiting client's 
+        # query is sent. 
+        self.b.messageReceived(messages.commandComplete('ROLLBACK'))
+        self.b.messageReceived(messages.readyForQuery('transaction'))
+        self.assertEqual(len(self.b.transport.data), 3)
+        self.assertTrue('select 2' in self.b.transport.data[2])
+        self.assertEqual(self.b.owner, waiting)
+        self.assertEqual(len(waiting.transport.data), 0)
+
+
+    def test_slow_client_aborted(self):
+        factory = self.reaper(**{'max-client-buffer': 100})
+        self.f.transport._tempDataLen = 100
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, None)
+
+        self.f.transport._tempDataLen = 101
+        factory.reapClients()
+        self.assertEqual(self.f.transport.closed, 'aborted')
+        self.assertTrue('53000' in self.error().data)
+
+
+    def test_large_message_refused(self):
+        self.f.maxMessageSize = 100
+        self.f.dataReceived(messages.query('select 1').serialize())
+        self.assertEqual(self.f.transport.closed, None)
+
+        data = messages.query('select %s' % ('1' * 200)).serialize()
+        self.f.dataReceived(data[:20])
+        self.assertEqual(self.f.transport.closed, 'lost')
+        self.assertTrue('54000' in self.error().data)
+        self.assertFalse(self.f.parsingMessage)
+
+        # nothing more is read from it.
+        sent = len(self.b.transport.data)
+        self.f.dataReceived(data[20:])
+        self.assertEqual(len(self.b.transport.data), sent)
+
+
+    def test_reaper_runs_with_limits(self):
+        factory = self.reaper()
+        factory.startFactory()
+        self.assertEqual(factory.reaper, None)
+
+        clock = task.Clock()
+        self.patch(proxy, 'reactor', clock)
+        factory = self.reaper(**{'idle-timeout': 30})
+        factory.startFactory()
+        self.assertTrue(factory.reaper.running)
+        self.now += 31
+        clock.advance(factory.reapInterval)
+        self.assertEqual(self.f.transport.closed, 'lost')
+        factory.reaper.stop()
@@ -0,0 +1,73 @@
+from twisted.trial import unittest
+from corefilter import FilterTest
+from pgproxy.proxy import PGProxyProtocol
+from pgproxy.registry import ClientRegistry
+
+
+
+class ClientRegistryTests(unittest.TestCase):
+
+    def test_order(self):
+        r = ClientRegistry(['a', 'b', 'c'])
+        self.assertEqual(list(r), ['a', 'b', 'c'])
+        self.assertEqual(list(reversed(r)), ['c', 'b', 'a'])
+        self.assertEqual(len(r), 3)
+        self.assertEqual(r.last(), 'c')
+        self.assertTrue('b' in r)
+
+
+    def test_moveToEnd(self):
+        r = ClientRegistry(['a', 'b', 'c'])
+        r.moveToEnd('a')
+        self.assertEqual(list(r), ['b', 'c', 'a'])
+        self.assertEqual(r.last(), 'a')
+        r.moveToEnd('a')
+        self.assertEqual(list(r), ['b', 'c', 'a'])
+        self.assertRaises(ValueError, r.moveToEnd, 'x')
+
+
+    def test_remove(self):
+        r = ClientRegistry(['a', 'b', 'c'])
+        r.remove('c')
+        self.assertEqual(r.last(), 'b')
+        r.remove('a')
+        self.assertEqual(list(r), ['b'])
+        self.assertRaises(ValueError, r.remove, 'a')
+        r.discard('a')
+        r.discard('b')
+        self.assertFalse(r)
+        self.assertEqual(r.last(), None)
+
+
+    def test_popleft(self):
+        r = ClientRegistry(['a', 'b'])
+        self.assertEqual(r.popleft(), 'a')
+        self.assertEqual(r.popleft(), 'b')
+        self.assertEqual(r.last(), None)
+        self.assertRaises(IndexError, r.popleft)
+
+
+
+class ClientStateTests(FilterTest):
+
+    def test_idle_client_state_is_shared(self):
+        b, f = self.protocols()
+        self.assertFalse('heldMessages' in f.__dict__)
+        self.assertFalse('pausedFor' in f.__dict__)
+        self.assertFalse('_message' in f.__dict__)
+        self.assertEqual(f.filter.savepoints, ())
+
+
+    def test_many_clients(self):
+        b, f = self.protocols()
+        clients = [f]
+        for _ in range(1000):
+            c = PGProxyProtocol()
+            c.postgresProtocol = b
+            b.attachClient(c)
+            clients.append(c)
+        b.activateClient(clients[10])
+        self.assertTrue(b.currentClient() is clients[10])
+        b.detachClient(clients[10])
+        self.assertTrue(b.currentClient() is clients[-1])
+        self.assertEqual(len(b.clientStack), 1000)
@@ -0,0 +1,147 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.repeats import fingerprint, RepeatDetector
+from pgproxy.report import TestReport
+from pgproxy.stats import ProxyStats
+from pgproxy import messages, filters, admin
+
+
+
+class FingerprintTests(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id = 42 AND name = 'o''b'"),
+            'select * from users where id = ? and name = ?')
+
+
+    def test_params_and_lists(self):
+        self.assertEqual(fingerprint('select a from t where id in (1, 2,3)'),
+                         fingerprint('select a from t where id in ($1)'))
+
+
+    def test_whitespace_and_comments(self):
+        self.assertEqual(fingerprint('select  1 -- one\n ;'), 'select ?')
+        self.assertEqual(fingerprint('select /* x */ t1.a from t1'),
+                         'select t1.a from t1')
+
+
+    def test_negative_and_decimal(self):
+        self.assertEqual(fingerprint('select -1.5e3, 2'), 'select ?, ?')
+
+
+
+class RepeatDetectorTests(unittest.TestCase):
+
+    def test_run(self):
+        d = RepeatDetector(run=3, count=100)
+        found = [d.observe('t', 'select * from a where id = %d' % i)
+                 for i in range(5)]
+        self.assertEqual([len(f) for f in found], [0, 0, 1, 0, 0])
+        self.assertEqual(found[2][0].kind, 'run')
+        self.assertEqual(found[2][0].times, 3)
+
+
+    def test_run_broken(self):
+        d = RepeatDetector(run=3, count=100)
+        for i in range(4):
+            d.observe('t', 'select * from a where id = %d' % i)
+            d.observe('t', 'select * from b')
+        self.assertEqual(d.findings(), {})
+
+
+    def test_count(self):
+        d = RepeatDetector(run=100, count=4)
+        for i in range(4):
+            d.observe('t', 'select * from a where id = %d' % i)
+            d.observe('t', 'select * from b')
+        findings = d.findings()['t']
+        self.assertEqual([(f.kind, f.fingerprint) for f in findings],
+                         [('count', 'select * from a where id = ?'),
+                          ('count', 'select * from b')])
+
+
+    def test_tests_separate(self):
+        d = RepeatDetector(run=2, count=100)
+        d.observe('t1', 'select 1')
+        d.observe('t2', 'select 1')
+        self.assertEqual(d.findings(), {})
+
+
+    def test_ended_tests_forgotten(self):
+        d = RepeatDetector(run=2, count=100)
+        d.observe('t1', 'select 1')
+        d.observe('t1', 'select 1')
+        d.end('t1')
+        self.assertEqual(d.tests, {})
+        self.assertEqual(d.findings().keys(), ['t1'])
+
+        # a test that isn't ended is forgotten when the next one starts. 
+        d.observe('t2', 'select 1')
+        d.observe('t3', 'select 1')
+        self.assertEqual(d.tests.keys(), ['t3'])
+
+
+
+class RepeatProxyTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(filters, 'reactor', self.clock)
+
+
+    def runTest(self, notice):
+        b, f = self.protocols()
+        f.transport = CollectingTransport()
+        b.stats = f.stats = ProxyStats()
+        b.stats.tests = TestReport()
+        b.stats.repeats = RepeatDetector(run=2, count=100, notice=notice)
+        self.receiveAuth(b)
+
+        f.messageReceived(messages.query("begin test 'foo'"))
+        b.messageReceived(messages.commandComplete('BEGIN'))
+        b.messageReceived(messages.readyForQuery('transaction'))
+        for i in range(2):
+            f.messageReceived(messages.query('select %d' % i))
+            b.messageReceived(messages.commandComplete('SELECT 1'))
+            b.messageReceived(messages.readyForQuery('transaction'))
+        self.clock.advance(0)
+        return b, f
+
+
+    def test_repeats_reported(self):
+        b, f = self.runTest(False)
+        self.assertEqual(
+            [r['fingerprint'] for r in 
+             b.stats.tests.tests['foo'].asDict()['repeats']],
+            ['select ?'])
+        self.assertEqual(admin.repeats(f)[1], [['foo', 'run', 2, 'select ?']])
+        self.assertFalse('N' in [d[0] for d in f.transport.data])
+
+
+    def test_state_dropped_at_rollback(self):
+        b, f = self.runTest(False)
+        self.assertEqual(b.stats.repeats.tests.keys(), ['foo'])
+        f.messageReceived(messages.query("rollback test 'foo'"))
+        self.assertEqual(b.stats.repeats.tests, {})
+        self.assertEqual(admin.repeats(f)[1], [['foo', 'run', 2, 'select ?']])
+
+
+    def test_state_dropped_at_detach(self):
+        b, f = self.runTest(False)
+        b.detachClient(f)
+        self.assertEqual(b.stats.repeats.tests, {})
+
+
+    def test_notice(self):
+        b, f = self.runTest(True)
+        notices = [d for d in f.transport.data if d[0] == 'N']
+        self.assertEqual(len(notices), 1)
+        self.assertTrue('select ?' in notices[0])
+
+
+    def test_repeats_command_needs_detection(self):
+        b, f = self.protocols()
+        f.stats = ProxyStats()
+        self.assertRaises(admin.AdminError, admin.repeats, f)
@@ -0,0 +1,98 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest
+from pgproxy.report import TestStats, TestReport
+from pgproxy.stats import ProxyStats
+from pgproxy import messages, filters, admin
+import csv
+import json
+
+
+
+class TestStatsTests(unittest.TestCase):
+
+    def test_slowest_kept(self):
+        t = TestStats()
+        for i in range(20):
+            t.addQuery('select %d' % i, i / 100.0)
+        self.assertEqual(t.queries, 20)
+        self.assertEqual(len(t.slowest), TestStats.slowestKept)
+        self.assertEqual(t.slowestStatement(), (0.19, 'select 19'))
+        self.assertEqual([s['sql'] for s in t.asDict()['slowest']],
+                         ['select 19', 'select 18', 'select 17',
+                          'select 16', 'select 15'])
+
+
+    def report(self):
+        r = TestReport()
+        r.recordQuery('fast', messages.query('select 1'), 0.001)
+        r.recordQuery('slow', messages.query('select 2'), 0.5)
+        r.recordResult('slow', messages.dataRow(['2']))
+        return r
+
+
+    def test_write_json(self):
+        path = self.mktemp()
+        self.report().write(path)
+        data = json.load(open(path))
+        self.assertEqual(sorted(data), ['fast', 'slow'])
+        self.assertEqual(data['slow']['rows'], 1)
+        self.assertEqual(data['slow']['slowest'],
+                         [{'seconds': 0.5, 'sql': 'select 2'}])
+
+
+    def test_write_csv(self):
+        path = self.mktemp() + '.csv'
+        self.report().write(path)
+        rows = list(csv.reader(open(path)))
+        self.assertEqual(rows[0][:3], ['test', 'queries', 'backend_seconds'])
+        self.assertEqual([r[0] for r in rows[1:]], ['slow', 'fast'])
+        self.assertEqual(rows[1][-1], 'select 2')
+
+
+
+class ReportProxyTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(filters, 'reactor', self.clock)
+
+
+    def test_test_work_reported(self):
+        b, f = self.protocols()
+        b.stats = f.stats = ProxyStats()
+        b.stats.tests = TestReport()
+        self.receiveAuth(b)
+
+        f.messageReceived(messages.query("begin test 'foo'"))
+        b.messageReceived(messages.commandComplete('BEGIN'))
+        b.messageReceived(messages.readyForQuery('transaction'))
+        f.messageReceived(messages.query('begin'))
+        b.messageReceived(messages.commandComplete('SAVEPOINT'))
+        b.messageReceived(messages.readyForQuery('transaction'))
+        f.messageReceived(messages.query('select 1'))
+        b.messageReceived(messages.rowDescription(['?column?']))
+        b.messageReceived(messages.dataRow(['1']))
+        b.messageReceived(messages.commandComplete('SELECT 1'))
+        b.messageReceived(messages.readyForQuery('transaction'))
+        f.messageReceived(messages.query("rollback test 'foo'"))
+        b.messageReceived(messages.commandComplete('ROLLBACK'))
+        b.messageReceived(messages.readyForQuery('idle'))
+
+        t = b.stats.tests.tests['foo']
+        self.assertEqual(t.queries, 3)
+        self.assertEqual(t.rows, 1)
+        self.assertEqual(t.savepoints, 1)
+        sqls = sorted([sql for _, sql in t.slowest])
+        self.assertEqual(sqls[0], 'BEGIN; -- foo')
+        self.assertTrue(sqls[1].startswith('SAVEPOINT sp_'))
+        self.assertEqual(sqls[2], 'select 1')
+
+        columns, rows = admin.tests(f)
+        self.assertEqual(rows[0][:2], ['foo', 3])
+
+
+    def test_tests_command_needs_report(self):
+        b, f = self.protocols()
+        f.stats = ProxyStats()
+        self.assertRaises(admin.AdminError, admin.tests, f)
@@ -0,0 +1,165 @@
+from twisted.trial import unittest
+from corefilter import FilterTest, MockTransport
+from pgproxy.proxy import PGProxyProtocol
+from pgproxy.statements import StatementTable, PreparedStatements
+from pgproxy.stats import ProxyStats
+from pgproxy import messages, admin
+import csv
+import json
+
+
+
+class StatementTableTests(unittest.TestCase):
+
+    def reply(self, table, sql, seconds, *results):
+        for r in results:
+            table.recordResult(r)
+        table.recordReply(messages.query(sql), seconds)
+
+
+    def test_aggregates(self):
+        t = StatementTable()
+        for i in range(10):
+            self.reply(t, 'select * from a where id = %d' % i, 0.001 * i,
+                       messages.dataRow(['1']),
+                       messages.commandComplete('SELECT 1'))
+        self.reply(t, "update a set x = 'y'", 0.01,
+                   messages.commandComplete('UPDATE 7'))
+
+        rows = dict([(r['fingerprint'], r) 
+                     for r in [s.asDict() for s in t.ranked()]])
+        s = rows['select * from a where id = ?']
+        self.assertEqual(s['calls'], 10)
+        self.assertEqual(s['rows'], 10)
+        self.assertTrue(s['p99_ms'] >= s['p95_ms'] >= s['mean_ms'] > 0)
+        self.assertEqual(rows['update a set x = ?']['rows'], 7)
+
+
+    def test_extended_query(self):
+        t = StatementTable()
+        sync = messages.sync()
+        t.recordReply(sync, 0.001)
+        self.assertEqual(t.statements.keys(), [])
+        sync.executed = ['select $1']
+        t.recordReply(sync, 0.001)
+        self.assertEqual(t.statements.keys(), ['select ?'])
+
+
+    def test_prepared_statements(self):
+        p = PreparedStatements()
+        p.parse('', 'select $1')
+        p.parse('s1', 'select * from a where id = $1')
+        p.bind('', 's1')
+        p.execute('')
+        p.bind('p1', '')
+        p.execute('p1')
+        self.assertEqual(p.sync(), 
+                         ['select * from a where id = $1', 'select $1'])
+        self.assertEqual(p.sync(), [])
+        p.close('S', 's1')
+        p.close('P', 'p1')
+        p.execute('')
+        p.execute('p1')
+        self.assertEqual(p.sync(), [])
+
+
+    def test_lru_eviction(self):
+        t = StatementTable(maxSize=2)
+        self.reply(t, 'select 1 from a', 0.001)
+        self.reply(t, 'select 1 from b', 0.001)
+        self.reply(t, 'select 1 from a', 0.001)
+        self.reply(t, 'select 1 from c', 0.001)
+        self.assertEqual(t.statements.keys(),
+                         ['select ? from a', 'select ? from c'])
+        self.assertEqual(t.evicted, 1)
+
+
+    def test_write(self):
+        t = StatementTable()
+        self.reply(t, 'select 1', 0.5)
+        path = self.mktemp()
+        t.write(path)
+        data = json.load(open(path))
+        self.assertEqual(data['statements'][0]['fingerprint'], 'select ?')
+        t.write(path + '.csv')
+        rows = list(csv.reader(open(path + '.csv')))
+        self.assertEqual(rows[0], list(StatementTable.columns))
+        self.assertEqual(rows[1][:2], ['select ?', '1'])
+
+
+
+class StatementProxyTests(FilterTest):
+
+    def test_client_latency(self):
+        b, f = self.protocols()
+        b.stats = f.stats = ProxyStats()
+        b.stats.statements = StatementTable()
+        self.receiveAuth(b)
+
+        q = messages.query('select 1')
+        f.messageReceived(q)
+        self.assertNotEqual(q.received, None)
+        q.received -= 1
+        b.messageReceived(messages.dataRow(['1']))
+        b.messageReceived(messages.commandComplete('SELECT 1'))
+        b.messageReceived(messages.readyForQuery('idle'))
+
+        columns, rows = admin.statements(f)
+        self.assertEqual(rows[0][:2], ['select ?', 1])
+        self.assertTrue(rows[0][columns.index('total_ms')] >= 1000)
+
+
+    def batch(self, f, b, *ms):
+        for m in ms + (messages.sync(),):
+            f.messageReceived(m)
+        for m in ms:
+            b.messageReceived(
+                {'P': messages.parseComplete, 'B': messages.bindComplete, 
+                 'E': lambda: messages.commandComplete('SELECT 1')}[m.type]())
+        b.messageReceived(messages.readyForQuery('idle'))
+
+
+    def test_named_statement_reused(self):
+        """
+        A named statement that's executed again after a Parse of other 
+        SQL, and after another client has prepared a statement of the same 
+        name, is charged to its own SQL. 
+        """
+        b, f = self.protocols()
+        f2 = PGProxyProtocol()
+        f2.transport = MockTransport()
+        f2.postgresProtocol = b
+        b.attachClient(f2)
+        b.stats = f.stats = f2.stats = ProxyStats()
+        b.stats.statements = StatementTable()
+        self.receiveAuth(b)
+
+        parse = lambda name, sql: messages._message(
+            'P', '%s\x00%s\x00\x00\x00' % (name, sql), 
+            messages.FrontendMessage)
+        bind = lambda portal, name: messages._message(
+            'B', '%s\x00%s\x00' % (portal, name) + '\x00' * 6, 
+            messages.FrontendMessage)
+        execute = messages._message('E', '\x00\x00\x00\x00\x00', 
+                                    messages.FrontendMessage)
+
+        self.batch(f, b, parse('s1', 'select * from a where id = $1'), 
+                   bind('', 's1'), execute)
+        self.batch(f, b, parse('', 'select * from b'), bind('', ''), execute)
+        self.batch(f2, b, parse('s1', 'delete from c'), bind('', 's1'), 
+                   execute)
+        self.batch(f, b, bind('', 's1'), execute)
+        # a batch that executes nothing isn't a call. 
+        self.batch(f, b, parse('', 'select 2'))
+
+        calls = dict([(s.fingerprint, s.calls) 
+                      for s in b.stats.statements.ranked()])
+        self.assertEqual(calls, {'select * from a where id = ?': 2, 
+                                 'select * from b': 1, 
+                                 'delete from c': 1})
+
+
+    def test_statements_command_needs_table(self):
+        b, f = self.protocols()
+        f.stats = ProxyStats()
+        self.assertRaises(admin.AdminError, admin.statements, f)
@@ -0,0 +1,80 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest
+from pgproxy.stats import Histogram, ProxyStats
+from pgproxy import messages, filters, admin
+
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_buckets(self):
+        h = Histogram()
+        prev = -1
+        for v in range(0, 100000, 7):
+            i = h.index(v)
+            self.assertTrue(i >= prev)
+            self.assertTrue(h.lowest(i) <= v)
+            self.assertTrue(v - h.lowest(i) <= max(1, v / 16))
+            prev = i
+
+
+    def test_percentiles(self):
+        h = Histogram()
+        for ms in range(1, 101):
+            h.record(ms / 1000.0)
+        s = h.summary()
+        self.assertEqual(s['count'], 100)
+        self.assertEqual(s['min'], 1.0)
+        self.assertEqual(s['max'], 100.0)
+        self.assertEqual(s['mean'], 50.5)
+        self.assertTrue(47 <= s['p50'] <= 50, s['p50'])
+        self.assertTrue(93 <= s['p99'] <= 99, s['p99'])
+
+
+    def test_empty(self):
+        self.assertEqual(Histogram().summary(), {'count': 0})
+        self.assertEqual(Histogram().percentile(50), None)
+
+
+
+class ProxyStatsTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(filters, 'reactor', self.clock)
+
+
+    def protocols(self):
+        b, f = FilterTest.protocols(self)
+        self.stats = b.stats = f.stats = ProxyStats()
+        return b, f
+
+
+    def test_counts(self):
+        b, f = self.protocols()
+        self.receiveAuth(b)
+        q = messages.query('select 1')
+        f.messageReceived(q)
+        b.messageReceived(messages.readyForQuery('idle'))
+        f.messageReceived(messages.query('begin'))
+        self.clock.advance(0)
+
+        s = self.stats.snapshot()
+        self.assertEqual(s['messages']['FQ'], 2)
+        self.assertEqual(s['messages']['bQ'], 1)
+        self.assertEqual(s['bytes']['bQ'], len(q.serialize()))
+        self.assertEqual(s['messages']['BZ'], 2)
+        self.assertEqual(s['messages']['fZ'], 3)
+        self.assertEqual(s['actions'], {'drop': 1, 'spoof': 1})
+        self.assertEqual(s['latency_ms']['Q']['count'], 1)
+
+
+    def test_admin_query(self):
+        b, f = self.protocols()
+        self.receiveAuth(b)
+        f.messageReceived(messages.query('show pgproxy stats'))
+        columns, rows = admin.stats(f)
+        self.assertEqual(columns, ['name', 'value'])
+        self.assertTrue(['messages.FQ', 1] in rows)
+        self.assertTrue(['actions.spoof', 1] in rows)
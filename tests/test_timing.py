@@ -0,0 +1,72 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from corefilter import FilterTest, CollectingTransport
+from pgproxy.timing import StageTimes
+from pgproxy.stats import ProxyStats
+from pgproxy import messages, filters, admin
+
+
+
+class StageTimesTests(unittest.TestCase):
+
+    def test_totals(self):
+        t = StageTimes()
+        t.add('parse', 'FQ', 1, 0.5)
+        t.add('parse', 'FQ', 2, 0.25)
+        t.add('write', 'bQ', 1, 0.125)
+        self.assertEqual(t.types['parse', 'FQ'], [2, 0.75])
+        self.assertEqual(t.rows(), [
+                ('type', 'FQ', 'parse', 2, 0.75),
+                ('type', 'bQ', 'write', 1, 0.125),
+                ('connection', 1, 'parse', 1, 0.5),
+                ('connection', 1, 'write', 1, 0.125),
+                ('connection', 2, 'parse', 1, 0.25)])
+
+        t.forget(1)
+        self.assertEqual(t.connections.keys(), [2])
+
+
+
+class StageTimingProxyTests(FilterTest):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(filters, 'reactor', self.clock)
+
+
+    def test_stages_timed(self):
+        b, f = self.protocols()
+        b.transport = CollectingTransport()
+        f.transport = CollectingTransport()
+        b.stats = f.stats = ProxyStats()
+        b.timing = f.timing = StageTimes()
+        f.connectionId = 7
+        self.receiveAuth(b)
+
+        q = messages.query('select 1').serialize()
+        f.dataReceived(q[:3])
+        f.dataReceived(q[3:])
+        b.dataReceived(messages.commandComplete('SELECT 1').serialize() + 
+                       messages.readyForQuery('idle').serialize())
+        f.dataReceived(messages.query('begin').serialize())
+
+        types = b.timing.types
+        self.assertEqual(types['parse', 'FQ'][0], 2)
+        self.assertEqual(types['filter', 'FQ'][0], 2)
+        self.assertEqual(types['write', 'bQ'][0], 1)
+        self.assertEqual(types['parse', 'BZ'][0], 1)
+        self.assertEqual(types['write', 'fZ'][0], 2)
+        self.assertEqual(types['wait', 'FQ'][0], 1)
+        self.assertEqual(types['spoof', 'fC'][0], 1)
+        self.assertEqual(sorted(b.timing.connections[7]), 
+                         ['filter', 'parse', 'spoof', 'wait', 'write'])
+
+        columns, rows = admin.stages(f)
+        self.assertEqual(columns[:3], ['scope', 'key', 'stage'])
+        self.assertTrue(['connection', 7, 'wait', 1] in 
+                        [r[:4] for r in rows])
+
+
+    def test_stages_command_needs_timing(self):
+        b, f = self.protocols()
+        self.assertRaises(admin.AdminError, admin.stages, f)
@@ -0,0 +1,161 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.python import usage
+from pgproxy.fakebackend import FakeBackendFactory
+from pgproxy.proxy import PGProxyServerFactory
+from pgproxy.bench.client import BenchClientProtocol, connectUnix
+from pgproxy.unix import socketPath, isDirectory
+from pgproxy import aio, options, PGProxy
+import os
+import shutil
+import stat
+import tempfile
+
+
+
+class _Service(object):
+
+    def __init__(self, config):
+        self.config = config
+
+
+
+class SocketPathTests(unittest.TestCase):
+
+    def test_directory(self):
+        self.assertEqual(socketPath('/tmp', 5433), '/tmp/.s.PGSQL.5433')
+        self.assertTrue(isDirectory('/tmp'))
+
+
+    def test_socket(self):
+        """
+        A path already named like a socket is the socket itself, whatever
+        the port.
+        """
+        self.assertEqual(socketPath('/tmp/.s.PGSQL.5432', 0),
+                         '/tmp/.s.PGSQL.5432')
+        self.assertFalse(isDirectory('/tmp/.s.PGSQL.5432'))
+
+
+
+class ValidationTests(unittest.TestCase):
+
+    def parse(self, *args):
+        config = options.Options()
+        config.parseOptions(list(args))
+        return config
+
+
+    def test_both(self):
+        config = self.parse('--listen-unix=/tmp')
+        self.assertEqual(config['listen-unix'], '/tmp')
+        self.assertFalse(config['no-tcp'])
+
+
+    def test_noTcp(self):
+        self.assertRaises(usage.UsageError, self.parse, '--no-tcp')
+        self.assertTrue(self.parse('--no-tcp', '--listen-unix=/tmp')['no-tcp'])
+
+
+    def test_workers(self):
+        self.assertRaises(usage.UsageError, self.parse, '--listen-unix=/tmp',
+                          '--workers=2')
+
+
+    def test_anyPort(self):
+        """
+        The socket in a directory is named for the port, so the port can't
+        be picked once listening.
+        """
+        self.assertRaises(usage.UsageError, self.parse, '--listen-unix=/tmp',
+                          '--listen-port=0')
+        self.parse('--listen-unix=/tmp/.s.PGSQL.5433', '--listen-port=0')
+
+
+
+class UnixProxyTests(unittest.TestCase):
+    """
+    Runs a query through a proxy that's connected to a fake backend, with
+    everything connected by Unix sockets.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='pgproxy-test-')
+        self.backend = FakeBackendFactory()
+        self.backendPort = reactor.listenUNIX(
+            socketPath(self.dir, 5432), self.backend)
+        self.proxy = PGProxyServerFactory(_Service({
+                    'server-unix': self.dir, 'server-port': 5432}))
+        self.proxyPort = reactor.listenUNIX(
+            socketPath(self.dir, 5433), self.proxy)
+        self.clients = []
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for c in self.clients:
+            c.terminate()
+        yield self.proxyPort.stopListening()
+        yield self.backendPort.stopListening()
+        yield defer.gatherResults([p.lost for p in self.backend.protocols])
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+    @defer.inlineCallbacks
+    def test_query(self):
+        c = yield connectUnix(socketPath(self.dir, 5433))
+        self.clients.append(c)
+        yield c.startup()
+        yield c.query('select 1')
+        self.assertEqual(c.errors, 0)
+        self.assertEqual(c.rows, 1)
+        self.assertEqual(len(self.backend.protocols), 1)
+
+
+
+class PGProxyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='pgproxy-test-')
+        self.backend = FakeBackendFactory()
+        self.backendPort = reactor.listenUNIX(
+            socketPath(self.dir, 5432), self.backend)
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.backendPort.stopListening()
+        yield defer.gatherResults([p.lost for p in self.backend.protocols])
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+    @defer.inlineCallbacks
+    def _query_test(self, **kw):
+        p = PGProxy(5433, ('localhost', 5432),
+                    pidfile=os.path.join(self.dir, 'pgproxy.pid'),
+                    listenUnix=self.dir, serverUnix=self.dir,
+                    listenTcp=False, **kw)
+        p.start()
+        try:
+            self.assertEqual(p.socketPath, socketPath(self.dir, 5433))
+            mode = os.stat(p.socketPath).st_mode
+            self.assertTrue(stat.S_ISSOCK(mode))
+            self.assertEqual(stat.S_IMODE(mode), 0777)
+            c = yield connectUnix(p.socketPath)
+            yield c.startup()
+            yield c.query('select 1')
+            self.assertEqual(c.errors, 0)
+            c.terminate()
+        finally:
+            p.stop()
+        self.assertFalse(os.path.exists(p.socketPath))
+
+
+    def test_twisted(self):
+        return self._query_test()
+
+
+    def test_asyncio(self):
+        if not aio.available():
+            raise unittest.SkipTest('asyncio is not available')
+        return self._query_test(engine='asyncio')
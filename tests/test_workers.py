@@ -0,0 +1,199 @@
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from pgproxy.twistd import Options
+from pgproxy.metrics import aggregate
+from pgproxy import workers
+import socket
+
+
+
+class FakeReactor(task.Clock):
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+        self.pids = iter(range(100, 200))
+
+
+    def spawnProcess(self, p, executable, args, env=None, childFDs=None):
+        p.transport = FakeProcess(self.pids.next())
+        self.spawned.append((p, args))
+
+
+
+class FakeProcess(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.signals = []
+
+
+    def signalProcess(self, sig):
+        self.signals.append(sig)
+
+
+
+def _config(*argv):
+    config = Options()
+    config.parseOptions(list(argv))
+    return config
+
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.patch(workers, 'reactor', self.reactor)
+        self.now = 1000.0
+        self.patch(workers.time, 'time', lambda: self.now)
+        self.supervisor = workers.Supervisor(_config(
+                '--workers=2', '--server-port=6543', '--report=r.json',
+                '--metrics-port=9000', '--stage-timing'))
+
+
+    def end(self, p):
+        p.processEnded(failure.Failure(error.ProcessTerminated(1)))
+
+
+    def test_workerArgs(self):
+        args = self.supervisor.workerArgs(1)
+        for a in ('--workers=2', '--worker=1', '--pidfile=', 
+                  '--server-port=6543', '--report=r.1.json', 
+                  '--metrics-port=9002', '--stage-timing'):
+            self.assertTrue(a in args, a)
+        self.assertFalse('--listen-port=5433' in args)
+        self.assertTrue('--ready-fd=%d' % workers.readyFd in args)
+
+
+    def test_ready_fd_not_passed_on(self):
+        self.supervisor.config['ready-fd'] = 7
+        self.assertFalse('--ready-fd=7' in self.supervisor.workerArgs(0))
+
+
+    def test_ready(self):
+        self.supervisor.startService()
+        ready = []
+        self.supervisor.ready.addCallback(ready.append)
+        self.supervisor.workers[0].childDataReceived(workers.readyFd, '5433\n')
+        self.assertEqual(ready, [])
+        self.supervisor.workers[1].childDataReceived(workers.readyFd, '5433\n')
+        self.assertEqual(ready, [5433])
+
+
+    def test_start_and_restart(self):
+        self.supervisor.startService()
+        self.assertEqual(sorted(self.supervisor.workers), [0, 1])
+        w = self.supervisor.workers[0]
+        self.end(w)
+        self.assertEqual(sorted(self.supervisor.workers), [1])
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEqual(sorted(self.supervisor.workers), [0, 1])
+        self.assertEqual(self.supervisor.restarted, 1)
+
+        # crashing again right away waits longer
+        self.end(self.supervisor.workers[0])
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertFalse(0 in self.supervisor.workers)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertTrue(0 in self.supervisor.workers)
+
+        # but not after running for a while
+        self.now += self.supervisor.stableAfter
+        self.end(self.supervisor.workers[0])
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertTrue(0 in self.supervisor.workers)
+
+
+    def test_stop(self):
+        self.supervisor.startService()
+        ws = self.supervisor.workers.values()
+        d = self.supervisor.stopService()
+        for w in ws:
+            self.assertEqual(w.transport.signals, [workers.signal.SIGTERM])
+        self.end(ws[0])
+        self.reactor.advance(self.supervisor.killTimeout)
+        self.assertEqual(ws[1].transport.signals, 
+                         [workers.signal.SIGTERM, workers.signal.SIGKILL])
+        self.end(ws[1])
+        self.assertEqual(self.supervisor.workers, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        return d
+
+
+    def test_output_logged(self):
+        logged = []
+        self.patch(workers.log, 'msg', logged.append)
+        p = workers.WorkerProcess(self.supervisor, 3)
+        p.childDataReceived(1, 'one\ntw')
+        p.childDataReceived(1, 'o\n')
+        self.assertEqual(logged, ['worker 3: one', 'worker 3: two'])
+
+
+
+class ReusePortTests(unittest.TestCase):
+
+    def test_two_listeners(self):
+        if workers.SO_REUSEPORT is None:
+            raise unittest.SkipTest('SO_REUSEPORT is not available')
+        a = workers.reusePortSocket(0, '127.0.0.1')
+        self.addCleanup(a.close)
+        b = workers.reusePortSocket(a.getsockname()[1], '127.0.0.1')
+        self.addCleanup(b.close)
+        self.assertEqual(a.getsockname(), b.getsockname())
+
+
+    def test_workerPath(self):
+        self.assertEqual(workers.workerPath('/x/report.json', 2), 
+                         '/x/report.2.json')
+        self.assertEqual(workers.workerPath('cassette', 0), 'cassette.0')
+
+
+
+class AggregateTests(unittest.TestCase):
+
+    def page(self, uptime, clients, latency):
+        return '\n'.join([
+                '# HELP pgproxy_uptime_seconds Seconds since the proxy started.',
+                '# TYPE pgproxy_uptime_seconds gauge',
+                'pgproxy_uptime_seconds %.3f' % uptime,
+                '# HELP pgproxy_client_connections Client connections that '
+                'are open.',
+                '# TYPE pgproxy_client_connections gauge',
+                'pgproxy_client_connections %d' % clients,
+                '# HELP pgproxy_reply_latency_seconds Seconds.',
+                '# TYPE pgproxy_reply_latency_seconds histogram',
+                'pgproxy_reply_latency_seconds_bucket{le="+Inf",type="Q"} 2',
+                'pgproxy_reply_latency_seconds_sum{type="Q"} %.6f' % latency,
+                ]) + '\n'
+
+
+    def test_aggregate(self):
+        lines = aggregate([self.page(5, 3, 0.5), 
+                           self.page(7, 4, 0.25)]).splitlines()
+        self.assertEqual(lines, [
+                '# HELP pgproxy_uptime_seconds Seconds since the proxy started.',
+                '# TYPE pgproxy_uptime_seconds gauge',
+                'pgproxy_uptime_seconds 7.000000',
+                '# HELP pgproxy_client_connections Client connections that '
+                'are open.',
+                '# TYPE pgproxy_client_connections gauge',
+                'pgproxy_client_connections 7',
+                '# HELP pgproxy_reply_latency_seconds Seconds.',
+                '# TYPE pgproxy_reply_latency_seconds histogram',
+                'pgproxy_reply_latency_seconds_bucket{le="+Inf",type="Q"} 4',
+                'pgproxy_reply_latency_seconds_sum{type="Q"} 0.750000',
+                ])
+        self.assertEqual(aggregate([]), '\n')
+
+
+
+class OptionsTests(unittest.TestCase):
+
+    def test_workers_validated(self):
+        from twisted.python import usage
+        self.assertRaises(usage.UsageError, _config, '--workers=0')
+        self.assertRaises(usage.UsageError, _config, '--workers=2', 
+                          '--listen-port=0')
+        self.assertEqual(_config('--workers=3')['workers'], 3)
@@ -0,0 +1,138 @@
+from twisted.trial import unittest
+from pgproxy.writeset import writtenTables, truncateQuery, WriteSetIndex
+
+
+
+class WrittenTablesTests(unittest.TestCase):
+
+    def assertTables(self, sql, *tables):
+        self.assertEqual(writtenTables(sql), set(tables))
+
+
+    def test_insert(self):
+        self.assertTables('insert into foo (x) values (1)', 'foo')
+
+
+    def test_update(self):
+        self.assertTables('UPDATE Foo SET x = 1', 'foo')
+
+
+    def test_update_only(self):
+        self.assertTables('update only foo set x = 1', 'foo')
+
+
+    def test_delete(self):
+        self.assertTables('delete from public.foo where x = 1', 'public.foo')
+
+
+    def test_quoted_name_keeps_case(self):
+        self.assertTables('insert into "Foo" values (1)', '"Foo"')
+
+
+    def test_copy_from(self):
+        self.assertTables('copy foo (x, y) from stdin', 'foo')
+
+
+    def test_copy_to_is_not_a_write(self):
+        self.assertTables('copy foo to stdout')
+
+
+    def test_select_for_update_is_not_a_write(self):
+        self.assertTables('select * from foo for update')
+        self.assertTables('select * from foo for update of foo')
+
+
+    def test_upsert(self):
+        self.assertTables(
+            'insert into foo values (1) on conflict (x) do update set x = 2',
+            'foo')
+
+
+    def test_literals_ignored(self):
+        self.assertTables("select 'delete from foo'")
+
+
+    def test_multiple_statements(self):
+        self.assertTables(
+            'insert into foo values (1); update bar set x = 1', 'foo', 'bar')
+
+
+    def test_select(self):
+        self.assertTables('select * from updates')
+
+
+    def test_multiline(self):
+        self.assertTables('insert\n  into\tfoo values (1)', 'foo')
+        self.assertTables('copy foo\n(x)\nfrom stdin', 'foo')
+
+
+    def test_comments_ignored(self):
+        self.assertTables('select 1 -- delete from foo')
+        self.assertTables('select 1 /* update foo set x = 1 */')
+        self.assertTables('/* note */ update foo -- why\n set x = 1', 'foo')
+
+
+    def test_comment_markers_in_literals(self):
+        self.assertTables("insert into foo values ('--'); delete from bar",
+                          'foo', 'bar')
+        self.assertTables("select '/*'; delete from bar; select '*/'", 'bar')
+
+
+    def test_dollar_quoted_literals_ignored(self):
+        self.assertTables('select $$delete from foo$$')
+        self.assertTables('select $x$ update foo set y = 1 $x$')
+
+
+    def test_quoted_name_with_comment_marker(self):
+        self.assertTables('delete from "a--b"', '"a--b"')
+
+
+    def test_foreign_key_actions(self):
+        self.assertTables(
+            'create table foo (x int references bar on update cascade '
+            'on delete cascade)')
+        self.assertTables(
+            'alter table foo add foreign key (x) references bar (y) '
+            'on update set null')
+
+
+    def test_trigger_events(self):
+        self.assertTables(
+            'create trigger t before update on foo for each row '
+            'execute procedure f()')
+        self.assertTables(
+            'create trigger t after insert or update or delete on foo '
+            'execute procedure f()')
+        self.assertTables(
+            'create trigger t instead of update on foo_view '
+            'execute procedure f()')
+        self.assertTables(
+            'create trigger t before update of x on foo '
+            'execute procedure f()')
+
+
+    def test_grants(self):
+        self.assertTables('grant update on foo to someone')
+        self.assertTables('grant select, update, delete on foo to someone')
+        self.assertTables('revoke update on foo from someone')
+        self.assertTables(
+            'grant update on foo to someone; delete from bar', 'bar')
+
+
+
+class WriteSetIndexTests(unittest.TestCase):
+
+    def test_record_and_discard(self):
+        i = WriteSetIndex()
+        i.record('t', 'insert into foo values (1)')
+        i.record('t', 'delete from bar')
+        i.record('u', 'delete from baz')
+        self.assertEqual(i.tables('t'), ['bar', 'foo'])
+        self.assertEqual(i.discard('t'), ['bar', 'foo'])
+        self.assertEqual(i.tables('t'), [])
+        self.assertEqual(i.tables('u'), ['baz'])
+
+
+    def test_truncateQuery(self):
+        self.assertEqual(truncateQuery(['bar', 'foo']),
+                         'TRUNCATE bar, foo RESTART IDENTITY CASCADE')